@@ -0,0 +1,5 @@
+"""
+Benchmarks of query matching, rule dispatch, storage and invoke.
+
+Run with ``python -m benchmarks``, see ``python -m benchmarks --help``.
+"""
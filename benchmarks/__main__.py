@@ -0,0 +1,85 @@
+"""
+Run the benchmarks and write the results as JSON.
+
+    python -m benchmarks --scale quick -o before.json
+    python -m benchmarks -o after.json
+    python -m benchmarks --compare before.json after.json
+"""
+
+import sys
+import json
+import time
+import platform
+import argparse
+from . import bench_query, bench_dispatch, bench_storage, bench_invoke
+from .common import SCALES, result_doc
+
+SUITES = {
+    'query': bench_query,
+    'dispatch': bench_dispatch,
+    'storage': bench_storage,
+    'invoke': bench_invoke,
+}
+
+
+def result_key(doc):
+    return doc['name'], json.dumps(doc['params'], sort_keys=True)
+
+
+def run(suites, scale):
+    results = []
+    for name in suites:
+        for result in SUITES[name].run(SCALES[scale]):
+            doc = result_doc(result)
+            print('{:<24} {:<50} {:>12.2f} us/op'.format(
+                doc['name'], json.dumps(doc['params'], sort_keys=True),
+                doc['us_per_op']), file=sys.stderr)
+            results.append(doc)
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'scale': scale,
+        'results': results
+    }
+
+
+def compare(old_path, new_path):
+    with open(old_path) as stream:
+        old = dict((result_key(doc), doc)
+                   for doc in json.load(stream)['results'])
+    with open(new_path) as stream:
+        new = json.load(stream)['results']
+    for doc in new:
+        before = old.get(result_key(doc))
+        if before is None:
+            continue
+        ratio = before['us_per_op'] / doc['us_per_op']
+        print('{:<24} {:<50} {:>10.2f} -> {:>10.2f} us/op  x{:.2f}'.format(
+            doc['name'], json.dumps(doc['params'], sort_keys=True),
+            before['us_per_op'], doc['us_per_op'], ratio))
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks')
+    parser.add_argument('suites', nargs='*',
+                        help='suites to run: {}, all by default'.format(
+                            ', '.join(SUITES)))
+    parser.add_argument('--scale', choices=list(SCALES), default='default')
+    parser.add_argument('-o', '--output', type=argparse.FileType('w'),
+                        default=sys.stdout)
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'))
+    ns = parser.parse_args()
+    unknown = set(ns.suites) - set(SUITES)
+    if unknown:
+        parser.error('unknown suites: {}'.format(', '.join(sorted(unknown))))
+    if ns.compare:
+        compare(*ns.compare)
+        return
+    report = run(ns.suites or list(SUITES), ns.scale)
+    json.dump(report, ns.output, indent=2)
+    ns.output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,27 @@
+"""Rule dispatch over growing rule sets."""
+
+from imi.context import ContextAgent, ContextError
+from .common import measure, make_rules, make_message
+
+NUMBER = 5000
+
+
+def run(scale):
+    for count in scale['rules']:
+        agent = ContextAgent(make_rules(count), None)
+        first = make_message(0, 1)
+        last = make_message(count - 1, 1)
+        params = {'rules': count}
+        yield measure('dispatch.find_rule', dict(params, target='first'),
+                      lambda: agent.find_rule(first), NUMBER)
+        yield measure('dispatch.find_rule', dict(params, target='last'),
+                      lambda: agent.find_rule(last), NUMBER)
+        unknown = make_message(count, 1)
+
+        def miss():
+            try:
+                agent.find_rule(unknown)
+            except ContextError:
+                pass
+        yield measure('dispatch.find_rule', dict(params, target='none'),
+                      miss, NUMBER)
@@ -0,0 +1,92 @@
+"""End-to-end /invoke throughput with noop:// nodes."""
+
+import json
+import threading
+import http.client
+from wsgiref.simple_server import WSGIRequestHandler, make_server
+from bottle import Bottle
+from imi import handlers
+from imi.context import ContextAgent
+from imi.storage import Database
+from imi.web import WebApp, ThreadingWSGIServer, setup_routing
+from .common import timed, MemoryStore, make_rules, make_message
+
+CLIENTS = 8
+
+
+class BenchApp(WebApp):
+    """WebApp on synthetic rules and an in-memory store."""
+
+    def __init__(self, rules):
+        self.db = Database(MemoryStore())
+        self.ctx = ContextAgent(rules, self.db)
+
+
+class QuietHandler(WSGIRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+
+def post(port, message):
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    try:
+        data = json.dumps(message)
+        headers = {'Content-Type': 'application/json'}
+        conn.request('POST', '/invoke', data, headers)
+        response = conn.getresponse()
+        response.read()
+        return response.status
+    finally:
+        conn.close()
+
+
+def send_all(port, messages):
+    lock = threading.Lock()
+    errors = []
+
+    def client():
+        while True:
+            with lock:
+                message = next(messages, None)
+            if message is None:
+                return
+            if post(port, message) != 200:
+                errors.append(message)
+    threads = [threading.Thread(target=client) for _ in range(CLIENTS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+def run(scale):
+    handlers.register()
+    count = scale['requests']
+    rules = make_rules(100)
+    app = BenchApp(rules)
+    params = {'rules': len(rules), 'nodes': 2}
+    messages = [make_message(num % len(rules), num) for num in range(count)]
+    with timed('agent.apply_message', params, count) as result:
+        for message in messages:
+            app.ctx.apply_message(message)
+    yield result[0]
+    bottle_app = Bottle(catchall=False)
+    setup_routing(bottle_app, BenchApp(rules))
+    server = make_server('127.0.0.1', 0, bottle_app,
+                         ThreadingWSGIServer, QuietHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        port = server.server_port
+        with timed('web.invoke', dict(params, clients=CLIENTS),
+                   count) as result:
+            errors = send_all(port, iter(messages))
+        if errors:
+            raise RuntimeError('{} requests failed'.format(len(errors)))
+        yield result[0]
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
@@ -0,0 +1,50 @@
+"""Micro benchmarks of query.match and index.extract."""
+
+from imi.query import match, compile as compile_query
+from imi.index import extract, compile as compile_index
+from .common import measure, make_message
+
+NUMBER = 20000
+
+RICH_QUERY = {
+    'source': {'$exists': True},
+    'type': {'$in': ['urn:type:bench:0', 'urn:type:bench:1']},
+    'name': {'$regex': '^name-'},
+    'visit.rooms': {'$elemMatch': {'floor': {'$gt': 1}}},
+    '$or': [{'physician': 'phys-1'}, {'physician': {'$ne': None}}]
+}
+
+
+def run(scale):
+    message = make_message(0, 1)
+    simple = {'source': {'$exists': True}, 'type': 'urn:type:bench:0'}
+    compiled = compile_query(simple)
+    yield measure('query.match', {'query': 'simple', 'compiled': False},
+                  lambda: match(message, simple), NUMBER)
+    yield measure('query.match', {'query': 'simple', 'compiled': True},
+                  lambda: match(message, compiled), NUMBER)
+    visit = {'rooms': [{'floor': 1}, {'floor': 3}], 'ward': {'floor': 2}}
+    nested = dict(message, visit=visit)
+    rich = compile_query(RICH_QUERY)
+    yield measure('query.match', {'query': 'rich', 'compiled': True},
+                  lambda: match(nested, rich), NUMBER)
+    yield measure('query.compile', {'query': 'rich'},
+                  lambda: compile_query(RICH_QUERY), NUMBER)
+    index = ('name', 'physician')
+    yield measure('index.extract', {'keys': 2},
+                  lambda: extract(message, index), NUMBER)
+    compiled = compile_index(index)
+    yield measure('index.extract', {'keys': 2, 'compiled': True},
+                  lambda: compiled(message), NUMBER)
+    deep = ('visit.ward.floor', 'name', 'physician', 'missing.key')
+    yield measure('index.extract', {'keys': 4, 'nested': True},
+                  lambda: extract(nested, deep), NUMBER)
+    compiled = compile_index(deep)
+    yield measure('index.extract',
+                  {'keys': 4, 'nested': True, 'compiled': True},
+                  lambda: compiled(nested), NUMBER)
+    array = compile_index(('visit.rooms.floor',))
+    rooms = dict(message, visit={'rooms': [{'floor': 1}, {'bed': 2}]})
+    yield measure('index.extract',
+                  {'keys': 1, 'array': True, 'compiled': True},
+                  lambda: array(rooms), NUMBER)
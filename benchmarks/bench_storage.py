@@ -0,0 +1,170 @@
+"""
+Context creation, loading, lookup and save for in-memory and on-disk
+stores.
+"""
+
+import os
+import json
+import random
+import time
+import tempfile
+from itertools import cycle, product
+from unittest.mock import patch
+from imi.context import ContextAgent
+from imi.loader import read_text
+from imi.storage import (Database, FileStore, ctx_db_path, get_fname,
+                         init_contexts)
+from imi.journal import JournalStore
+from imi.compact import CompactStore
+from imi.checkpoint import checkpoint_path
+from imi.writer import WriteBehindStore, DURABILITY
+from imi.layout import migrate
+from .common import (measure, timed, datadir, MemoryStore, make_rule_docs,
+                     make_rules, make_context_docs)
+
+NUMBER = 20000
+DISK_NUMBER = 500
+CREATE_NUMBER = 5000
+LOAD_NUMBER = 5000
+# Seconds added to every file read to model network-attached storage
+LOAD_LATENCY = 0.0002
+
+
+def new_context(agent, num):
+    rule = agent.rules[num % len(agent.rules)]
+    index = frozenset({('name', 'new-{}'.format(num)), ('physician', 'p')})
+    return agent.init_context(rule, index)
+
+
+def make_rule_docs_10():
+    return make_rule_docs(10)
+
+
+def slow_read(latency):
+    def read(path):
+        if latency:
+            time.sleep(latency)
+        return read_text(path)
+    return read
+
+
+def run(scale):
+    for nodes in (2, 10):
+        agent = ContextAgent(make_rules(1, nodes=nodes), None)
+        rule = agent.rules[0]
+        index = frozenset({('name', 'n'), ('physician', 'p')})
+        yield measure('agent.init_context', {'nodes': nodes},
+                      lambda: agent.init_context(rule, index), CREATE_NUMBER)
+    rule_docs = make_rule_docs(100)
+    for count in scale['contexts']:
+        docs = make_context_docs(rule_docs, count)
+        params = {'contexts': count}
+        with timed('database.load', params, count) as result:
+            db = Database(MemoryStore(docs))
+        yield result[0]
+        rand = random.Random(0)
+        keys = [(doc['rule_name'], frozenset(doc['index'].items()))
+                for doc in rand.sample(docs, min(count, 1000))]
+        keys = cycle(keys)
+        yield measure('database.find_by_idx', dict(params, found=True),
+                      lambda: db.find_by_idx(*next(keys)), NUMBER)
+        missing = frozenset({('name', 'missing'), ('physician', 'p')})
+        yield measure('database.find_by_idx', dict(params, found=False),
+                      lambda: db.find_by_idx('rule-0', missing), NUMBER)
+        ctx = db.find_by_idx(*next(keys))
+        yield measure('database.save', dict(params, store='memory'),
+                      lambda: db.save(ctx), NUMBER)
+        del db, docs
+    agent = ContextAgent(make_rules(10), None)
+    stores = [('files', ''), ('compact', ''), ('journal', '')]
+    stores += [('files', durability) for durability in DURABILITY]
+    for name, durability in stores:
+        with tempfile.TemporaryDirectory() as tmp, \
+                patch('imi.compact.load_rule_docs', make_rule_docs_10):
+            with datadir(tmp):
+                if name == 'files':
+                    store = FileStore()
+                elif name == 'compact':
+                    store = CompactStore()
+                    store.load()
+                else:
+                    store = JournalStore(sync_every=0)
+                if durability:
+                    store = WriteBehindStore(store, durability)
+                params = {'store': name}
+                if durability:
+                    params['write_behind'] = durability
+                db = Database(store)
+                ctxs = iter([new_context(agent, num)
+                             for num in range(DISK_NUMBER)])
+                with timed('database.save', dict(params, new=True),
+                           DISK_NUMBER) as result:
+                    saved = [db.save(next(ctxs)) for _ in range(DISK_NUMBER)]
+                    db.flush()
+                yield result[0]
+                # Three saves of a context, as by the steps of a message
+                with timed('database.save', dict(params, new=False),
+                           DISK_NUMBER * 3) as result:
+                    for ctx in saved:
+                        for _ in range(3):
+                            db.save(ctx)
+                    db.flush()
+                yield result[0]
+                db.close()
+    docs = make_context_docs(rule_docs, LOAD_NUMBER)
+    with tempfile.TemporaryDirectory() as tmp:
+        with datadir(tmp):
+            store = FileStore()
+            path = ctx_db_path()
+            for ctx, doc in zip(init_contexts(docs), docs):
+                with path.joinpath(get_fname(ctx)).open('w') as stream:
+                    json.dump(doc, stream, indent='  ')
+            for latency, workers in product((0, LOAD_LATENCY), (1, 8)):
+                params = {'store': 'files', 'workers': workers,
+                          'latency': latency}
+                read = slow_read(latency)
+                with patch('imi.config.LOAD_WORKERS', workers), \
+                        patch('imi.loader.read_text', read):
+                    with timed('database.load', params,
+                               LOAD_NUMBER) as result:
+                        Database(store)
+                yield result[0]
+            # Files older than the checkpoint are not replayed
+            past = time.time() - 100
+            for file in path.glob('*.json'):
+                os.utime(str(file), (past, past))
+            checkpoint = checkpoint_path()
+            with patch('imi.checkpoint.load_rule_docs', lambda: rule_docs):
+                Database(store, checkpoint=checkpoint).write_checkpoint()
+            params = {'store': 'files', 'checkpoint': True}
+            with timed('database.load', params, LOAD_NUMBER) as result:
+                db = Database(store, checkpoint=checkpoint)
+            yield result[0]
+            keys = cycle(list(db.pending))
+            with timed('database.find_by_idx', dict(params, restore=True),
+                       LOAD_NUMBER) as result:
+                for _ in range(LOAD_NUMBER):
+                    db.find_by_idx(*next(keys))
+            yield result[0]
+            migrate('sharded', path)
+            for workers in (1, 8):
+                params = {'store': 'files', 'layout': 'sharded',
+                          'workers': workers}
+                with patch('imi.config.LOAD_WORKERS', workers), \
+                        patch('imi.config.CONTEXT_LAYOUT', 'sharded'):
+                    with timed('database.load', params,
+                               LOAD_NUMBER) as result:
+                        Database(FileStore())
+                yield result[0]
+    with tempfile.TemporaryDirectory() as tmp, \
+            patch('imi.compact.load_rule_docs', lambda: rule_docs):
+        with datadir(tmp):
+            store = CompactStore()
+            store.refresh_rules()
+            for ctx in init_contexts(docs):
+                store.update(ctx)
+            params = {'store': 'compact', 'workers': 1, 'latency': 0}
+            with patch('imi.config.LOAD_WORKERS', 1):
+                with timed('database.load', params, LOAD_NUMBER) as result:
+                    Database(CompactStore())
+            yield result[0]
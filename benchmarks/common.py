@@ -0,0 +1,163 @@
+"""Timing helpers and synthetic rules, messages and contexts."""
+
+import time
+import random
+from collections import namedtuple
+from contextlib import contextmanager
+from imi import config
+from imi.storage import init_rules, random_id
+
+__all__ = ['Result', 'measure', 'timed', 'datadir', 'MemoryStore', 'SCALES',
+           'make_rule_docs', 'make_rules', 'make_message',
+           'make_context_docs']
+
+Result = namedtuple('Result', ('name', 'params', 'ops', 'seconds'))
+
+# Sizes of rule sets and context populations per scale
+SCALES = {
+    'quick': {'rules': [10, 100], 'contexts': [1000], 'requests': 200},
+    'default': {'rules': [10, 100, 1000, 10000],
+                'contexts': [1000, 100000], 'requests': 2000},
+    'full': {'rules': [10, 100, 1000, 10000],
+             'contexts': [1000, 100000, 1000000], 'requests': 10000},
+}
+
+
+def measure(name, params, func, number, repeat=3):
+    """Best time of `repeat` runs of `number` calls of func."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return Result(name, params, number, best)
+
+
+@contextmanager
+def timed(name, params, ops):
+    """Time a block doing `ops` operations, the result is in the list."""
+    result = []
+    start = time.perf_counter()
+    yield result
+    elapsed = time.perf_counter() - start
+    result.append(Result(name, params, ops, elapsed))
+
+
+@contextmanager
+def datadir(path):
+    saved = config.DATADIR
+    config.DATADIR = path
+    try:
+        yield
+    finally:
+        config.DATADIR = saved
+
+
+def result_doc(result):
+    doc = result._asdict()
+    seconds = result.seconds
+    doc['ops_per_sec'] = result.ops / seconds if seconds else None
+    doc['us_per_op'] = result.seconds / result.ops * 1e6
+    return doc
+
+
+class MemoryStore:
+    """Store keeping nothing, to measure Database itself."""
+
+    def __init__(self, docs=()):
+        self.docs = list(docs)
+
+    def load(self):
+        return self.docs
+
+    def iter_complete(self):
+        return iter(())
+
+    def read_complete(self, rule_name, ctx_id):
+        return None
+
+    def create(self, ctx):
+        return ctx._replace(id=random_id())
+
+    def update(self, ctx):
+        pass
+
+    @contextmanager
+    def batch(self):
+        yield
+
+    def wait(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def make_node_docs(url, count):
+    nodes = [{'url': url + '?scheduled_at=tuesday',
+              'exit': {'scheduled_at': {'$exists': True}}},
+             {'url': url + '?notified_at=now',
+              'exit': {'notified_at': {'$exists': True}}}]
+    for num in range(2, count):
+        nodes.append({'url': url + '?step{}=done'.format(num),
+                      'exit': {'step{}'.format(num): 'done',
+                               'source': {'$in': ['bench', 'test']}}})
+    return nodes[:count]
+
+
+def make_rule_docs(count, url='noop://step', nodes=2):
+    """Rules shaped like examples/rules, told apart by the type field."""
+    docs = []
+    for num in range(count):
+        docs.append({
+            'name': 'rule-{}'.format(num),
+            'criteria': {
+                'source': {'$exists': True},
+                'type': 'urn:type:bench:{}'.format(num)
+            },
+            'index': ['name', 'physician'],
+            'nodes': make_node_docs(url, nodes)
+        })
+    return docs
+
+
+def make_rules(count, url='noop://step', nodes=2):
+    return init_rules(make_rule_docs(count, url, nodes))
+
+
+def make_message(rule_num, num):
+    """A message shaped like examples/messages/survey.json."""
+    return {
+        'source': 'bench',
+        'type': 'urn:type:bench:{}'.format(rule_num),
+        'name': 'name-{}'.format(num),
+        'physician': 'phys-{}'.format(num % 100)
+    }
+
+
+def make_context_docs(rule_docs, count):
+    """Documents of active contexts spread over the rules."""
+    rand = random.Random(count)
+    docs = []
+    for num in range(count):
+        rule = rule_docs[rand.randrange(len(rule_docs))]
+        message = make_message(0, num)
+        nodes = []
+        for node_num, node in enumerate(rule['nodes']):
+            state = 'current' if node_num == 0 else 'initial'
+            nodes.append({'url': node['url'], 'state': state,
+                          'calls_count': 0,
+                          'result': {'criteria': node['exit']}})
+        docs.append({
+            'id': random_id(),
+            'rule_name': rule['name'],
+            'index': dict((key, message[key]) for key in rule['index']),
+            'nodes': nodes
+        })
+    return docs
@@ -0,0 +1,296 @@
+"""
+Asyncio variant of the context agent.
+
+HTTP node services are called on the event loop with asyncio streams,
+reusing the keep-alive connections of an AsyncPoolManager, so a single
+process can keep any number of messages waiting on slow services. The
+other schemes (noop://, command://) go through the opener installed by
+handlers.register() in a pool of threads. Database calls run in one
+dedicated thread, which keeps them serialized, and messages for the same
+context are processed one after another.
+"""
+
+import io
+import ssl
+import json
+import asyncio
+import logging
+import contextlib
+import http.client
+from collections import deque
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import URLError, HTTPError
+from urllib.parse import urlsplit
+from . import config, metrics
+from .context import (ContextAgent, invoke_service, enter_current,
+                      leave_current)
+from .pool import RETRY_ERRORS
+
+__all__ = ['AsyncContextAgent', 'AsyncPoolManager', 'invoke_service_async']
+
+log = logging.getLogger(__name__)
+
+HTTP_SCHEMES = ('http', 'https')
+
+# Errors of a request, reported as URLError like urlopen() does
+REQUEST_ERRORS = (OSError, EOFError, asyncio.TimeoutError,
+                  asyncio.LimitOverrunError, http.client.HTTPException)
+
+
+def parse_status(line):
+    parts = line.decode('latin-1').rstrip('\r\n').split(None, 2)
+    try:
+        version, status = parts[0], int(parts[1])
+    except (IndexError, ValueError):
+        raise http.client.BadStatusLine(line)
+    if not version.startswith('HTTP/'):
+        raise http.client.BadStatusLine(line)
+    return version, status, parts[2] if len(parts) > 2 else ''
+
+
+async def read_chunked(reader):
+    chunks = []
+    while True:
+        line = await reader.readline()
+        try:
+            size = int(line.split(b';', 1)[0], 16)
+        except ValueError:
+            raise http.client.IncompleteRead(b''.join(chunks))
+        if not size:
+            break
+        chunks.append(await reader.readexactly(size))
+        await reader.readexactly(2)
+    # Trailers up to the empty line
+    while (await reader.readline()).strip():
+        pass
+    return b''.join(chunks)
+
+
+async def read_response(reader):
+    """
+    Status, reason, headers and body of a response, and whether the
+    connection can take another request.
+    """
+    head = await reader.readuntil(b'\r\n\r\n')
+    line, _, rest = head.partition(b'\r\n')
+    version, status, reason = parse_status(line)
+    headers = http.client.parse_headers(io.BytesIO(rest))
+    connection = headers.get('Connection', '').lower()
+    if version == 'HTTP/1.1':
+        keep = 'close' not in connection
+    else:
+        keep = 'keep-alive' in connection
+    if status in (204, 304) or status < 200:
+        body = b''
+    elif 'chunked' in headers.get('Transfer-Encoding', '').lower():
+        body = await read_chunked(reader)
+    elif headers.get('Content-Length') is not None:
+        body = await reader.readexactly(int(headers['Content-Length']))
+    else:
+        body = await reader.read()
+        keep = False
+    return status, reason, headers, body, keep
+
+
+class AsyncConnectionPool:
+    """Idle keep-alive stream connections to a single host."""
+
+    def __init__(self, scheme, host, port, size,
+                 connect_timeout, read_timeout):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.size = size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.idle = deque()
+
+    async def request(self, data, retries):
+        for attempt in range(retries + 1):
+            conn = None
+            try:
+                conn = await self._get()
+                conn[1].write(data)
+                await conn[1].drain()
+            except RETRY_ERRORS as err:
+                if conn:
+                    conn[1].close()
+                if attempt == retries:
+                    raise
+                log.info('Retry {} request: {}'.format(self.host, err))
+                continue
+            except BaseException:
+                if conn:
+                    conn[1].close()
+                raise
+            try:
+                response = await asyncio.wait_for(read_response(conn[0]),
+                                                  self.read_timeout)
+            except BaseException:
+                conn[1].close()
+                raise
+            self._put(conn, response[-1])
+            return response[:-1]
+
+    def close(self):
+        while self.idle:
+            self.idle.pop()[1].close()
+
+    async def _get(self):
+        while self.idle:
+            reader, writer = conn = self.idle.pop()
+            # Closed by the other side while idle
+            if not reader.at_eof() and not writer.is_closing():
+                return conn
+            writer.close()
+        return await self._connect()
+
+    def _put(self, conn, keep):
+        if keep and len(self.idle) < self.size:
+            self.idle.append(conn)
+        else:
+            conn[1].close()
+
+    async def _connect(self):
+        context = None
+        if self.scheme == 'https':
+            context = ssl.create_default_context()
+        connect = asyncio.open_connection(self.host, self.port, ssl=context)
+        return await asyncio.wait_for(connect, self.connect_timeout)
+
+
+class AsyncPoolManager:
+    """
+    Connection pools keyed by scheme, host and port. The connections
+    belong to the event loop they were opened in.
+    """
+
+    def __init__(self, size=None, connect_timeout=None,
+                 read_timeout=None, retries=None):
+        self.size = size or config.HTTP_POOL_SIZE
+        self.connect_timeout = connect_timeout or config.HTTP_CONNECT_TIMEOUT
+        self.read_timeout = read_timeout or config.HTTP_READ_TIMEOUT
+        if retries is None:
+            retries = config.HTTP_RETRIES
+        self.retries = retries
+        self.pools = {}
+
+    def get_pool(self, scheme, host, port):
+        key = scheme, host, port
+        pool = self.pools.get(key)
+        if pool is None:
+            pool = self.pools[key] = AsyncConnectionPool(
+                scheme, host, port, self.size,
+                self.connect_timeout, self.read_timeout)
+        return pool
+
+    async def post(self, url, data):
+        """Body of the response to a JSON POST, HTTPError unless 2xx."""
+        parts = urlsplit(url)
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        selector = parts.path or '/'
+        if parts.query:
+            selector += '?' + parts.query
+        head = ('POST {} HTTP/1.1\r\n'
+                'Host: {}\r\n'
+                'Content-Type: application/json\r\n'
+                'Content-Length: {}\r\n'
+                'Connection: keep-alive\r\n\r\n')
+        head = head.format(selector, parts.netloc, len(data))
+        pool = self.get_pool(parts.scheme, parts.hostname, port)
+        try:
+            status, reason, headers, body = await pool.request(
+                head.encode('latin-1') + data, self.retries)
+        except REQUEST_ERRORS as err:
+            raise URLError(err)
+        if not 200 <= status < 300:
+            raise HTTPError(url, status, reason, headers, io.BytesIO(body))
+        return body
+
+    def close(self):
+        for pool in self.pools.values():
+            pool.close()
+        self.pools.clear()
+
+
+async def invoke_service_async(url, payload, executor=None, pools=None):
+    """
+    Call the node. HTTP goes through the pools, a new AsyncPoolManager
+    for this call only when None. Other schemes run invoke_service() in
+    a thread of the executor.
+    """
+    if urlsplit(url).scheme not in HTTP_SCHEMES:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, invoke_service,
+                                          url, payload)
+    data = json.dumps(payload).encode('utf-8')
+    if pools is not None:
+        body = await pools.post(url, data)
+    else:
+        pools = AsyncPoolManager()
+        try:
+            body = await pools.post(url, data)
+        finally:
+            pools.close()
+    return json.loads(body.decode('utf-8'))
+
+
+async def call_node_async(rule_name, url, message, executor=None,
+                          pools=None):
+    seconds, errors = metrics.node_metrics(rule_name, url)
+    start = perf_counter()
+    try:
+        return await invoke_service_async(url, message, executor, pools)
+    except Exception:
+        errors.inc()
+        raise
+    finally:
+        seconds.observe(perf_counter() - start)
+
+
+class AsyncContextAgent(ContextAgent):
+
+    def __init__(self, rules, database):
+        super().__init__(rules, database)
+        self.storage = ThreadPoolExecutor(1)
+        self.nodes = ThreadPoolExecutor(config.ASYNC_NODE_THREADS)
+        self.http = AsyncPoolManager()
+
+    async def apply_message(self, message):
+        go_next = True
+        while go_next:
+            rule, idx = self.find_metadata(message)
+            async with self.context_lock(rule.name, idx):
+                ctx = await self.run_storage(
+                    self.get_context, message, rule, idx)
+                current, chain = enter_current(ctx)
+                response = await call_node_async(
+                    rule.name, current.url, message, self.nodes, self.http)
+                go_next, message = leave_current(response, current, chain)
+                await self.run_storage(self.save_context, ctx)
+        return message
+
+    async def run_storage(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.storage, func, *args)
+
+    @contextlib.asynccontextmanager
+    async def context_lock(self, rule_name, idx):
+        key = rule_name, idx
+        entry = self.locks.get(key)
+        if entry is None:
+            entry = self.locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.locks[key]
+
+    def close(self):
+        self.storage.shutdown()
+        self.nodes.shutdown()
+        self.http.close()
@@ -0,0 +1,110 @@
+import json
+import logging
+from .storage import open_database
+from .context import ContextError
+from .aio import AsyncContextAgent
+from .web import ensuredatadir, close_app
+from .reload import RuleReloader
+from .checkpoint import Checkpointer
+from .config import RULES_RELOAD_INTERVAL, CHECKPOINT_INTERVAL
+from . import handlers, metrics
+
+__all__ = ['init_app']
+
+log = logging.getLogger(__name__)
+
+
+def init_app():
+    handlers.register()
+    return AsgiApp()
+
+
+async def read_body(receive):
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+    return body
+
+
+async def send_json(send, status, doc):
+    data = json.dumps(doc).encode('utf-8')
+    headers = [(b'content-type', b'application/json'),
+               (b'content-length', str(len(data)).encode('latin-1'))]
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': headers})
+    await send({'type': 'http.response.body', 'body': data})
+
+
+async def send_metrics(send):
+    data = metrics.render().encode('utf-8')
+    headers = [(b'content-type', b'text/plain; version=0.0.4'),
+               (b'content-length', str(len(data)).encode('latin-1'))]
+    await send({'type': 'http.response.start', 'status': 200,
+                'headers': headers})
+    await send({'type': 'http.response.body', 'body': data})
+
+
+async def lifespan(receive, send, close):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+class AsgiApp:
+
+    def __init__(self):
+        ensuredatadir()
+        self.db = open_database()
+        self.ctx = AsyncContextAgent(self.db.rules(), self.db)
+        metrics.CONTEXTS.set_function(self.db.stats)
+        self.threads = []
+        if RULES_RELOAD_INTERVAL:
+            self.threads.append(RuleReloader(self.ctx, RULES_RELOAD_INTERVAL))
+        if self.db.checkpoint:
+            self.threads.append(Checkpointer(self.db, CHECKPOINT_INTERVAL))
+        for thread in self.threads:
+            thread.start()
+
+    def close(self):
+        """
+        Wait for the calls of the agent in progress, stop the background
+        threads, write the saves still queued.
+        """
+        self.ctx.close()
+        close_app(self)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await lifespan(receive, send, self.close)
+        if scope['path'] == '/metrics' and scope['method'] == 'GET':
+            return await send_metrics(send)
+        if scope['path'] != '/invoke':
+            return await send_json(send, 404, {'error': 'Not found'})
+        if scope['method'] != 'POST':
+            return await send_json(send, 405, {'error': 'Method not allowed'})
+        await self.invoke(receive, send)
+
+    async def invoke(self, receive, send):
+        log.info('Received a message')
+        status = 200
+        timer = metrics.REQUEST_SECONDS.labels('/invoke').time()
+        with timer:
+            try:
+                body = await read_body(receive)
+                res = await self.ctx.apply_message(
+                    json.loads(body.decode('utf-8')))
+            except ContextError as err:
+                status, res = 400, {'error': str(err)}
+            except ValueError as err:
+                status, res = 400, {'error': str(err)}
+        if status != 200:
+            metrics.REQUEST_ERRORS.labels('/invoke').inc()
+        await send_json(send, status, res)
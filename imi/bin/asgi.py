@@ -0,0 +1,3 @@
+from ..asgi import init_app
+
+app = init_app()
@@ -1,4 +1,5 @@
 import sys
+import signal
 import argparse
 import logging
 import io
@@ -6,10 +7,12 @@ import yaml
 import json
 from urllib.request import Request, urlopen
 from urllib.error import HTTPError
-from bottle import run as run_bottle
+from bottle import run as run_bottle, WSGIRefServer
 from ..daemon import Daemon
-from ..web import init_app
-from ..config import WEB_HOST, WEB_PORT, PIDFILE, LOGFILE
+from ..web import init_app, ThreadingWSGIServer
+from ..storage import YamlLoader
+from ..config import (WEB_HOST, WEB_PORT, WEB_WORKERS, WEB_THREADED,
+                      PIDFILE, LOGFILE)
 
 __all__ = ['main']
 
@@ -17,13 +20,40 @@ log = logging.getLogger(__name__)
 
 
 class ServerDaemon(Daemon):
+    workers = WEB_WORKERS
+
     def run(self):
         log_config(True)
-        run_server()
+        run_server(self.workers)
+
+
+def run_server(workers=WEB_WORKERS):
+    if workers > 1:
+        from ..prefork import Master
+        Master(workers).run()
+        return
+    signal.signal(signal.SIGHUP, ignore_hup)
+    app = init_app()
+    options = {'server_class': ThreadingWSGIServer} if WEB_THREADED else {}
+    server = WSGIRefServer(host=WEB_HOST, port=WEB_PORT, **options)
+    try:
+        run_bottle(app, server=server)
+    finally:
+        srv = getattr(server, 'srv', None)
+        if srv is not None:
+            # Waits for the requests in progress
+            srv.server_close()
+        # Saves of the write-behind storage acknowledged and not written
+        app.close()
+
+
+def exit_on_term(signum, frame):
+    sys.exit(0)
 
 
-def run_server():
-    run_bottle(init_app(), host=WEB_HOST, port=WEB_PORT)
+def ignore_hup(signum, frame):
+    log.warning('SIGHUP ignored, only a server started with --workers'
+                ' replaces its workers')
 
 
 class LogWritter(io.TextIOBase):
@@ -60,17 +90,25 @@ class ServerCli:
     def __init__(self):
         self.daemon = ServerDaemon(PIDFILE)
 
-    def start(self, detach):
+    def start(self, detach, workers=WEB_WORKERS):
         if detach:
+            self.daemon.workers = workers
             self.daemon.start()
         else:
-            run_server()
+            # The daemon handles SIGTERM on its own
+            signal.signal(signal.SIGTERM, exit_on_term)
+            run_server(workers)
 
     def stop(self):
         self.daemon.stop()
 
-    def restart(self):
-        self.daemon.restart()
+    def restart(self, workers=WEB_WORKERS):
+        self.daemon.workers = workers
+        if workers > 1:
+            # The master replaces its workers, the sockets stay bound
+            self.daemon.reload()
+        else:
+            self.daemon.restart()
 
 
 def invoke(msg):
@@ -88,7 +126,7 @@ class MessageCli:
 
     def send(self, stream):
         try:
-            msg = yaml.load(stream)
+            msg = yaml.load(stream, Loader=YamlLoader)
             stream.close()
             res = json.dumps(invoke(msg), indent='  ')
             print(res)
@@ -104,6 +142,51 @@ class MessageCli:
             print(json.dumps(res, indent='  '))
             sys.exit(1)
 
+    def ingest(self, stream, concurrency, batch_size):
+        from ..ingest import Ingest
+        stream = stream or sys.stdin
+        ingest = Ingest(concurrency, batch_size)
+        try:
+            res = ingest.run(stream)
+        except Exception as err:
+            res = {'error': str(err)}
+        print(json.dumps(res, indent='  '))
+        if 'error' in res or res['errors']:
+            sys.exit(1)
+
+
+class StorageCli:
+
+    def compact(self):
+        from ..journal import compact
+        count = compact()
+        log.info('Compacted {} journal segments'.format(count))
+
+    def import_files(self):
+        from ..sqlite import SqliteDatabase, import_context_files
+        db = SqliteDatabase()
+        count = import_context_files(db)
+        db.close()
+        log.info('Imported {} contexts'.format(count))
+
+    def convert(self, to):
+        from ..compact import convert
+        count = convert(to)
+        log.info('Converted {} contexts to {}'.format(count, to))
+
+    def migrate(self, layout):
+        from ..layout import migrate
+        count = migrate(layout)
+        log.info('Moved {} context files to the {} layout'.format(
+            count, layout))
+
+
+def positive_int(value):
+    num = int(value)
+    if num < 1:
+        raise argparse.ArgumentTypeError('{} is not positive'.format(value))
+    return num
+
 
 def handle_exception(type, value, traceback):
     log.error('Unhandled error occurred', exc_info=(type, value, traceback))
@@ -112,22 +195,42 @@ def handle_exception(type, value, traceback):
 def main():
     log_config()
     server_cmd = ['start', 'stop', 'restart']
-    message_cmd = ['send']
-    commands = server_cmd + message_cmd
+    message_cmd = ['send', 'ingest']
+    storage_cmd = ['compact', 'import', 'convert', 'migrate']
+    commands = server_cmd + message_cmd + storage_cmd
     parser = argparse.ArgumentParser()
     parser.add_argument('command', choices=commands)
     parser.add_argument('--detach', action='store_true')
+    parser.add_argument('--workers', type=int, default=WEB_WORKERS)
     parser.add_argument('-m', '--message', type=argparse.FileType('r'))
+    parser.add_argument('--concurrency', type=positive_int, default=4)
+    parser.add_argument('--batch-size', type=positive_int, default=1)
+    parser.add_argument('--to', choices=['compact', 'json'],
+                        default='compact')
+    parser.add_argument('--layout', choices=['flat', 'sharded'],
+                        default='sharded')
     ns = parser.parse_args()
     if ns.command in server_cmd:
         server = ServerCli()
         if ns.command == 'start':
-            server.start(ns.detach)
+            server.start(ns.detach, ns.workers)
         elif ns.command == 'stop':
             server.stop()
         elif ns.command == 'restart':
-            server.restart()
+            server.restart(ns.workers)
     elif ns.command in message_cmd:
         msgcli = MessageCli()
         if ns.command == 'send':
             msgcli.send(ns.message)
+        elif ns.command == 'ingest':
+            msgcli.ingest(ns.message, ns.concurrency, ns.batch_size)
+    elif ns.command in storage_cmd:
+        storagecli = StorageCli()
+        if ns.command == 'compact':
+            storagecli.compact()
+        elif ns.command == 'import':
+            storagecli.import_files()
+        elif ns.command == 'convert':
+            storagecli.convert(ns.to)
+        elif ns.command == 'migrate':
+            storagecli.migrate(ns.layout)
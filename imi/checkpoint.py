@@ -0,0 +1,164 @@
+"""
+Checkpoints of the active contexts for a fast start of the server.
+
+A checkpoint is a single file, datadir/checkpoint.bin. The header holds
+the time the checkpoint was taken and the place of the index at the end
+of the file. Every context is a compact encoded blob (see imi.compact),
+the index maps (rule_name, index) to the id, offset and length of the
+blob and holds the rule tables the blobs refer to.
+
+On start the file is memory mapped and only the index is decoded.
+A context is decoded when it is first looked up. Only the directory of
+active context files is listed: files changed since the checkpoint are
+read and replace their contexts, contexts without a file any more have
+completed. A Checkpointer thread writes a new checkpoint every
+config.CHECKPOINT_INTERVAL seconds when contexts changed.
+"""
+
+import os
+import mmap
+import time
+import struct
+import marshal
+import logging
+import threading
+from pathlib import Path
+from . import config
+from .compact import (encode, decode, rule_table, plain_tables,
+                      MARSHAL_VERSION)
+from .storage import load_rule_docs
+
+__all__ = ['Checkpointer', 'read_checkpoint', 'write_checkpoint']
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'IMIK'
+VERSION = 1
+# Magic, version, checkpoint time, offset and length of the index
+HEADER = struct.Struct('>4sBdQQ')
+# Files changed this long before a checkpoint are replayed as well,
+# mtime granularity and clock steps must not hide a save
+MARGIN = 2
+
+
+def checkpoint_path(tag=None):
+    name = 'checkpoint-{}.bin'.format(tag) if tag else 'checkpoint.bin'
+    return Path(config.DATADIR).joinpath(name)
+
+
+class Snapshot:
+    """Contexts of a memory mapped checkpoint, decoded on demand."""
+
+    def __init__(self, stamp, tables, contexts, data):
+        self.stamp = stamp
+        self.tables = tables
+        # Key to the id, offset and length of the blob
+        self.contexts = contexts
+        self.data = data
+
+    def blob(self, entry):
+        _, offset, length = entry
+        return self.data[offset:offset + length]
+
+    def read(self, entry):
+        return decode(self.blob(entry), self.tables)
+
+
+def read_checkpoint(path):
+    """The Snapshot of the checkpoint file, None if there is none."""
+    try:
+        with open(str(path), 'rb') as stream:
+            data = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError):
+        return None  # no checkpoint yet or an empty file
+    if len(data) < HEADER.size:
+        log.warning('Ignore truncated checkpoint {}'.format(path))
+        return None
+    magic, version, stamp, offset, length = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        log.warning('Ignore checkpoint {} of unknown format'.format(path))
+        return None
+    tables, contexts = marshal.loads(data[offset:offset + length])
+    return Snapshot(stamp, tables, contexts, data)
+
+
+def write_checkpoint(path, db):
+    """
+    Write the active contexts of the database to the checkpoint file,
+    return the count of contexts. Contexts not decoded since the last
+    checkpoint are copied as they are.
+    """
+    stamp = time.time() - MARGIN
+    with db.lock:
+        active = list(db.active.values())
+        pending = list(db.pending.items())
+    # Completed contexts left out must be gone from the disk as well
+    db.flush()
+    snapshot = db.snapshot
+    rules = dict((doc['name'], rule_table(doc)) for doc in load_rule_docs())
+    tables = dict(snapshot.tables) if snapshot else {}
+    tables.update(rules.values())
+    contexts = {}
+    tmp = Path(str(path) + '.tmp')
+    with tmp.open('wb') as stream:
+        stream.write(HEADER.pack(MAGIC, VERSION, stamp, 0, 0))
+        for key, entry in pending:
+            offset = stream.tell()
+            stream.write(snapshot.blob(entry))
+            contexts[key] = entry[0], offset, stream.tell() - offset
+        for ctx in active:
+            offset = stream.tell()
+            stream.write(encode(ctx, rules.get(ctx.rule_name)))
+            key = ctx.rule_name, frozenset(ctx.index)
+            contexts[key] = ctx.id, offset, stream.tell() - offset
+        offset = stream.tell()
+        index = plain_tables(tables), contexts
+        stream.write(marshal.dumps(index, MARSHAL_VERSION))
+        length = stream.tell() - offset
+        stream.seek(0)
+        stream.write(HEADER.pack(MAGIC, VERSION, stamp, offset, length))
+        stream.flush()
+        os.fsync(stream.fileno())
+    os.replace(str(tmp), str(path))
+    return len(contexts)
+
+
+class Checkpointer:
+
+    def __init__(self, db, interval=None):
+        self.db = db
+        if interval is None:
+            interval = config.CHECKPOINT_INTERVAL
+        self.interval = interval
+        self.changes = db.changes
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.write()
+            except Exception:
+                log.exception('Failed to write a checkpoint')
+
+    def write(self):
+        """Write a checkpoint if contexts changed since the last one."""
+        changes = self.db.changes
+        if changes == self.changes:
+            return False
+        start = time.monotonic()
+        count = self.db.write_checkpoint()
+        self.changes = changes
+        log.info('Checkpoint of {} contexts in {:.2f}s'.format(
+            count, time.monotonic() - start))
+        return True
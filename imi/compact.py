@@ -0,0 +1,308 @@
+"""
+Compact binary storage for contexts.
+
+Like the files storage it keeps every context in its own file,
+context/ctx-<rule>-<id>.ctx or in the shards of the layout (see
+imi.layout), and moves completed contexts to the context/complete
+directory. A file holds only what differs between
+contexts of a rule: the id, the rule name, the index and the state,
+calls count and result message of every node. Node urls and exit
+criteria equal to the ones of the rule node are left out and resolved
+on load from the rule table the context was written with. Rule tables
+are kept by fingerprint in context/rules.tables, so contexts stay
+readable after their rule is changed or removed.
+
+A file starts with the magic and the format version, the rest is
+marshal encoded. convert() turns the JSON files of the files storage
+into compact ones and back.
+"""
+
+import os
+import sys
+import json
+import struct
+import marshal
+import hashlib
+import threading
+import contextlib
+from pathlib import Path
+from .loader import load_documents
+from .storage import (load_rule_docs, load_context_doc, init_contexts,
+                      shared_criteria, is_complete_ctx, ctx_db_path,
+                      get_fname, scan_context_files, sync_contexts,
+                      random_id, rules_version, DatabaseError)
+from .layout import (ctx_parts, lookup_parts, ctx_file, open_ctx_file,
+                     remove_file, remove_active, has_flat_files,
+                     context_paths)
+
+__all__ = ['CompactStore', 'convert', 'encode', 'decode']
+
+MAGIC = b'IMIC'
+VERSION = 1
+HEADER = struct.Struct('>4sB')
+# Pinned, so files written by one Python version load on another
+MARSHAL_VERSION = 4
+EXT = '.ctx'
+TABLES = 'rules.tables'
+
+
+def compact_fname(rule_name, ctx_id):
+    return 'ctx-{}-{}{}'.format(rule_name, ctx_id, EXT)
+
+
+def ctx_fname(ctx):
+    return compact_fname(ctx.rule_name, ctx.id)
+
+
+def dumps(payload):
+    return HEADER.pack(MAGIC, VERSION) + marshal.dumps(payload,
+                                                       MARSHAL_VERSION)
+
+
+def loads(data):
+    if len(data) < HEADER.size or data[:len(MAGIC)] != MAGIC:
+        raise DatabaseError('Not a compact context file')
+    _, version = HEADER.unpack_from(data)
+    if version != VERSION:
+        raise DatabaseError(
+            'Unsupported compact format version {}'.format(version))
+    return marshal.loads(data[HEADER.size:])
+
+
+def rule_table(rule_doc):
+    """Fingerprint and the (url, exit criteria) pairs of the rule nodes."""
+    nodes = tuple((sys.intern(node['url']), shared_criteria(node['exit']))
+                  for node in rule_doc['nodes'])
+    plain = tuple((url, dict(criteria)) for url, criteria in nodes)
+    digest = hashlib.blake2b(marshal.dumps(plain, MARSHAL_VERSION),
+                             digest_size=8).digest()
+    return int.from_bytes(digest, 'big'), nodes
+
+
+def plain_tables(tables):
+    """Rule tables by fingerprint with criteria fit for marshal."""
+    return dict((fingerprint, tuple((url, dict(criteria))
+                                    for url, criteria in nodes))
+                for fingerprint, nodes in tables.items())
+
+
+def encode(ctx, table=None):
+    """
+    File content of the context. Nodes equal to the nodes of the rule
+    table keep only their state, the others keep their url and criteria.
+    """
+    fingerprint, rule_nodes = table or (0, ())
+    nodes = []
+    for num, node in enumerate(ctx.nodes):
+        url = node.url
+        criteria = node.result.criteria
+        if num < len(rule_nodes):
+            rule_url, rule_criteria = rule_nodes[num]
+            if url == rule_url:
+                url = None
+            if criteria is rule_criteria or criteria == rule_criteria:
+                criteria = None
+        if criteria is not None:
+            criteria = dict(criteria)  # a Matcher is not marshallable
+        nodes.append((node.state.name, node.calls_count,
+                      node.result.message, url, criteria))
+    return dumps((ctx.id, ctx.rule_name, dict(ctx.index), fingerprint,
+                  tuple(nodes)))
+
+
+def decode(data, tables):
+    """Context document of the file content, tables are by fingerprint."""
+    ctxid, rule_name, index, fingerprint, nodes = loads(data)
+    rule_nodes = tables.get(fingerprint, ()) if fingerprint else ()
+    node_docs = []
+    for num, (state, calls_count, message, url, criteria) in \
+            enumerate(nodes):
+        if url is None or criteria is None:
+            if num >= len(rule_nodes):
+                raise DatabaseError(
+                    'Unknown rule table of context #{}'.format(ctxid))
+            rule_url, rule_criteria = rule_nodes[num]
+            url = rule_url if url is None else url
+            criteria = rule_criteria if criteria is None else criteria
+        result = {'criteria': criteria}
+        if message:
+            result['message'] = message
+        node_docs.append({'url': url, 'state': state,
+                          'calls_count': calls_count, 'result': result})
+    return {'id': ctxid, 'rule_name': rule_name, 'index': index,
+            'nodes': node_docs}
+
+
+def read_bytes(path):
+    with path.open('rb') as stream:
+        return stream.read()
+
+
+def write_bytes(path, data, mode='wb'):
+    with open_ctx_file(path, mode) as stream:
+        stream.write(data)
+
+
+class CompactStore:
+
+    def __init__(self, path=None):
+        self.path = Path(path or ctx_db_path())
+        self.complete = self.path.joinpath('complete')
+        for path in (self.path, self.complete):
+            try:
+                path.mkdir(parents=True)
+            except FileExistsError:
+                pass
+        # Rule tables by fingerprint and the current ones by rule name
+        self.tables = {}
+        self.rules = {}
+        # Rules without a table by name, with the rules version of the miss
+        self.missing = {}
+        self.lock = threading.Lock()
+        # Sharded layout with flat files left to migrate
+        self.mixed = False
+        try:
+            self.tables = dict(loads(read_bytes(self.tables_path())))
+        except FileNotFoundError:
+            pass
+
+    def tables_path(self):
+        return self.path.joinpath(TABLES)
+
+    def refresh_rules(self):
+        """Take the rule tables of the rule files, remember new ones."""
+        with self.lock:
+            rules = {}
+            added = False
+            for doc in load_rule_docs():
+                fingerprint, nodes = rule_table(doc)
+                rules[doc['name']] = fingerprint, nodes
+                if fingerprint not in self.tables:
+                    self.tables[fingerprint] = nodes
+                    added = True
+            if added:
+                self._write_tables()
+            self.rules = rules
+
+    def load(self):
+        self.refresh_rules()
+        self.mixed = has_flat_files(self.path, EXT)
+        paths = context_paths(self.path, EXT)
+        return load_documents(paths, what='contexts', load=self.read)
+
+    def read(self, path):
+        return decode(read_bytes(path), self.tables)
+
+    def changed_since(self, stamp):
+        self.refresh_rules()
+        self.mixed = has_flat_files(self.path, EXT)
+        ids, changed = scan_context_files(self.path, EXT, stamp)
+        return ids, load_documents(changed, what='contexts', load=self.read)
+
+    def iter_complete(self):
+        for path in context_paths(self.complete, EXT):
+            yield self.read(path)
+
+    def read_complete(self, rule_name, ctx_id):
+        fname = compact_fname(rule_name, ctx_id)
+        for parts in lookup_parts(rule_name, ctx_id, fname):
+            try:
+                return self.read(self.complete.joinpath(*parts))
+            except FileNotFoundError:
+                continue
+        return None
+
+    def create(self, ctx):
+        path = self.complete if is_complete_ctx(ctx) else self.path
+        table = self.table_of(ctx.rule_name)
+        for _ in range(10):
+            ctx = ctx._replace(id=random_id())
+            fname = compact_fname(ctx.rule_name, ctx.id)
+            if self.mixed and path.joinpath(fname).exists():
+                continue  # taken by a flat file
+            parts = ctx_parts(ctx.rule_name, ctx.id, fname)
+            try:
+                write_bytes(path.joinpath(*parts), encode(ctx, table), 'xb')
+            except FileExistsError:
+                continue
+            return ctx
+        raise DatabaseError('Unable to save the context')
+
+    def update(self, ctx):
+        data = encode(ctx, self.table_of(ctx.rule_name))
+        if is_complete_ctx(ctx):
+            write_bytes(ctx_file(self.complete, ctx, ctx_fname), data)
+            remove_active(self.path, ctx, ctx_fname, self.mixed)
+        else:
+            write_bytes(ctx_file(self.path, ctx, ctx_fname), data)
+            if self.mixed:
+                remove_file(ctx_file(self.path, ctx, ctx_fname, 'flat'))
+
+    def sync(self, ctxs):
+        sync_contexts(self.path, ctxs, ctx_fname)
+
+    def table_of(self, rule_name):
+        table = self.rules.get(rule_name)
+        if table is None:
+            # A rule added after the start, contexts of rules changed
+            # since then keep their differing nodes in full. Rules are
+            # looked up again only once a rule file changed.
+            if self.missing.get(rule_name) == rules_version():
+                return None
+            self.refresh_rules()
+            table = self.rules.get(rule_name)
+            if table is None:
+                self.missing[rule_name] = rules_version()
+        return table
+
+    @contextlib.contextmanager
+    def batch(self):
+        yield
+
+    def wait(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def _write_tables(self):
+        tmp = self.path.joinpath(TABLES + '.tmp')
+        with tmp.open('wb') as stream:
+            stream.write(dumps(plain_tables(self.tables)))
+            stream.flush()
+            os.fsync(stream.fileno())
+        os.replace(str(tmp), str(self.tables_path()))
+
+
+def convert(to='compact', path=None):
+    """
+    Convert the context files of the files storage to the compact format
+    or back to JSON, next to the source file. The source file is removed
+    once the converted one is written, so an interrupted run can be
+    started again.
+    """
+    store = CompactStore(path)
+    store.refresh_rules()
+    count = 0
+    for directory in (store.path, store.complete):
+        if to == 'compact':
+            for path in context_paths(directory, '.json'):
+                ctx = init_contexts([load_context_doc(path)])[0]
+                data = encode(ctx, store.rules.get(ctx.rule_name))
+                write_bytes(path.with_name(ctx_fname(ctx)), data)
+                path.unlink()
+                count += 1
+        elif to == 'json':
+            for path in context_paths(directory, EXT):
+                doc = store.read(path)
+                ctx = init_contexts([doc])[0]
+                with path.with_name(get_fname(ctx)).open('w') as stream:
+                    json.dump(doc, stream, indent='  ')
+                path.unlink()
+                count += 1
+        else:
+            raise DatabaseError('Unknown context format {}'.format(to))
+    return count
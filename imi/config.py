@@ -3,3 +3,47 @@ WEB_HOST = '::'
 DATADIR = ''
 PIDFILE = 'imi.pid'
 LOGFILE = 'imi.log'
+# Context storage: 'files', 'compact', 'journal' or 'sqlite'
+STORAGE = 'files'
+# Context files of the files and compact storage: 'flat' in a single
+# directory or 'sharded' in directories by rule and id, see imi.layout
+CONTEXT_LAYOUT = 'flat'
+JOURNAL_SEGMENT_SIZE = 64 * 1024 * 1024
+# Journal records written between fsync calls, 0 to sync on flush only
+JOURNAL_SYNC_EVERY = 1
+# Keep-alive connections to node services
+HTTP_POOL_SIZE = 10
+HTTP_CONNECT_TIMEOUT = 5
+HTTP_READ_TIMEOUT = 60
+HTTP_RETRIES = 2
+# Threads of the asyncio agent calling noop:// and command:// node
+# services, HTTP services are called on the event loop
+ASYNC_NODE_THREADS = 64
+# Persistent command:// workers, command name to pool size
+COMMAND_WORKERS = {}
+COMMAND_TIMEOUT = 30
+COMMAND_START_TIMEOUT = 5
+# Server worker processes, contexts are partitioned between them
+WEB_WORKERS = 1
+# Handle requests of a worker in parallel threads
+WEB_THREADED = True
+WEB_RESPAWN_DELAY = 1
+# Seconds between checks of the rule files for changes, 0 to disable
+RULES_RELOAD_INTERVAL = 2
+# Threads reading context files on startup, 1 to read them one by one
+LOAD_WORKERS = 8
+# Processes decoding context files of LOAD_PROCESS_SIZE characters
+# and more, 0 to decode every file in the reading thread
+LOAD_PROCESSES = 0
+LOAD_PROCESS_SIZE = 1024 * 1024
+# Seconds between startup progress messages
+LOAD_PROGRESS_INTERVAL = 5
+# Seconds between checkpoints of the active contexts of the files and
+# compact storage, 0 to disable
+CHECKPOINT_INTERVAL = 60
+# Write-behind of the files and compact storage: '' to write contexts
+# while handling the message, 'none' to write them in a writer thread,
+# 'batched' to also sync them to disk every WRITE_BEHIND_INTERVAL
+# seconds, 'strict' to sync them before the save returns
+WRITE_BEHIND = ''
+WRITE_BEHIND_INTERVAL = 0.01
@@ -1,10 +1,14 @@
 import json
+import threading
+import contextlib
+from time import perf_counter
 from collections import namedtuple
-from copy import deepcopy
 from enum import Enum
 from urllib.request import Request, urlopen
 from .query import match
 from .index import extract as extract_index
+from .dispatch import RuleDispatcher
+from . import metrics
 
 __all__ = ['Context', 'Rule', 'Node', 'ContextError',
            'NodeResult', 'NodeState', 'ContextAgent']
@@ -18,6 +22,10 @@ Context = namedtuple('Context', ('id', 'rule_name', 'index', 'nodes'))
 
 
 class Node:
+    # Contexts hold many nodes, url and result criteria are shared
+    # with the rule node and other contexts
+    __slots__ = ('_url', 'state', 'calls_count', '_result')
+
     def __init__(self, url, state, calls_count, result):
         self._url = url
         self.state = state
@@ -34,6 +42,8 @@ class Node:
 
 
 class NodeResult:
+    __slots__ = ('_criteria', 'message')
+
     def __init__(self, criteria, message):
         self._criteria = criteria
         self.message = message
@@ -51,6 +61,16 @@ class ContextError(Exception):
         return self.msg
 
 
+def clone_nodes(nodes):
+    """
+    Copy the mutable per-context state of nodes,
+    url and result criteria never change and are shared.
+    """
+    return [Node(node.url, node.state, node.calls_count,
+                 NodeResult(node.result.criteria, node.result.message))
+            for node in nodes]
+
+
 def skip_to_current(nodes):
     # Node with state NodeState.current must be present,
     # that is context should be in active state
@@ -64,9 +84,30 @@ def skip_to_current(nodes):
 
 
 def invoke_context(message, ctx):
+    current, chain = enter_current(ctx)
+    response = call_node(ctx.rule_name, current.url, message)
+    return leave_current(response, current, chain)
+
+
+def call_node(rule_name, url, message):
+    seconds, errors = metrics.node_metrics(rule_name, url)
+    start = perf_counter()
+    try:
+        return invoke_service(url, message)
+    except Exception:
+        errors.inc()
+        raise
+    finally:
+        seconds.observe(perf_counter() - start)
+
+
+def enter_current(ctx):
     current, chain = skip_to_current(ctx.nodes)
     current.calls_count += 1
-    response = invoke_service(current.url, message)
+    return current, chain
+
+
+def leave_current(response, current, chain):
     current.result.message = response
     return next_step(response, current, chain)
 
@@ -95,17 +136,60 @@ def next_step(response, current, chain):
 class ContextAgent:
 
     def __init__(self, rules, database):
-        self.rules = rules
+        self.dispatcher = RuleDispatcher(rules)
         self.database = database
+        # Per (rule_name, index) locks with the count of their users
+        self.locks = {}
+        self.locks_guard = threading.Lock()
+
+    @property
+    def rules(self):
+        return self.dispatcher.rules
+
+    def set_rules(self, rules):
+        """
+        Swap the rule table at once. Contexts keep their own nodes
+        and only refer to rules by name, so they are not affected.
+        """
+        self.dispatcher = RuleDispatcher(rules)
 
     def apply_message(self, message):
         go_next = True
         while go_next:
             rule, idx = self.find_metadata(message)
+            go_next, message = self.apply_step(message, rule, idx)
+        return message
+
+    def apply_step(self, message, rule, idx):
+        with self.context_lock(rule.name, idx):
             ctx = self.get_context(message, rule, idx)
             go_next, message = invoke_context(message, ctx)
-            self.database.save(ctx)
-        return message
+            self.save_context(ctx)
+        return go_next, message
+
+    def save_context(self, ctx):
+        start = perf_counter()
+        ctx = self.database.save(ctx)
+        metrics.SAVE_SECONDS.observe(perf_counter() - start)
+        return ctx
+
+    @contextlib.contextmanager
+    def context_lock(self, rule_name, idx):
+        """Serialize messages of one context, others run in parallel."""
+        key = rule_name, idx
+        with self.locks_guard:
+            entry = self.locks.get(key)
+            if entry is None:
+                entry = self.locks[key] = [threading.Lock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.locks_guard:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.locks[key]
 
     def find_metadata(self, message):
         rule = self.find_rule(message)
@@ -113,19 +197,22 @@ class ContextAgent:
         return rule, idx
 
     def find_rule(self, message):
-        for rule in self.rules:
-            if match(message, rule.criteria):
-                return rule
-        else:
+        start = perf_counter()
+        rule = self.dispatcher.find(message)
+        metrics.DISPATCH_SECONDS.observe(perf_counter() - start)
+        if rule is None:
             raise ContextError('Cannot find a rule for the message')
+        return rule
 
     def get_context(self, message, rule, idx):
+        start = perf_counter()
         ctx = self.database.find_by_idx(rule.name, idx)
+        metrics.LOOKUP_SECONDS.observe(perf_counter() - start)
         if not ctx:
             ctx = self.init_context(rule, idx)
         return ctx
 
     def init_context(self, rule, idx):
-        nodes = deepcopy(rule.nodes)
+        nodes = clone_nodes(rule.nodes)
         nodes[0].state = NodeState.current
         return Context(None, rule.name, idx, nodes)
@@ -68,6 +68,24 @@ class Daemon(metaclass=abc.ABCMeta):
         self.stop()
         self.start()
 
+    def reload(self):
+        """Send SIGHUP to the daemon, start it if it does not run."""
+        try:
+            with self._pidfile.open('r') as stream:
+                pid = int(stream.read().strip())
+        except FileNotFoundError:
+            pid = None
+
+        if pid:
+            try:
+                os.kill(pid, signal.SIGHUP)
+                return
+            except ProcessLookupError:
+                message = 'PID file {} is stale, starting the daemon'
+                log.warning(message.format(self._pidfile))
+                self._finalize()
+        self.start()
+
     @abc.abstractmethod
     def run(self):
         """You should override this method when you subclass Daemon.
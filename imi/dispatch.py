@@ -0,0 +1,86 @@
+from collections import Counter, defaultdict
+from .query import (compile as compile_query, iter_path_candidates,
+                    split_key, RE_TYPE)
+
+__all__ = ['RuleDispatcher']
+
+
+class RuleDispatcher:
+    """
+    Finds the first rule (in rules order) whose criteria match a message.
+
+    Rules are hashed by the value they require for a discriminator field,
+    the field most of the criteria test with plain equality or $in.
+    Only rules from the bucket of the message value, plus the rules
+    which do not constrain that field, are checked with the full matcher.
+    """
+
+    def __init__(self, rules):
+        self.rules = tuple(rules)
+        self.matchers = tuple(compile_query(rule.criteria)
+                              for rule in self.rules)
+        discriminators = [discriminator_values(rule.criteria)
+                          for rule in self.rules]
+        self.key = choose_key(discriminators)
+        self.path = split_key(self.key)
+        self.buckets = defaultdict(list)
+        self.wildcard = []
+        for pos, values in enumerate(discriminators):
+            if self.key is None or self.key not in values:
+                self.wildcard.append(pos)
+                continue
+            for value in values[self.key]:
+                self.buckets[value].append(pos)
+
+    def find(self, message):
+        for pos in self.candidates(message):
+            if self.matchers[pos](message):
+                return self.rules[pos]
+        return None
+
+    def candidates(self, message):
+        if self.key is None:
+            return range(len(self.rules))
+        found = set(self.wildcard)
+        for value in iter_path_candidates(message, self.path):
+            items = value if isinstance(value, (list, tuple)) else (value,)
+            for item in items:
+                try:
+                    found.update(self.buckets.get(item, ()))
+                except TypeError:
+                    continue  # unhashable value cannot equal a bucket key
+        return sorted(found)
+
+
+def discriminator_values(criteria):
+    """
+    Map field names of the criteria to the set of values one of which
+    the field must hold for the criteria to match.
+    """
+    values = {}
+    for key, search in (criteria or {}).items():
+        if key.startswith('$'):
+            continue
+        if isinstance(search, dict):
+            ops = search.keys()
+            if '$in' not in ops or not all(op.startswith('$') for op in ops):
+                continue
+            candidates = search['$in']
+            if not isinstance(candidates, (list, tuple)):
+                continue
+        elif search is None or isinstance(search, (RE_TYPE, list, tuple)):
+            continue
+        else:
+            candidates = (search,)
+        try:
+            values[key] = frozenset(candidates)
+        except TypeError:
+            continue
+    return values
+
+
+def choose_key(discriminators):
+    counts = Counter(key for values in discriminators for key in values)
+    if not counts:
+        return None
+    return counts.most_common(1)[0][0]
@@ -6,12 +6,16 @@ from urllib.request import BaseHandler, build_opener, install_opener
 from urllib.response import addinfourl
 from urllib.parse import urlparse, parse_qs
 from .config import DATADIR
+from .pool import PoolManager, PooledHTTPHandler, PooledHTTPSHandler
+from .workers import WorkerManager
 
 __all__ = ['register']
 
 
 def register():
-    opener = build_opener(CustomHandler())
+    pools = PoolManager()
+    opener = build_opener(CustomHandler(), PooledHTTPHandler(pools),
+                          PooledHTTPSHandler(pools))
     install_opener(opener)
 
 
@@ -27,6 +31,9 @@ def modify_from_query(url, data):
 
 class CustomHandler(BaseHandler):
 
+    def __init__(self, workers=None):
+        self.workers = workers or WorkerManager()
+
     def noop_open(self, req):
         headers = {'Content-Encoding': 'application/json'}
         data = io.BytesIO(modify_from_query(req.full_url, req.data))
@@ -38,7 +45,9 @@ class CustomHandler(BaseHandler):
         command = urlparse(url).netloc
         command_dir = pathlib.Path(DATADIR).joinpath('bin')
         command_path = command_dir.joinpath(command)
-        command_args = [str(command_path), '-']
-        out = subprocess.check_output(command_args, input=req.data)
+        out = self.workers.call(command, command_path, req.data)
+        if out is None:
+            command_args = [str(command_path), '-']
+            out = subprocess.check_output(command_args, input=req.data)
         data = io.BytesIO(out)
         return addinfourl(data, headers, req.full_url, code=200)
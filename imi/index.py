@@ -1,18 +1,55 @@
-FSEP = '.'
+from .query import split_key, iter_path_candidates, NOTHING
+
+__all__ = ['extract', 'compile', 'Extractor']
+
+
+class Extractor(tuple):
+    """
+    Compiled index. It is still the tuple of index keys, but it also
+    keeps the keys split once into paths. Calling it with a document
+    gives the canonical key of the context: a frozenset of (key, value).
+    """
+
+    def __init__(self, keys):
+        self.paths = tuple((key, split_key(key)) for key in self)
+
+    def __call__(self, document):
+        return frozenset([(key, extract_path(document, path))
+                          for key, path in self.paths])
+
+
+def compile(index):
+    """
+    Build a reusable Extractor for the index keys. Compiling an Extractor
+    again returns it as is.
+    """
+    if isinstance(index, Extractor):
+        return index
+    return Extractor(index or ())
 
 
 def extract(document, index):
-    result = dict((key, None) for key in index)
-    for key in index:
-        path = key.split(FSEP)
-        val = document
-        for node in path:
-            if isinstance(val, dict):
-                val = val.get(node)
-
-            # TODO: search in arrays
-            else:
-                val = None
-                break
-        result[key] = val
-    return frozenset(result.items())
+    return compile(index)(document)
+
+
+def extract_path(document, path):
+    val = document
+    for num, (part, _) in enumerate(path):
+        if isinstance(val, dict):
+            val = val.get(part, NOTHING)
+        elif isinstance(val, (list, tuple)) and num:
+            # Search in arrays the way query does
+            return single_value(iter_path_candidates(val, path[num:]))
+        else:
+            return None
+    return None if val is NOTHING else val
+
+
+def single_value(candidates):
+    values = []
+    for val in candidates:
+        if val is not NOTHING and val not in values:
+            values.append(val)
+    if len(values) > 1:
+        raise ValueError('Index value is ambiguous: {}'.format(values))
+    return values[0] if values else None
@@ -0,0 +1,157 @@
+"""
+Streaming ingest of messages into a running server.
+
+Messages are read lazily from NDJSON or multi-document YAML and posted
+by a number of threads, each keeping its own keep-alive connection, so
+that many requests are in flight at once.
+"""
+
+import json
+import time
+import logging
+import queue
+import threading
+import http.client
+from itertools import islice
+import yaml
+from .config import WEB_HOST, WEB_PORT
+from .storage import YamlLoader
+
+__all__ = ['Ingest', 'iter_messages']
+
+log = logging.getLogger(__name__)
+
+HEADERS = {'Content-Type': 'application/json'}
+
+
+def iter_messages(stream):
+    """Yield messages of an NDJSON or a multi-document YAML stream."""
+    first = ''
+    for first in stream:
+        if first.strip():
+            break
+    if first.lstrip().startswith('{'):
+        lines = (first,)
+        for line in iter_lines(lines, stream):
+            yield json.loads(line)
+        return
+    for doc in yaml.load_all(HeadStream(first, stream), Loader=YamlLoader):
+        if doc is not None:
+            yield doc
+
+
+class HeadStream:
+    """The stream with its first line put back, read by yaml in chunks."""
+
+    def __init__(self, head, stream):
+        self.head = head
+        self.stream = stream
+
+    def read(self, size=-1):
+        if not self.head:
+            return self.stream.read(size)
+        head, self.head = self.head, ''
+        return head
+
+
+def iter_lines(head, stream):
+    for lines in (head, stream):
+        for line in lines:
+            if line.strip():
+                yield line
+
+
+def iter_chunks(items, size):
+    items = iter(items)
+    while True:
+        chunk = list(islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def is_error(result):
+    return isinstance(result, dict) and list(result) == ['error']
+
+
+class Ingest:
+
+    def __init__(self, concurrency=4, batch_size=1,
+                 host=WEB_HOST, port=WEB_PORT):
+        if concurrency < 1 or batch_size < 1:
+            raise ValueError('Concurrency and batch size must be positive')
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.host = host
+        self.port = port
+        self.sent = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def run(self, stream):
+        start = time.monotonic()
+        tasks = queue.Queue(self.concurrency * 2)
+        threads = []
+        for _ in range(self.concurrency):
+            thread = threading.Thread(target=self.worker, args=(tasks,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        try:
+            for chunk in iter_chunks(iter_messages(stream), self.batch_size):
+                tasks.put(chunk)
+        finally:
+            for _ in threads:
+                tasks.put(None)
+            for thread in threads:
+                thread.join()
+        elapsed = time.monotonic() - start
+        return {
+            'messages': self.sent,
+            'errors': self.errors,
+            'seconds': round(elapsed, 3),
+            'rate': round(self.sent / elapsed, 1) if elapsed else None
+        }
+
+    def worker(self, tasks):
+        conn = http.client.HTTPConnection(self.host, self.port)
+        try:
+            while True:
+                chunk = tasks.get()
+                if chunk is None:
+                    return
+                try:
+                    errors = self.post(conn, chunk)
+                except Exception:
+                    # The worker keeps draining the queue, or run() blocks
+                    log.exception('Failed to post messages')
+                    conn.close()
+                    errors = len(chunk)
+                with self.lock:
+                    self.sent += len(chunk)
+                    self.errors += errors
+        finally:
+            conn.close()
+
+    def post(self, conn, chunk):
+        """Post messages and return the number of failed ones."""
+        if self.batch_size > 1:
+            path, body = '/invoke/batch', chunk
+        else:
+            path, body = '/invoke', chunk[0]
+        try:
+            data = json.dumps(body).encode('utf-8')
+        except (TypeError, ValueError):
+            return len(chunk)  # a YAML date or another non JSON value
+        try:
+            conn.request('POST', path, data, HEADERS)
+            response = conn.getresponse()
+            results = json.loads(response.read().decode('utf-8'))
+        except (OSError, http.client.HTTPException, ValueError):
+            conn.close()  # reconnected by the next request
+            return len(chunk)
+        if response.status != 200:
+            return len(chunk)
+        if self.batch_size > 1:
+            return sum(1 for result in results if is_error(result))
+        return 0
@@ -0,0 +1,285 @@
+"""
+Append-only journal storage for contexts.
+
+Every save appends one compact JSON line to the newest segment file
+(journal/segment-<n>.log). A record of a new context holds the whole
+context, a record of an update holds the per node state only.
+compact() folds closed segments into journal/snapshot.json and moves
+completed contexts to the journal/complete.log archive, which is only
+read on demand. On startup every segment is folded, so the in-memory
+state is read from a snapshot of the active contexts alone.
+"""
+
+import os
+import json
+import logging
+import threading
+import contextlib
+from pathlib import Path
+from . import config
+from .storage import context_to_dict, random_id, DatabaseError
+
+__all__ = ['JournalStore', 'compact']
+
+log = logging.getLogger(__name__)
+
+SEGMENT_GLOB = 'segment-*.log'
+SNAPSHOT = 'snapshot.json'
+ARCHIVE = 'complete.log'
+
+
+def journal_path():
+    return Path(config.DATADIR).joinpath('journal')
+
+
+def segment_name(number):
+    return 'segment-{:08d}.log'.format(number)
+
+
+def segment_number(path):
+    return int(path.stem.split('-', 1)[1])
+
+
+def list_segments(path):
+    return sorted(path.glob(SEGMENT_GLOB), key=segment_number)
+
+
+def dumps(record):
+    return json.dumps(record, separators=(',', ':'))
+
+
+def new_record(ctx):
+    return {'op': 'new', 'ctx': context_to_dict(ctx)}
+
+
+def update_record(ctx):
+    state = [[node.state.name, node.calls_count, node.result.message]
+             for node in ctx.nodes]
+    return {'op': 'update', 'id': ctx.id, 'state': state}
+
+
+def is_active_doc(doc):
+    return any(node['state'] == 'current' for node in doc['nodes'])
+
+
+def apply_record(docs, record):
+    """Apply the record to the documents, return the document changed."""
+    if record['op'] == 'new':
+        doc = record['ctx']
+        docs[doc['id']] = doc
+        return doc
+    doc = docs.get(record['id'])
+    if doc is None:
+        log.warning('Skip update of unknown context #{}'.format(record['id']))
+        return None
+    for node, state_rec in zip(doc['nodes'], record['state']):
+        state, calls_count, message = state_rec
+        node['state'] = state
+        node['calls_count'] = calls_count
+        if message:
+            node['result']['message'] = message
+        else:
+            node['result'].pop('message', None)
+    return doc
+
+
+def read_snapshot(path):
+    try:
+        with path.joinpath(SNAPSHOT).open(encoding='utf-8') as stream:
+            snapshot = json.load(stream)
+    except FileNotFoundError:
+        return 0, {}
+    docs = dict((doc['id'], doc) for doc in snapshot['contexts'])
+    return snapshot['segment'], docs
+
+
+def read_segment(path, docs, done=None):
+    """
+    Apply the records of the segment. With done, a context completed by
+    a record is passed to it and dropped from the documents.
+    """
+    with path.open(encoding='utf-8') as stream:
+        for num, line in enumerate(stream, 1):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A crash can leave the tail record half-written
+                log.warning('Skip broken record {}:{}'.format(path, num))
+                break
+            doc = apply_record(docs, record)
+            if done and doc is not None and not is_active_doc(doc):
+                done(docs.pop(doc['id']))
+
+
+def replay(path, upto=None, done=None):
+    """Rebuild context documents from the snapshot and the segments."""
+    folded, docs = read_snapshot(path)
+    last = folded
+    for segment in list_segments(path):
+        number = segment_number(segment)
+        if number <= folded:
+            continue
+        if upto is not None and number > upto:
+            break
+        read_segment(segment, docs, done)
+        last = number
+    return last, docs
+
+
+def write_snapshot(path, segment, docs):
+    tmp = path.joinpath(SNAPSHOT + '.tmp')
+    with tmp.open('w', encoding='utf-8') as stream:
+        snapshot = {'segment': segment, 'contexts': list(docs.values())}
+        stream.write(dumps(snapshot))
+        stream.flush()
+        os.fsync(stream.fileno())
+    os.replace(str(tmp), str(path.joinpath(SNAPSHOT)))
+
+
+def compact(path=None, keep_newest=True):
+    """
+    Fold every closed segment into the snapshot and remove them.
+    The newest segment may be in use by a running server and is kept,
+    unless keep_newest is false. Completed contexts are archived as the
+    segments are read, so they are not kept in memory.
+    """
+    path = Path(path or journal_path())
+    segments = list_segments(path)
+    closed = segments[:-1] if keep_newest else segments
+    if not closed:
+        return 0
+    with path.joinpath(ARCHIVE).open('a', encoding='utf-8') as stream:
+
+        def archive(doc):
+            stream.write(dumps(doc) + '\n')
+        last, docs = replay(path, segment_number(closed[-1]), archive)
+        active = {}
+        for ctxid, doc in docs.items():
+            if is_active_doc(doc):
+                active[ctxid] = doc
+            else:
+                archive(doc)
+        stream.flush()
+        os.fsync(stream.fileno())
+    write_snapshot(path, last, active)
+    for segment in closed:
+        segment.unlink()
+    return len(closed)
+
+
+class JournalStore:
+
+    def __init__(self, path=None, segment_size=None, sync_every=None):
+        self.path = Path(path or journal_path())
+        if segment_size is None:
+            segment_size = config.JOURNAL_SEGMENT_SIZE
+        if sync_every is None:
+            sync_every = config.JOURNAL_SYNC_EVERY
+        self.segment_size = segment_size
+        self.sync_every = sync_every
+        self.ids = set()
+        self.segment = 0
+        self.stream = None
+        self.unsynced = 0
+        # Batch depth of every thread, only its own syncs are deferred
+        self.local = threading.local()
+        self.lock = threading.RLock()
+        try:
+            self.path.mkdir(parents=True)
+        except FileExistsError:
+            pass
+
+    def load(self):
+        """
+        Fold the segments of the last run into the snapshot, so completed
+        contexts are archived instead of replayed on every start.
+        """
+        compact(self.path, keep_newest=False)
+        last, docs = read_snapshot(self.path)
+        self.ids = set(docs)
+        # Never append after a possibly broken tail of an old segment
+        self._open_segment(last + 1)
+        return list(docs.values())
+
+    def iter_complete(self):
+        try:
+            with self.path.joinpath(ARCHIVE).open(encoding='utf-8') as stream:
+                for line in stream:
+                    yield json.loads(line)
+        except FileNotFoundError:
+            pass
+        _, docs = replay(self.path)
+        for doc in docs.values():
+            if not is_active_doc(doc):
+                yield doc
+
+    def read_complete(self, rule_name, ctx_id):
+        for doc in self.iter_complete():
+            if doc['id'] == ctx_id and doc['rule_name'] == rule_name:
+                return doc
+        return None
+
+    def create(self, ctx):
+        with self.lock:
+            for _ in range(10):
+                ctx = ctx._replace(id=random_id())
+                if ctx.id not in self.ids:
+                    break
+            else:
+                raise DatabaseError('Unable to save the context')
+            self.ids.add(ctx.id)
+            self._write(new_record(ctx))
+        return ctx
+
+    def update(self, ctx):
+        self._append(update_record(ctx))
+
+    @contextlib.contextmanager
+    def batch(self):
+        self.local.depth = getattr(self.local, 'depth', 0) + 1
+        try:
+            yield
+        finally:
+            self.local.depth -= 1
+            if not self.local.depth:
+                self.flush()
+
+    def wait(self):
+        pass
+
+    def flush(self):
+        with self.lock:
+            if self.stream and self.unsynced:
+                self.stream.flush()
+                os.fsync(self.stream.fileno())
+                self.unsynced = 0
+
+    def close(self):
+        with self.lock:
+            if self.stream:
+                self.flush()
+                self.stream.close()
+                self.stream = None
+
+    def _open_segment(self, number):
+        self.segment = number
+        segment = self.path.joinpath(segment_name(number))
+        self.stream = segment.open('a', encoding='utf-8')
+
+    def _append(self, record):
+        with self.lock:
+            self._write(record)
+
+    def _write(self, record):
+        if self.stream is None:
+            self._open_segment(self.segment + 1)
+        self.stream.write(dumps(record) + '\n')
+        self.stream.flush()
+        self.unsynced += 1
+        # Records of a batch are synced when it ends
+        batched = getattr(self.local, 'depth', 0) > 0
+        if not batched and self.sync_every and \
+                self.unsynced >= self.sync_every:
+            self.flush()
+        if self.stream.tell() >= self.segment_size:
+            self.close()
@@ -0,0 +1,226 @@
+"""
+Layout of the context files of the files and compact storage.
+
+flat     context/ctx-<rule>-<id>.json, completed contexts in
+         context/complete/ctx-<rule>-<id>.json
+sharded  context/<rule>/<id[:2]>/ctx-<rule>-<id>.json, likewise under
+         context/complete. Ids are random, the two characters split the
+         contexts of a rule in 1296 shards: a million contexts of a rule
+         are about 800 files per directory.
+
+config.CONTEXT_LAYOUT selects the layout. The sharded layout also reads
+the flat files left, so migrate() can move them while the server runs:
+restart it with the sharded layout, then run `imi migrate`. A file is
+hard linked to its new name before the old one is removed and the server
+removes the flat file of a context it saves, so neither undoes the other.
+Going back to the flat layout needs the server stopped.
+"""
+
+import os
+import functools
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from . import config
+
+__all__ = ['migrate']
+
+LAYOUTS = ('flat', 'sharded')
+# Characters of the id naming its shard
+SHARD_WIDTH = 2
+# Suffixes of the context files of the files and compact storage
+SUFFIXES = ('.json', '.ctx')
+# Shards listed by a thread at a time
+SCAN_CHUNK = 64
+
+
+def is_sharded(layout=None):
+    return (layout or config.CONTEXT_LAYOUT) == 'sharded'
+
+
+def ctx_parts(rule_name, ctx_id, fname, layout=None):
+    """Parts of the path of a context file below its directory."""
+    if is_sharded(layout):
+        return rule_name, ctx_id[:SHARD_WIDTH], fname
+    return fname,
+
+
+def lookup_parts(rule_name, ctx_id, fname):
+    """Parts of the paths a context file may have, the current first."""
+    yield ctx_parts(rule_name, ctx_id, fname)
+    if is_sharded():
+        yield fname,  # not migrated yet
+
+
+def ctx_file(path, ctx, fname, layout=None):
+    return path.joinpath(*ctx_parts(ctx.rule_name, ctx.id, fname(ctx),
+                                    layout))
+
+
+def parse_fname(name):
+    """Rule name and id of a context file name."""
+    stem = name[:name.rindex('.')]
+    rule_name, ctx_id = stem[len('ctx-'):].rsplit('-', 1)
+    return rule_name, ctx_id
+
+
+def open_ctx_file(path, mode, **kwargs):
+    """Open a context file, creating its shard on first use."""
+    try:
+        return path.open(mode, **kwargs)
+    except FileNotFoundError:
+        if 'r' in mode:
+            raise
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return path.open(mode, **kwargs)
+
+
+def remove_file(path):
+    try:
+        path.unlink()
+    except FileNotFoundError:
+        pass
+
+
+def remove_active(path, ctx, fname, mixed=False):
+    """
+    Remove the active file of a completed context. With flat files left
+    the flat one goes first, a migration can not bring it back then.
+    """
+    active = ctx_file(path, ctx, fname)
+    if not mixed:
+        active.unlink()
+        return
+    remove_file(ctx_file(path, ctx, fname, 'flat'))
+    remove_file(active)
+
+
+def has_flat_files(path, suffix):
+    """Whether sharded context files still have flat ones next to them."""
+    if not is_sharded():
+        return False
+    with os.scandir(str(path)) as entries:
+        return any(entry.name.endswith(suffix) for entry in entries)
+
+
+def scan_dir(path, suffix, stat=False):
+    """DirEntry of the context files and of the sub directories."""
+    files = []
+    dirs = []
+    try:
+        with os.scandir(str(path)) as entries:
+            for entry in entries:
+                if entry.name.endswith(suffix):
+                    if stat:
+                        entry.stat()  # cached by the entry
+                    files.append(entry)
+                elif entry.is_dir():
+                    dirs.append(entry)
+    except FileNotFoundError:
+        pass  # a shard removed meanwhile
+    return files, dirs
+
+
+def scan_dirs(paths, suffix, stat=False):
+    files = []
+    for path in paths:
+        files.extend(scan_dir(path, suffix, stat)[0])
+    return files
+
+
+def list_shards(path, suffix, stat=False, workers=None):
+    """
+    DirEntry of the context files in the shards of the directory and
+    the shard directories. Shards are listed in parallel threads.
+    """
+    if workers is None:
+        workers = config.LOAD_WORKERS
+    scan = functools.partial(scan_dir, suffix=suffix, stat=stat)
+    rule_dirs = [entry.path for entry in scan_dir(path, suffix)[1]
+                 if entry.name != 'complete']
+    files = []
+    shards = []
+    if not rule_dirs:
+        return files, shards
+    with ThreadPoolExecutor(max(workers, 1)) as pool:
+        for _, found in pool.map(scan, rule_dirs):
+            shards.extend(entry.path for entry in found)
+        chunks = [shards[num:num + SCAN_CHUNK]
+                  for num in range(0, len(shards), SCAN_CHUNK)]
+        scan = functools.partial(scan_dirs, suffix=suffix, stat=stat)
+        for found in pool.map(scan, chunks):
+            files.extend(found)
+    return files, shards
+
+
+def context_entries(path, suffix, stat=False):
+    """
+    DirEntry of the context files of the directory in the layout. A flat
+    file next to its sharded copy, left by an interrupted migration, is
+    older than the copy and skipped.
+    """
+    flat = scan_dir(path, suffix, stat)[0]
+    if not is_sharded():
+        return flat
+    files = list_shards(path, suffix, stat)[0]
+    if flat:
+        names = set(entry.name for entry in files)
+        files.extend(entry for entry in flat if entry.name not in names)
+    return files
+
+
+def context_paths(path, suffix):
+    if not is_sharded():
+        return path.glob('*' + suffix)
+    return [Path(entry.path) for entry in context_entries(path, suffix)]
+
+
+def move_file(source, target):
+    """
+    Link the file to its new name and remove the old one. A target saved
+    meanwhile is newer and kept, False if the source is gone.
+    """
+    for _ in range(2):
+        try:
+            os.link(str(source), str(target))
+        except FileExistsError:
+            break
+        except FileNotFoundError:
+            if not source.exists():
+                return False
+            target.parent.mkdir(parents=True, exist_ok=True)
+            continue
+        break
+    else:
+        return False
+    remove_file(source)
+    return True
+
+
+def migrate(layout='sharded', path=None):
+    """
+    Move the context files of the files and compact storage, active and
+    completed, to the layout. Return the count of files moved.
+    """
+    from .storage import ctx_db_path, DatabaseError
+    if layout not in LAYOUTS:
+        raise DatabaseError('Unknown context layout {}'.format(layout))
+    path = Path(path) if path else ctx_db_path()
+    count = 0
+    for directory in (path, path.joinpath('complete')):
+        if is_sharded(layout):
+            entries = scan_dir(directory, SUFFIXES)[0]
+            shards = []
+        else:
+            entries, shards = list_shards(directory, SUFFIXES)
+        for entry in entries:
+            rule_name, ctx_id = parse_fname(entry.name)
+            parts = ctx_parts(rule_name, ctx_id, entry.name, layout)
+            if move_file(Path(entry.path), directory.joinpath(*parts)):
+                count += 1
+        for shard in shards:
+            for empty in (shard, os.path.dirname(shard)):
+                try:
+                    os.rmdir(empty)
+                except OSError:
+                    pass  # not empty yet or removed
+    return count
@@ -0,0 +1,115 @@
+"""
+Parallel loading of JSON documents from many small files.
+
+Startup reads every active context file. Opening and reading them is
+bound by storage latency, so a pool of threads keeps several reads in
+flight. Decoding holds the GIL and is done by the reading thread, except
+for files of config.LOAD_PROCESS_SIZE and more which are decoded in a
+process pool when config.LOAD_PROCESSES is set.
+"""
+
+import json
+import time
+import logging
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from . import config
+
+__all__ = ['load_documents']
+
+log = logging.getLogger(__name__)
+
+# Files read by a thread per task, keeps the pool overhead per file low
+CHUNK_SIZE = 32
+
+
+def read_text(path):
+    with path.open(encoding='utf-8') as stream:
+        return stream.read()
+
+
+def load_chunk(load, paths):
+    return [load(path) for path in paths]
+
+
+class Progress:
+    """Log the count of loaded files at most every `interval` seconds."""
+
+    def __init__(self, total, interval=None, what='files'):
+        if interval is None:
+            interval = config.LOAD_PROGRESS_INTERVAL
+        self.total = total
+        self.interval = interval
+        self.what = what
+        self.done = 0
+        self.start = time.monotonic()
+        self.last = self.start
+
+    def step(self, count=1):
+        self.done += count
+        now = time.monotonic()
+        if self.interval and now - self.last >= self.interval:
+            self.last = now
+            log.info('Loaded {}/{} {}'.format(
+                self.done, self.total, self.what))
+
+    def finish(self):
+        elapsed = time.monotonic() - self.start
+        log.info('Loaded {} {} in {:.2f}s'.format(
+            self.done, self.what, elapsed))
+
+
+class Loader:
+
+    def __init__(self, processes=0, process_size=None):
+        if process_size is None:
+            process_size = config.LOAD_PROCESS_SIZE
+        self.process_size = process_size
+        self.decoders = None
+        if processes:
+            self.decoders = ProcessPoolExecutor(processes)
+
+    def load(self, path):
+        text = read_text(path)
+        if self.decoders and len(text) >= self.process_size:
+            return self.decoders.submit(json.loads, text).result()
+        return json.loads(text)
+
+    def close(self):
+        if self.decoders:
+            self.decoders.shutdown()
+
+
+def load_documents(paths, workers=None, processes=None, what='files',
+                   chunk_size=CHUNK_SIZE, load=None):
+    """
+    Documents of the JSON files in the order of paths, or the results of
+    load(path) for files of other formats. Every thread reads a chunk of
+    files at a time. With less than two workers the files are read one
+    by one in the calling thread.
+    """
+    if workers is None:
+        workers = config.LOAD_WORKERS
+    if processes is None:
+        processes = config.LOAD_PROCESSES
+    paths = list(paths)
+    progress = Progress(len(paths), what=what)
+    loader = Loader(processes if load is None else 0)
+    load = load or loader.load
+    docs = []
+    try:
+        if workers > 1 and len(paths) > 1:
+            chunks = [paths[num:num + chunk_size]
+                      for num in range(0, len(paths), chunk_size)]
+            with ThreadPoolExecutor(min(workers, len(chunks))) as pool:
+                for chunk in pool.map(partial(load_chunk, load), chunks):
+                    docs.extend(chunk)
+                    progress.step(len(chunk))
+        else:
+            for path in paths:
+                docs.append(load(path))
+                progress.step()
+    finally:
+        loader.close()
+    progress.finish()
+    return docs
@@ -0,0 +1,269 @@
+"""
+Counters and latency histograms in the Prometheus text format.
+
+Metrics are module level objects updated in place on the hot paths,
+an observation costs a bisect and an addition. Updates take no lock:
+an increment may very rarely be lost to a thread switch, which is fine
+for monitoring and keeps the overhead low enough to be always on.
+Every process keeps its own values, /metrics renders them with render().
+The workers of a prefork server add up the snapshot() of the others.
+"""
+
+import abc
+import bisect
+import threading
+from time import perf_counter
+from urllib.parse import urlsplit
+
+__all__ = ['Counter', 'Gauge', 'Histogram', 'render', 'snapshot',
+           'METRICS']
+
+# Seconds, from a dict lookup to a slow node service
+BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+           0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+METRICS = []
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, escape(value))
+                          for name, value in pairs) + '}'
+
+
+def escape(value):
+    value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+    return value.replace('\n', '\\n')
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(metaclass=abc.ABCMeta):
+    kind = None
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.label_names = tuple(labels)
+        self.children = {}
+        self.lock = threading.Lock()
+        METRICS.append(self)
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.new_child())
+        return child
+
+    @abc.abstractmethod
+    def new_child(self):
+        """Value of a new label set."""
+
+    def collect(self):
+        """Label values to the plain data of the children."""
+        with self.lock:
+            children = list(self.children.items())
+        return {values: self.child_data(child) for values, child in children}
+
+    def merge(self, data, other):
+        return data + other
+
+    def render(self, values=None):
+        if values is None:
+            values = self.collect()
+        lines = ['# HELP {} {}'.format(self.name, self.doc),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        for key, data in sorted(values.items()):
+            lines.extend(self.render_child(key, data))
+        return lines
+
+
+class CounterValue:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def new_child(self):
+        return CounterValue()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def child_data(self, child):
+        return child.value
+
+    def render_child(self, values, data):
+        labels = format_labels(self.label_names, values)
+        yield '{}{} {}'.format(self.name, labels, format_value(data))
+
+
+class Timer:
+    __slots__ = ('child', 'start')
+
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.child.observe(perf_counter() - self.start)
+
+
+class HistogramValue:
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def time(self):
+        return Timer(self)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labels=(), buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, doc, labels)
+        if not self.label_names:
+            # Saves a call on the hot paths
+            self.observe = self.labels().observe
+
+    def new_child(self):
+        return HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def time(self):
+        return Timer(self.labels())
+
+    def child_data(self, child):
+        return list(child.counts), child.sum
+
+    def merge(self, data, other):
+        counts = [count + more for count, more in zip(data[0], other[0])]
+        return counts, data[1] + other[1]
+
+    def render_child(self, values, data):
+        counts, total = data
+        cumulative = 0
+        bounds = self.buckets + (float('inf'),)
+        for bound, count in zip(bounds, counts):
+            cumulative += count
+            labels = format_labels(self.label_names, values,
+                                   [('le', format_value(bound))])
+            yield '{}_bucket{} {}'.format(self.name, labels, cumulative)
+        labels = format_labels(self.label_names, values)
+        yield '{}_sum{} {}'.format(self.name, labels, format_value(total))
+        yield '{}_count{} {}'.format(self.name, labels, cumulative)
+
+
+class Gauge(Metric):
+    """Values read on render from a function returning label -> value."""
+    kind = 'gauge'
+
+    def __init__(self, name, doc, labels=()):
+        super().__init__(name, doc, labels)
+        self.func = None
+
+    def set_function(self, func):
+        self.func = func
+
+    def new_child(self):
+        raise TypeError('Gauge values are read from its function')
+
+    def collect(self):
+        if self.func is None:
+            return {}
+        values = self.func()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return {key if isinstance(key, tuple) else (key,): value
+                for key, value in values.items()}
+
+    def render_child(self, values, data):
+        labels = format_labels(self.label_names, values)
+        yield '{}{} {}'.format(self.name, labels, format_value(data))
+
+
+def snapshot():
+    """Values of the metrics of this process, JSON serializable."""
+    return {metric.name: [[list(values), data]
+                          for values, data in metric.collect().items()]
+            for metric in METRICS}
+
+
+def render(snapshots=()):
+    """Text of the metrics, added up with snapshots of other processes."""
+    lines = []
+    for metric in METRICS:
+        values = metric.collect()
+        for other in snapshots:
+            for key, data in other.get(metric.name, ()):
+                key = tuple(key)
+                if key in values:
+                    data = metric.merge(values[key], data)
+                values[key] = data
+        lines.extend(metric.render(values))
+    return '\n'.join(lines) + '\n'
+
+
+REQUEST_SECONDS = Histogram(
+    'imi_request_seconds', 'Time to handle a request', ['path'])
+REQUEST_ERRORS = Counter(
+    'imi_request_errors_total', 'Requests answered with an error', ['path'])
+DISPATCH_SECONDS = Histogram(
+    'imi_dispatch_seconds', 'Time to find the rule of a message')
+LOOKUP_SECONDS = Histogram(
+    'imi_context_lookup_seconds', 'Time to look up the context of a message')
+NODE_SECONDS = Histogram(
+    'imi_node_seconds', 'Time of node service calls',
+    ['rule', 'scheme', 'host'])
+NODE_ERRORS = Counter(
+    'imi_node_errors_total', 'Failed node service calls',
+    ['rule', 'scheme', 'host'])
+SAVE_SECONDS = Histogram(
+    'imi_save_seconds', 'Time to save a context')
+CONTEXTS = Gauge(
+    'imi_contexts', 'Contexts in the storage by state', ['state'])
+CONTEXTS_COMPLETED = Counter(
+    'imi_contexts_completed_total', 'Contexts completed since the start')
+
+NODE_CHILDREN = {}
+
+
+def node_metrics(rule_name, url):
+    """Time histogram and error counter of a node, cached by url."""
+    key = rule_name, url
+    children = NODE_CHILDREN.get(key)
+    if children is None:
+        parts = urlsplit(url)
+        values = rule_name, parts.scheme, parts.hostname or parts.netloc
+        children = (NODE_SECONDS.labels(*values),
+                    NODE_ERRORS.labels(*values))
+        NODE_CHILDREN[key] = children
+    return children
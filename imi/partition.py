@@ -0,0 +1,70 @@
+"""
+Partitioning of contexts between the worker processes of a server.
+
+Every worker owns a hash range of (rule_name, index) and keeps only its
+own contexts in memory. A message for a context of another worker is
+forwarded to the private socket of the owner, so a context is always
+changed by a single process.
+"""
+
+import json
+import zlib
+from urllib.error import HTTPError
+from .context import ContextAgent, ContextError, invoke_service
+
+__all__ = ['Partition', 'PartitionAgent', 'partition_of']
+
+
+def partition_of(rule_name, index, count):
+    key = json.dumps([rule_name, sorted(index)], default=str)
+    return zlib.crc32(key.encode('utf-8')) % count
+
+
+class Partition:
+
+    def __init__(self, number, addresses):
+        self.number = number
+        self.addresses = addresses
+
+    @property
+    def count(self):
+        return len(self.addresses)
+
+    def owner(self, rule_name, index):
+        return partition_of(rule_name, index, self.count)
+
+    def owns(self, rule_name, index):
+        return self.owner(rule_name, index) == self.number
+
+    def url(self, owner):
+        host, port = self.addresses[owner]
+        return 'http://{}:{}/invoke'.format(host, port)
+
+
+class PartitionAgent(ContextAgent):
+
+    def __init__(self, rules, database, partition):
+        super().__init__(rules, database)
+        self.partition = partition
+
+    def apply_message(self, message):
+        go_next = True
+        while go_next:
+            rule, idx = self.find_metadata(message)
+            owner = self.partition.owner(rule.name, idx)
+            if owner != self.partition.number:
+                return self.forward(owner, message)
+            go_next, message = self.apply_step(message, rule, idx)
+        return message
+
+    def forward(self, owner, message):
+        try:
+            return invoke_service(self.partition.url(owner), message)
+        except HTTPError as err:
+            if err.code != 400:
+                raise
+            try:
+                doc = json.loads(err.read().decode('utf-8'))
+            except ValueError:
+                raise err
+            raise ContextError(doc.get('error', str(err)))
@@ -0,0 +1,195 @@
+"""
+Keep-alive HTTP connection pools for node services.
+
+The pooled handlers replace the default urllib HTTP(S) handlers in the
+opener installed by handlers.register(), so urlopen() keeps working for
+every scheme while http:// and https:// requests reuse connections.
+"""
+
+import io
+import ssl
+import queue
+import select
+import logging
+import threading
+import http.client
+from urllib.request import HTTPHandler, HTTPSHandler
+from urllib.response import addinfourl
+from urllib.error import URLError
+from urllib.parse import urlsplit
+from . import config
+
+__all__ = ['PoolManager', 'PooledHTTPHandler', 'PooledHTTPSHandler']
+
+log = logging.getLogger(__name__)
+
+# Errors connecting or writing the request, the service did not get a
+# whole request then. Once the request is written nothing is retried,
+# a node service must not be called twice.
+RETRY_ERRORS = (ConnectionRefusedError, ConnectionResetError,
+                BrokenPipeError)
+
+
+def is_dropped(conn):
+    """Whether an idle connection was closed by the other side."""
+    if conn.sock is None:
+        return True
+    # An idle connection has nothing to read but the end of the stream
+    try:
+        return bool(select.select([conn.sock], [], [], 0)[0])
+    except (OSError, ValueError):
+        return True
+
+
+class ConnectionPool:
+    """Idle keep-alive connections to a single host."""
+
+    def __init__(self, scheme, host, port, size,
+                 connect_timeout, read_timeout):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.idle = queue.LifoQueue(size)
+
+    def request(self, method, selector, body, headers, retries):
+        for attempt in range(retries + 1):
+            conn = None
+            try:
+                conn = self._get()
+                conn.request(method, selector, body, headers)
+            except RETRY_ERRORS as err:
+                if conn:
+                    conn.close()
+                if attempt == retries:
+                    raise
+                log.info('Retry {} request: {}'.format(self.host, err))
+                continue
+            except Exception:
+                if conn:
+                    conn.close()
+                raise
+            try:
+                response = conn.getresponse()
+                data = response.read()
+            except Exception:
+                conn.close()
+                raise
+            self._put(conn, response)
+            return response, data
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def _get(self):
+        while True:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                return self._connect()
+            if not is_dropped(conn):
+                return conn
+            conn.close()
+
+    def _put(self, conn, response):
+        if response.will_close:
+            conn.close()
+            return
+        try:
+            self.idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def _connect(self):
+        args = (self.host, self.port)
+        if self.scheme == 'https':
+            context = ssl.create_default_context()
+            conn = http.client.HTTPSConnection(
+                *args, timeout=self.connect_timeout, context=context)
+        else:
+            conn = http.client.HTTPConnection(
+                *args, timeout=self.connect_timeout)
+        conn.connect()
+        conn.sock.settimeout(self.read_timeout)
+        return conn
+
+
+class PoolManager:
+    """Connection pools keyed by scheme, host and port."""
+
+    def __init__(self, size=None, connect_timeout=None,
+                 read_timeout=None, retries=None):
+        self.size = size or config.HTTP_POOL_SIZE
+        self.connect_timeout = connect_timeout or config.HTTP_CONNECT_TIMEOUT
+        self.read_timeout = read_timeout or config.HTTP_READ_TIMEOUT
+        if retries is None:
+            retries = config.HTTP_RETRIES
+        self.retries = retries
+        self.pools = {}
+        self.lock = threading.Lock()
+
+    def get_pool(self, scheme, host, port):
+        key = scheme, host, port
+        with self.lock:
+            pool = self.pools.get(key)
+            if pool is None:
+                pool = ConnectionPool(scheme, host, port, self.size,
+                                      self.connect_timeout,
+                                      self.read_timeout)
+                self.pools[key] = pool
+        return pool
+
+    def open(self, req):
+        scheme = req.type
+        host, port = split_host(req.host, scheme)
+        headers = dict(req.unredirected_hdrs)
+        headers.update(req.headers)
+        headers = dict((name.title(), val) for name, val in headers.items())
+        headers['Connection'] = 'keep-alive'
+        pool = self.get_pool(scheme, host, port)
+        try:
+            response, data = pool.request(req.get_method(), req.selector,
+                                          req.data, headers, self.retries)
+        except OSError as err:
+            raise URLError(err)
+        result = addinfourl(io.BytesIO(data), response.msg,
+                            req.full_url, response.status)
+        result.msg = response.reason
+        return result
+
+    def close(self):
+        with self.lock:
+            for pool in self.pools.values():
+                pool.close()
+            self.pools.clear()
+
+
+def split_host(host, scheme):
+    default = 443 if scheme == 'https' else 80
+    parts = urlsplit('//' + host)
+    return parts.hostname, parts.port or default
+
+
+class PooledHTTPHandler(HTTPHandler):
+
+    def __init__(self, pools):
+        super().__init__()
+        self.pools = pools
+
+    def http_open(self, req):
+        return self.pools.open(req)
+
+
+class PooledHTTPSHandler(HTTPSHandler):
+
+    def __init__(self, pools):
+        super().__init__()
+        self.pools = pools
+
+    def https_open(self, req):
+        return self.pools.open(req)
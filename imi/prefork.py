@@ -0,0 +1,192 @@
+"""
+Pre-forked multi-process server.
+
+The master binds the public socket and one private loopback socket per
+worker, then forks the workers and restarts those which die. Every
+worker accepts requests on the shared public socket and serves its own
+private socket, which other workers use to forward messages of the
+contexts it owns (see partition.py). The sockets stay bound in the
+master, so requests wait in the backlog while a worker restarts.
+On SIGTERM every worker finishes the request in progress and exits.
+On SIGHUP the master replaces the workers one at a time, keeping the
+sockets bound, so a restart refuses no connection. A new worker loads
+the rules and its contexts again.
+"""
+
+import os
+import time
+import signal
+import socket
+import logging
+import threading
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+from . import config
+from .partition import Partition
+from .storage import DatabaseError
+from .web import init_app
+
+__all__ = ['Master', 'bind_socket']
+
+log = logging.getLogger(__name__)
+
+LOCALHOST = '127.0.0.1'
+
+
+def bind_socket(host, port):
+    family, type_, proto, _, address = socket.getaddrinfo(
+        host, port, type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE)[0]
+    sock = socket.socket(family, type_, proto)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(address)
+    sock.listen(128)
+    # Workers race for connections, the losers must not block in accept()
+    sock.setblocking(False)
+    return sock
+
+
+class PreboundServer(WSGIServer):
+    """WSGI server on a socket bound by the master."""
+
+    def __init__(self, sock, handler=WSGIRequestHandler):
+        super().__init__(None, handler, bind_and_activate=False)
+        self.socket.close()
+        self.socket = sock
+        self.server_address = sock.getsockname()
+        host, self.server_port = self.server_address[:2]
+        self.server_name = socket.getfqdn(host)
+        self.setup_environ()
+
+
+class ThreadingPreboundServer(ThreadingMixIn, PreboundServer):
+    # server_close() waits for the requests in progress
+    daemon_threads = False
+    block_on_close = True
+
+
+def serve_worker(number, sock, private):
+    addresses = [s.getsockname()[:2] for s in private]
+    app = init_app(Partition(number, addresses))
+    if config.WEB_THREADED:
+        public = ThreadingPreboundServer(sock)
+    else:
+        public = PreboundServer(sock)
+    public.set_app(app)
+    internal = ThreadingPreboundServer(private[number])
+    internal.set_app(app)
+
+    def stop(signum, frame):
+        # shutdown() waits for serve_forever() of this very thread
+        threading.Thread(target=public.shutdown).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    thread = threading.Thread(target=internal.serve_forever)
+    thread.daemon = True
+    thread.start()
+    log.info('Worker {} started'.format(number))
+    try:
+        public.serve_forever()
+    finally:
+        public.server_close()
+        # Messages forwarded by the other workers meanwhile
+        internal.shutdown()
+        internal.server_close()
+        app.close()
+    log.info('Worker {} stopped'.format(number))
+
+
+class Master:
+
+    def __init__(self, count, host=None, port=None):
+        self.count = count
+        self.host = config.WEB_HOST if host is None else host
+        self.port = config.WEB_PORT if port is None else port
+        self.sock = None
+        self.private = []
+        self.children = {}
+        self.stopping = False
+        # Workers still to replace and the one being replaced
+        self.replacing = []
+        self.replaced = None
+
+    def run(self):
+        if self.count > 1 and config.STORAGE == 'journal':
+            raise DatabaseError('Journal storage allows a single worker')
+        self.sock = bind_socket(self.host, self.port)
+        self.private = [bind_socket(LOCALHOST, 0) for _ in range(self.count)]
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, self.restart)
+        try:
+            for number in range(self.count):
+                self.spawn(number)
+            self.supervise()
+        finally:
+            for sock in [self.sock] + self.private:
+                sock.close()
+
+    def spawn(self, number):
+        # A child must not run the master handlers before it sets its own
+        signals = {signal.SIGTERM, signal.SIGINT, signal.SIGHUP}
+        signal.pthread_sigmask(signal.SIG_BLOCK, signals)
+        pid = os.fork()
+        if pid:
+            self.children[pid] = number
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, signals)
+            return
+        code = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, signals)
+            serve_worker(number, self.sock, self.private)
+        except BaseException:
+            log.exception('Worker {} failed'.format(number))
+            code = 1
+        finally:
+            os._exit(code)
+
+    def supervise(self):
+        while self.children:
+            pid, status = os.wait()
+            number = self.children.pop(pid, None)
+            if number is None or self.stopping:
+                continue
+            if number == self.replaced:
+                log.info('Worker {} stopped, replacing it'.format(number))
+                self.replaced = None
+                self.spawn(number)
+                self.replace_next()
+                continue
+            message = 'Worker {} exited with status {}, restarting'
+            log.warning(message.format(number, status))
+            time.sleep(config.WEB_RESPAWN_DELAY)
+            self.spawn(number)
+
+    def restart(self, signum=None, frame=None):
+        """Replace the workers one by one, the sockets stay bound."""
+        if self.stopping:
+            return
+        log.info('Replacing the workers')
+        self.replacing = sorted(self.children.values())
+        if self.replaced is None:
+            self.replace_next()
+
+    def replace_next(self):
+        while self.replacing:
+            number = self.replacing.pop(0)
+            for pid, child in self.children.items():
+                if child == number:
+                    self.replaced = number
+                    os.kill(pid, signal.SIGTERM)
+                    return
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
@@ -63,10 +63,38 @@ $size - TODO: Selects documents if the array field is a specified size.
 
 """
 
-__all__ = ['match']
+__all__ = ['match', 'compile', 'Matcher']
 
 RE_TYPE = type(re.compile(''))
 NOTHING = object()
+FSEP = '.'
+
+
+class Matcher(dict):
+    """
+    Compiled query. It is still the query document itself, so it can be
+    serialized and compared as before, but it also keeps a test function
+    built once with paths split, operators bound and regexes compiled.
+    Treat it as read-only: changing the items does not recompile it.
+    """
+    __slots__ = ('_test',)
+
+    def __init__(self, query):
+        super().__init__(query)
+        self._test = compile_query(self)
+
+    def __call__(self, document):
+        return self._test(document)
+
+
+def compile(query):
+    """
+    Build a reusable Matcher for the query. Compiling a Matcher again
+    returns it as is.
+    """
+    if isinstance(query, Matcher):
+        return query
+    return Matcher(query or {})
 
 
 def match(document, query):
@@ -75,95 +103,158 @@ def match(document, query):
     in the find() method and other related scenarios (like $elemMatch)
     Inspired by https://github.com/vmalloc/mongomock project
     """
-    if query is None or query == {}:
-        return True
-    for key, search in query.items():
-        if key in LOGICAL_OPERATOR_MAP:
-            if LOGICAL_OPERATOR_MAP[key](document, search):
-                continue
-            else:
+    return compile(query)(document)
+
+
+def compile_query(query):
+    clauses = tuple(compile_clause(key, search)
+                    for key, search in query.items())
+    if not clauses:
+        return always
+    if len(clauses) == 1:
+        return clauses[0]
+
+    def test(document):
+        for clause in clauses:
+            if not clause(document):
                 return False
-        none_search = search is None or search is {'$exists:': False}
-        for doc_val in iter_key_candidates(document, key):
-            if isinstance(search, dict):
-                is_match = dict_match(document, key, doc_val, search)
-            elif isinstance(search, RE_TYPE):
-                is_match = regex(doc_val, search)
-            elif isinstance(doc_val, (list, tuple)):
-                is_match = (search in doc_val or search == doc_val)
-            else:
-                is_none = none_search and doc_val is NOTHING
-                is_match = doc_val == search or is_none
-            if is_match:
-                break
-        else:
-            return False
-    return True
+        return True
+    return test
 
 
-def dict_match(document, key, value, search):
+def compile_clause(key, search):
+    if key in LOGICAL_OPERATOR_MAP:
+        reduce = LOGICAL_OPERATOR_MAP[key]
+        subqueries = tuple(compile(subq) for subq in search)
+        return lambda document: reduce(q(document) for q in subqueries)
+    path = split_key(key)
+    test_value = compile_search(key, search)
+
+    def clause(document):
+        for doc_val in iter_path_candidates(document, path):
+            if test_value(document, doc_val):
+                return True
+        return False
+    return clause
+
+
+def compile_search(key, search):
+    if isinstance(search, dict):
+        return compile_dict_search(key, search)
+    if isinstance(search, RE_TYPE):
+        return lambda document, value: regex(value, search)
+    none_search = search is None
+
+    def test(document, value):
+        if isinstance(value, (list, tuple)):
+            return search in value or search == value
+        return value == search or (none_search and value is NOTHING)
+    return test
+
+
+def compile_dict_search(key, search):
     no_ops = not all(op.startswith('$') for op in search.keys())
     if no_ops:
-        if isinstance(value, (list, tuple)):
-            return any(item == search for item in value)
-        return value == search
+        def test(document, value):
+            if isinstance(value, (list, tuple)):
+                return any(item == search for item in value)
+            return value == search
+        return test
+    checks = []
     for op, arg in search.items():
-        is_match = False
-        handler = OPERATOR_MAP.get(op)
-        if handler:
-            is_match = handler(value, arg)
+        if op in OPERATOR_MAP:
+            checks.append(bind_operator(op, arg))
         elif op == '$not':
-            is_match = not_op(document, key, arg)
-        if not is_match:
-            return False
+            checks.append(bind_not(key, arg))
+        else:
+            return lambda document, value: False
+
+    def test(document, value):
+        for check in checks:
+            if not check(document, value):
+                return False
+        return True
+    return test
+
+
+def bind_operator(op, arg):
+    handler = OPERATOR_MAP[op]
+    prepare = OPERATOR_ARGS.get(op)
+    if prepare:
+        arg = prepare(arg)
+    return lambda document, value: handler(value, arg)
+
+
+def bind_not(key, arg):
+    query = compile({key: arg})
+    return lambda document, value: not query(document)
+
+
+def always(document):
     return True
 
 
+def split_key(key):
+    """
+    Split a dotted key once, keeping the integer form of every part
+    for positional access into arrays.
+    """
+    if not key:
+        return ()
+    path = []
+    for part in key.split(FSEP):
+        try:
+            pos = int(part)
+        except ValueError:
+            pos = None
+        path.append((part, pos))
+    return tuple(path)
+
+
 def iter_key_candidates(document, key):
     """
     Get possible subdocuments or lists that are referred to by
     the key in question. Returns the appropriate nested value if
     the key includes dot notation.
     """
-    if not key:
+    return iter_path_candidates(document, split_key(key))
+
+
+def iter_path_candidates(document, path):
+    """
+    Same as iter_key_candidates but for a key already split by split_key.
+    """
+    if not path:
         return (document,)
     if isinstance(document, (list, tuple)):
-        return iter_key_candidates_sublist(document, key)
+        return iter_path_candidates_sublist(document, path)
     if not isinstance(document, dict):
         return (document,)
-    key_parts = key.split('.')
-    if len(key_parts) == 1:
-        return (document.get(key, NOTHING),)
-    sub_key = '.'.join(key_parts[1:])
-    sub_doc = document.get(key_parts[0], {})
-    return iter_key_candidates(sub_doc, sub_key)
+    if len(path) == 1:
+        return (document.get(path[0][0], NOTHING),)
+    sub_doc = document.get(path[0][0], {})
+    return iter_path_candidates(sub_doc, path[1:])
 
 
-def iter_key_candidates_sublist(document, key):
+def iter_path_candidates_sublist(document, path):
     """
     :param document: a list to be searched for candidates for our key
-    :param key: the string key to be matched
+    :param path: the split key to be matched
     """
-    key_parts = key.split(".")
-    sub_key = key_parts.pop(0)
-    key_remainder = ".".join(key_parts)
-    try:
-        sub_key_int = int(sub_key)
-    except ValueError:
-        sub_key_int = None
+    (sub_key, sub_key_int), remainder = path[0], path[1:]
     if sub_key_int is None:
         res = []
         for sub_doc in document:
             if isinstance(sub_doc, dict) and sub_key in sub_doc:
-                val = iter_key_candidates(sub_doc[sub_key], key_remainder)
+                val = iter_path_candidates(sub_doc[sub_key], remainder)
                 res.extend(val)
         return res or (NOTHING,)
     else:
         if sub_key_int >= len(document):
             return ()
         sub_doc = document[sub_key_int]
-        if key_remainder:
-            return iter_key_candidates(sub_doc, key_remainder)
+        if remainder:
+            return iter_path_candidates(sub_doc, remainder)
         return (sub_doc,)
 
 
@@ -176,10 +267,6 @@ def all_op(document, search):
     return all(item in document for item in search)
 
 
-def not_op(document, key, value):
-    return not match(document, {key: value})
-
-
 def not_nothing_and(func):
     "wrap an operator to return False if the first arg is NOTHING"
     return lambda a, b: a is not NOTHING and func(a, b)
@@ -188,7 +275,7 @@ def not_nothing_and(func):
 def elem_match_op(document, query):
     if not isinstance(document, (list, tuple)):
         return False
-    return any(match(item, query) for item in document)
+    return any(query(item) for item in document)
 
 
 def regex(document, regex):
@@ -205,12 +292,19 @@ OPERATOR_MAP = {
     '$in': lambda dv, sv: any(x in sv for x in force_list(dv)),
     '$nin': lambda dv, sv: all(x not in sv for x in force_list(dv)),
     '$exists': lambda dv, sv: bool(sv) == (dv is not NOTHING),
-    '$regex': not_nothing_and(lambda dv, sv: regex(dv, re.compile(sv))),
+    '$regex': not_nothing_and(regex),
     '$elemMatch': elem_match_op
 }
 
 
+# Operator arguments prepared once at compile time
+OPERATOR_ARGS = {
+    '$regex': re.compile,
+    '$elemMatch': compile,
+}
+
+
 LOGICAL_OPERATOR_MAP = {
-    '$or': lambda d, subq: any(match(d, q) for q in subq),
-    '$and': lambda d, subq: all(match(d, q) for q in subq),
+    '$or': any,
+    '$and': all,
 }
@@ -0,0 +1,87 @@
+"""
+Reload of rules when the rules/*.yaml files change.
+
+A thread polls the rule files through the parsed rule file cache of
+imi.storage, which reads a file again only when its modification time
+or size changes and parses it only when its content does. Rules of the
+changed files are compiled again and the rule table of the agent is
+swapped at once. A file which fails to load keeps its previous rules.
+"""
+
+import logging
+import threading
+from . import config
+from .storage import (list_rule_files, load_rule_file, evict_rule_files,
+                      init_rules)
+
+__all__ = ['RuleReloader']
+
+log = logging.getLogger(__name__)
+
+
+class RuleReloader:
+
+    def __init__(self, agent, interval=None):
+        self.agent = agent
+        if interval is None:
+            interval = config.RULES_RELOAD_INTERVAL
+        self.interval = interval
+        # Path to the documents, or the error, and the rules of the file
+        self.files = {}
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.scan()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.scan()
+            except Exception:
+                log.exception('Failed to reload rules')
+
+    def scan(self):
+        """Reload changed rule files, return True if rules changed."""
+        files = {}
+        changed = False
+        paths = list_rule_files()
+        for path in paths:
+            cached = self.files.get(path)
+            try:
+                docs = load_rule_file(path)
+            except FileNotFoundError:
+                continue
+            except Exception as err:
+                docs = err
+            if cached and cached[0] is docs:
+                files[path] = cached
+                continue
+            files[path] = docs, self.load(path, docs, cached)
+            changed = True
+        evict_rule_files(paths)
+        if files.keys() != self.files.keys():
+            changed = True
+        self.files = files
+        if changed:
+            rules = [rule for _, rules in files.values() for rule in rules]
+            self.agent.set_rules(rules)
+            log.info('Loaded {} rules'.format(len(rules)))
+        return changed
+
+    def load(self, path, docs, cached):
+        try:
+            if isinstance(docs, Exception):
+                raise docs
+            return init_rules(docs)
+        except Exception as err:
+            log.error('Cannot load rules of {}: {}'.format(path, err))
+            return cached[1] if cached else []
@@ -0,0 +1,337 @@
+"""
+SQLite storage for contexts.
+
+Contexts are not kept in memory: every lookup and save is a single
+statement on the contexts table, except the saves of a batch, which are
+kept until the batch ends and written in one transaction. Active and
+completed contexts live in the same table and differ by the active flag.
+"""
+
+import json
+import sqlite3
+import logging
+import threading
+import contextlib
+from itertools import chain
+from pathlib import Path
+from . import config, metrics
+from .storage import (load_rule_docs, load_context_docs, init_rules,
+                      init_contexts, context_to_dict, is_active_ctx,
+                      iter_complete_docs, random_id, DatabaseError)
+
+__all__ = ['SqliteDatabase', 'import_context_files']
+
+log = logging.getLogger(__name__)
+
+# Ids are unique within a rule, like the names of the context files
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS contexts ('
+    ' id TEXT NOT NULL,'
+    ' rule_name TEXT NOT NULL,'
+    ' idx TEXT NOT NULL,'
+    ' active INTEGER NOT NULL,'
+    ' doc TEXT NOT NULL,'
+    ' PRIMARY KEY (rule_name, id))',
+    # Only one active context per index, any number of completed ones
+    'CREATE UNIQUE INDEX IF NOT EXISTS contexts_active_idx'
+    ' ON contexts (rule_name, idx, active) WHERE active = 1',
+)
+
+SELECT_COMPLETE = ('SELECT doc FROM contexts'
+                   ' WHERE rule_name = ? AND id = ? AND active = 0')
+ITER_COMPLETE = 'SELECT doc FROM contexts WHERE active = 0'
+COUNT_ACTIVE = 'SELECT count(*) FROM contexts WHERE active = 1'
+SELECT_ACTIVE = ('SELECT doc FROM contexts'
+                 ' WHERE rule_name = ? AND idx = ? AND active = 1')
+SELECT_ACTIVE_ID = ('SELECT id FROM contexts'
+                    ' WHERE rule_name = ? AND idx = ? AND active = 1')
+SELECT_ID = 'SELECT 1 FROM contexts WHERE rule_name = ? AND id = ?'
+INSERT = ('INSERT INTO contexts (id, rule_name, idx, active, doc)'
+          ' VALUES (?, ?, ?, ?, ?)')
+UPDATE = ('UPDATE contexts SET active = ?, doc = ?'
+          ' WHERE id = ? AND rule_name = ? AND idx = ? AND active = 1')
+
+
+def sqlite_path():
+    return Path(config.DATADIR).joinpath('context.db')
+
+
+def primary_key(conn):
+    """Columns of the primary key of the contexts table, in key order."""
+    columns = conn.execute('PRAGMA table_info(contexts)').fetchall()
+    keys = sorted((column[5], column[1]) for column in columns if column[5])
+    return [name for _, name in keys]
+
+
+def upgrade_schema(conn):
+    """Key a contexts table of the id alone by the rule name and id."""
+    if primary_key(conn) != ['id']:
+        return
+    log.info('Upgrading the contexts table')
+    conn.execute('BEGIN')
+    try:
+        conn.execute('DROP INDEX IF EXISTS contexts_active_idx')
+        conn.execute('ALTER TABLE contexts RENAME TO contexts_old')
+        for statement in SCHEMA:
+            conn.execute(statement)
+        conn.execute('INSERT INTO contexts (id, rule_name, idx, active, doc)'
+                     ' SELECT id, rule_name, idx, active, doc'
+                     ' FROM contexts_old')
+        conn.execute('DROP TABLE contexts_old')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+
+
+def index_key(index):
+    """Canonical text form of a context index."""
+    return json.dumps(sorted(dict(index).items()), separators=(',', ':'))
+
+
+def dumps(ctx):
+    return json.dumps(context_to_dict(ctx), separators=(',', ':'))
+
+
+class Pending:
+    """A row saved in a batch, written when the batch ends."""
+    __slots__ = ('ctx_id', 'rule_name', 'idx', 'active', 'doc', 'new',
+                 'owner')
+
+    def __init__(self, ctx, new, owner):
+        self.ctx_id = ctx.id
+        self.rule_name = ctx.rule_name
+        self.idx = index_key(ctx.index)
+        self.new = new
+        self.owner = owner
+        self.set(ctx)
+
+    def set(self, ctx):
+        self.active = int(is_active_ctx(ctx))
+        self.doc = dumps(ctx)
+
+
+class SqliteDatabase:
+    # Every worker of a prefork server counts the whole table
+    shared = True
+
+    def __init__(self, path=None):
+        path = path or sqlite_path()
+        # Shared by the server threads, statements are serialized
+        self.conn = sqlite3.connect(str(path), isolation_level=None,
+                                    check_same_thread=False)
+        self.lock = threading.RLock()
+        # Nothing is kept in memory, so there is nothing to checkpoint
+        self.checkpoint = None
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        upgrade_schema(self.conn)
+        for statement in SCHEMA:
+            self.conn.execute(statement)
+        # Rows saved in batches by (rule_name, id), in the order of the
+        # saves, and the latest of them by (rule_name, index key)
+        self.pending = {}
+        self.pending_idx = {}
+        self.local = threading.local()
+
+    def find_by_idx(self, rule_name, index):
+        key = rule_name, index_key(index)
+        with self.lock:
+            ctx_id = self.pending_idx.get(key)
+            if ctx_id is not None:
+                entry = self.pending[rule_name, ctx_id]
+                doc = entry.doc if entry.active else None
+            else:
+                row = self.conn.execute(SELECT_ACTIVE, key).fetchone()
+                doc = row and row[0]
+        if doc is None:
+            return None
+        return init_contexts([json.loads(doc)])[0]
+
+    def save(self, ctx):
+        owner = getattr(self.local, 'owner', None)
+        with self.lock:
+            if not ctx.id:
+                return self._insert(ctx, owner)
+            entry = self.pending.get((ctx.rule_name, ctx.id))
+            if entry is None and owner is None:
+                self._update(ctx)
+            elif entry is None:
+                self._check_active(ctx)
+                self._add_pending(Pending(ctx, False, owner))
+            else:
+                entry.set(ctx)
+                if entry.owner is not owner:
+                    # Saved outside the batch of the row, written now
+                    self._write([entry])
+        if not is_active_ctx(ctx):
+            metrics.CONTEXTS_COMPLETED.inc()
+        return ctx
+
+    def read_complete(self, rule_name, ctx_id):
+        with self.lock:
+            entry = self.pending.get((rule_name, ctx_id))
+            if entry is not None:
+                doc = None if entry.active else entry.doc
+            else:
+                args = (rule_name, ctx_id)
+                row = self.conn.execute(SELECT_COMPLETE, args).fetchone()
+                doc = row and row[0]
+        if doc is None:
+            return None
+        return init_contexts([json.loads(doc)])[0]
+
+    def iter_complete(self):
+        for row in self.conn.execute(ITER_COMPLETE):
+            yield init_contexts([json.loads(row[0])])[0]
+
+    def stats(self):
+        """Count of the active contexts."""
+        with self.lock:
+            active = self.conn.execute(COUNT_ACTIVE).fetchone()[0]
+            for entry in self.pending.values():
+                if entry.new:
+                    active += entry.active
+                elif not entry.active:
+                    active -= 1
+        return {'active': active}
+
+    def rules(self):
+        rule_docs = load_rule_docs()
+        return init_rules(rule_docs)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Group the saves of the thread into one transaction, written when
+        the batch ends and dropped if it fails. Saves are visible to every
+        thread meanwhile, and no lock is held between them, so the batch
+        never waits for other threads with the database locked. A save of
+        another thread to a row of the batch writes the row at once.
+        """
+        if getattr(self.local, 'owner', None) is not None:
+            yield  # nested
+            return
+        owner = self.local.owner = object()
+        try:
+            yield
+        except BaseException:
+            with self.lock:
+                self._drop(self._owned(owner))
+            raise
+        else:
+            with self.lock:
+                self._write(self._owned(owner))
+        finally:
+            self.local.owner = None
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.conn.close()
+
+    def _insert(self, ctx, owner=None):
+        for _ in range(10):
+            if self.find_by_idx(ctx.rule_name, ctx.index):
+                raise DatabaseError('The context already exists')
+            ctx = ctx._replace(id=random_id())
+            if owner is not None:
+                if self._id_taken(ctx):
+                    continue
+                self._add_pending(Pending(ctx, True, owner))
+                return ctx
+            try:
+                self._insert_row(ctx)
+            except sqlite3.IntegrityError:
+                continue  # id collision or a concurrent insert
+            return ctx
+        raise DatabaseError('Unable to save the context')
+
+    def _insert_row(self, ctx):
+        args = (ctx.id, ctx.rule_name, index_key(ctx.index),
+                int(is_active_ctx(ctx)), dumps(ctx))
+        self.conn.execute(INSERT, args)
+
+    def _update(self, ctx):
+        args = (int(is_active_ctx(ctx)), dumps(ctx), ctx.id,
+                ctx.rule_name, index_key(ctx.index))
+        if self.conn.execute(UPDATE, args).rowcount != 1:
+            raise DatabaseError('Untracked context #{}'.format(ctx.id))
+
+    def _check_active(self, ctx):
+        args = (ctx.rule_name, index_key(ctx.index))
+        row = self.conn.execute(SELECT_ACTIVE_ID, args).fetchone()
+        if row is None or row[0] != ctx.id:
+            raise DatabaseError('Untracked context #{}'.format(ctx.id))
+
+    def _id_taken(self, ctx):
+        key = ctx.rule_name, ctx.id
+        return key in self.pending or \
+            self.conn.execute(SELECT_ID, key).fetchone() is not None
+
+    def _add_pending(self, entry):
+        self.pending[entry.rule_name, entry.ctx_id] = entry
+        self.pending_idx[entry.rule_name, entry.idx] = entry.ctx_id
+
+    def _owned(self, owner):
+        return [entry for entry in self.pending.values()
+                if entry.owner is owner]
+
+    def _write(self, entries):
+        """Write the pending rows in one transaction."""
+        if not entries:
+            return
+        self.conn.execute('BEGIN')
+        try:
+            for entry in entries:
+                if entry.new:
+                    self.conn.execute(INSERT, (
+                        entry.ctx_id, entry.rule_name, entry.idx,
+                        entry.active, entry.doc))
+                elif self.conn.execute(UPDATE, (
+                        entry.active, entry.doc, entry.ctx_id,
+                        entry.rule_name, entry.idx)).rowcount != 1:
+                    raise DatabaseError(
+                        'Untracked context #{}'.format(entry.ctx_id))
+        except BaseException as err:
+            self.conn.execute('ROLLBACK')
+            self._drop(entries)
+            if isinstance(err, sqlite3.IntegrityError):
+                raise DatabaseError('Unable to save the batch: {}'.format(
+                    err))
+            raise
+        self.conn.execute('COMMIT')
+        self._drop(entries)
+
+    def _drop(self, entries):
+        for entry in entries:
+            del self.pending[entry.rule_name, entry.ctx_id]
+            key = entry.rule_name, entry.idx
+            if self.pending_idx.get(key) == entry.ctx_id:
+                del self.pending_idx[key]
+
+
+def import_context_files(db):
+    """
+    Copy contexts from the context/*.json files into the SQLite database.
+    Contexts already present are skipped, so it is safe to run again.
+    """
+    count = 0
+    db.conn.execute('BEGIN')
+    try:
+        docs = chain(load_context_docs(), iter_complete_docs())
+        for doc in docs:
+            ctx = init_contexts([doc])[0]
+            try:
+                db._insert_row(ctx)
+            except sqlite3.IntegrityError:
+                log.warning('Skip context #{} of {}'.format(
+                    ctx.id, ctx.rule_name))
+                continue
+            count += 1
+    except Exception:
+        db.conn.execute('ROLLBACK')
+        raise
+    db.conn.execute('COMMIT')
+    return count
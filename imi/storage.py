@@ -1,53 +1,182 @@
+import os
+import sys
 import json
 import yaml
 import random
+import hashlib
 import string
+import functools
+import contextlib
+import threading
 
 from pathlib import Path
-from . import config
+from . import config, metrics
 from .context import Context, Rule, Node, NodeResult, NodeState
+from .query import compile as compile_query
+from .index import compile as compile_index
+from .loader import load_documents
+from .layout import (ctx_parts, lookup_parts, ctx_file, open_ctx_file,
+                     remove_file, remove_active, has_flat_files,
+                     context_entries, context_paths, is_sharded,
+                     parse_fname)
 
-__all__ = ['Database', 'DatabaseError']
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:  # PyYAML built without libyaml
+    from yaml import SafeLoader as YamlLoader
+
+__all__ = ['Database', 'DatabaseError', 'open_database']
 
 IDABC = string.ascii_lowercase + string.digits
+# Stores able to list the files changed since a checkpoint
+CHECKPOINT_STORAGE = ('files', 'compact')
+
+# Parsed rule files by path, with the mtime and size they were read at
+# and the digest of their content. A file which fails to parse keeps
+# its error in place of the documents.
+RULE_FILES = {}
+RULE_FILES_LOCK = threading.Lock()
+# Count of rule files parsed, changes when a rule file does
+RULE_FILES_VERSION = 0
+
+
+def rules_path():
+    return Path(config.DATADIR).joinpath('rules')
+
+
+def list_rule_files():
+    return list(rules_path().glob('*.y*ml'))
+
+
+def load_rule_file(path):
+    """
+    Rule documents of a file, parsed again only when its content changes.
+    A file with a new mtime or size is read and hashed, so a touched file
+    keeps its documents. The same list is returned while the file does
+    not change, it is shared and must not be changed.
+    """
+    global RULE_FILES_VERSION
+    stat = path.stat()
+    stamp = stat.st_mtime_ns, stat.st_size
+    with RULE_FILES_LOCK:
+        cached = RULE_FILES.get(path)
+    if not cached or cached[0] != stamp:
+        data = path.read_bytes()
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        if cached and cached[1] == digest:
+            rules = cached[2]
+        else:
+            try:
+                rules = parse_rule_file(path, data.decode('utf-8'))
+            except Exception as err:
+                rules = err
+            with RULE_FILES_LOCK:
+                RULE_FILES_VERSION += 1
+        cached = stamp, digest, rules
+        with RULE_FILES_LOCK:
+            RULE_FILES[path] = cached
+    if isinstance(cached[2], Exception):
+        raise cached[2].with_traceback(None)
+    return cached[2]
+
+
+def evict_rule_files(paths):
+    """Forget the parsed rule files which are not in paths any more."""
+    with RULE_FILES_LOCK:
+        for path in set(RULE_FILES).difference(paths):
+            del RULE_FILES[path]
+
+
+def rules_version():
+    return RULE_FILES_VERSION
+
+
+def parse_rule_file(path, text):
+    rules = []
+    for doc in yaml.load_all(text, Loader=YamlLoader):
+        doc['name'] = '{}-{}'.format(path.stem, doc['name'])
+        rules.append(doc)
+    return rules
 
 
 def load_rule_docs():
-    rules_dir = Path(config.DATADIR).joinpath('rules')
     rules = []
-    for path in rules_dir.glob('*.y*ml'):
-        with path.open(encoding='utf-8') as stream:
-            for doc in yaml.load_all(stream.read()):
-                doc['name'] = '{}-{}'.format(path.stem, doc['name'])
-                rules.append(doc)
+    paths = list_rule_files()
+    for path in paths:
+        rules.extend(load_rule_file(path))
+    evict_rule_files(paths)
     return rules
 
 
+def load_context_doc(path):
+    with path.open(encoding='utf-8') as stream:
+        return json.load(stream)
+
+
 def load_context_docs():
-    contexts = []
+    # Only active contexts, completed ones are read on demand
+    paths = context_paths(ctx_db_path(), '.json')
+    return load_documents(paths, what='contexts')
 
-    def loadctx(path):
-        with path.open(encoding='utf-8') as stream:
-            ctx = json.load(stream)
-            contexts.append(ctx)
-    ctxdir = ctx_db_path()
-    for path in ctxdir.glob('*.json'):
-        loadctx(path)
-    for path in ctxdir.joinpath('complete').glob('*.json'):
-        loadctx(path)
-    return contexts
+
+def scan_context_files(path, suffix, stamp):
+    """
+    Rule names and ids of the context files of the directory, ids are
+    unique per rule only, and the files modified at the stamp or later.
+    """
+    ids = set()
+    changed = []
+    # scandir skips the pattern matching and path objects of glob
+    for entry in context_entries(path, suffix, stat=True):
+        ids.add(parse_fname(entry.name))
+        if entry.stat().st_mtime >= stamp:
+            changed.append(Path(entry.path))
+    return ids, changed
+
+
+def iter_complete_docs():
+    for path in context_paths(ctx_db_path().joinpath('complete'), '.json'):
+        yield load_context_doc(path)
+
+
+def read_complete_doc(rule_name, ctx_id):
+    fname = get_fname(Context(ctx_id, rule_name, None, ()))
+    path = ctx_db_path()
+    for parts in lookup_parts(rule_name, ctx_id, fname):
+        try:
+            return load_context_doc(path.joinpath('complete', *parts))
+        except FileNotFoundError:
+            continue
+    return None
+
+
+@functools.lru_cache(maxsize=4096)
+def compile_shared(key):
+    return compile_query(json.loads(key))
+
+
+def shared_criteria(criteria):
+    """
+    Compiled criteria shared by every node with equal criteria,
+    contexts reference the same object as their rule nodes.
+    """
+    try:
+        key = json.dumps(criteria, sort_keys=True)
+    except (TypeError, ValueError):
+        return compile_query(criteria)
+    return compile_shared(key)
 
 
 def init_rules(rule_docs):
     rules = []
     for doc in rule_docs:
         name = doc['name']
-        crit = doc['criteria']
-        index = doc['index']
+        crit = compile_query(doc['criteria'])
+        index = compile_index(doc['index'])
         nodes = []
         for node_doc in doc['nodes']:
-            url = node_doc['url']
-            exit_crit = node_doc['exit']
+            url = sys.intern(node_doc['url'])
+            exit_crit = shared_criteria(node_doc['exit'])
             node_result = NodeResult(exit_crit, None)
             node = Node(url, NodeState.initial, 0, node_result)
             nodes.append(node)
@@ -88,10 +217,10 @@ def node_to_dict(node):
 
 
 def dict_to_node(data):
-    url = data['url']
+    url = sys.intern(data['url'])
     state = NodeState[data['state']]
     calls_count = data['calls_count']
-    result_crit = data['result']['criteria']
+    result_crit = shared_criteria(data['result']['criteria'])
     result_msg = data['result'].get('message')
     result = NodeResult(result_crit, result_msg)
     return Node(url, state, calls_count, result)
@@ -105,6 +234,10 @@ def is_complete_ctx(ctx):
     return not is_active_ctx(ctx)
 
 
+def ctx_key(ctx):
+    return ctx.rule_name, frozenset(ctx.index)
+
+
 def random_id():
     return ''.join(random.choice(IDABC) for _ in range(8))
 
@@ -130,15 +263,54 @@ def ctx_db_path():
     return Path(config.DATADIR).joinpath('context')
 
 
-def save_new_ctx(ctx):
+def sync_paths(paths):
+    """Flush files or directories to disk."""
+    for path in paths:
+        fd = os.open(str(path), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def sync_contexts(path, ctxs, fname):
+    """
+    Flush the files of contexts and the directories, which hold their
+    new names and the removal of completed ones, to disk.
+    """
+    complete = path.joinpath('complete')
+    files = []
+    dirs = [path, complete]
+    for ctx in ctxs:
+        file = ctx_file(path, ctx, fname)
+        if is_complete_ctx(ctx):
+            dirs.append(file.parent)
+            file = ctx_file(complete, ctx, fname)
+        files.append(file)
+        dirs.append(file.parent)
+        if is_sharded():
+            dirs.append(file.parent.parent)  # holds a new shard
+    sync_paths(files + list(dict.fromkeys(dirs)))
+
+
+def save_new_ctx(ctx, mixed=False):
+    """
+    Write a context to a new file. With flat files left the id must not
+    be taken by one of them either, see imi.layout.
+    """
     tries_count = 0
     ctxpath = ctx_db_path()
     if is_complete_ctx(ctx):
         ctxpath = ctxpath.joinpath('complete')
     while tries_count < 10:
         ctx = ctx._replace(id=random_id())
+        fname = get_fname(ctx)
+        if mixed and ctxpath.joinpath(fname).exists():
+            tries_count += 1
+            continue
+        path = ctxpath.joinpath(*ctx_parts(ctx.rule_name, ctx.id, fname))
         try:
-            with ctxpath.joinpath(get_fname(ctx)).open('x') as stream:
+            with open_ctx_file(path, 'x') as stream:
                 json.dump(context_to_dict(ctx), stream, indent='  ')
         except FileExistsError:
             tries_count += 1
@@ -147,14 +319,15 @@ def save_new_ctx(ctx):
     raise DatabaseError('Unable to save the context')
 
 
-def save_ctx(ctx):
+def save_ctx(ctx, mixed=False):
     path = ctx_db_path()
-    filename = get_fname(ctx)
     if is_complete_ctx(ctx):
-        path.joinpath(filename).unlink()
+        remove_active(path, ctx, get_fname, mixed)
         path = path.joinpath('complete')
-    with path.joinpath(filename).open('w') as stream:
+    with open_ctx_file(ctx_file(path, ctx, get_fname), 'w') as stream:
         json.dump(context_to_dict(ctx), stream, indent='  ')
+    if mixed:
+        remove_file(ctx_file(path, ctx, get_fname, 'flat'))
 
 
 class DatabaseError(Exception):
@@ -165,48 +338,209 @@ class DatabaseError(Exception):
         return self.msg
 
 
-class Database:
+class FileStore:
+    """
+    Keeps every context in its own JSON file, completed contexts
+    are moved to the context/complete directory. See imi.layout for
+    the layout of the files.
+    """
 
     def __init__(self):
         ensure_ctx_dir()
-        ctxs = load_context_docs()
+        # Sharded layout with flat files left to migrate
+        self.mixed = False
+
+    def load(self):
+        self.mixed = has_flat_files(ctx_db_path(), '.json')
+        return load_context_docs()
+
+    def changed_since(self, stamp):
+        """
+        Rule names and ids of the active contexts and the documents of
+        the ones changed since the stamp. A completed context is no
+        longer active.
+        """
+        self.mixed = has_flat_files(ctx_db_path(), '.json')
+        ids, changed = scan_context_files(ctx_db_path(), '.json', stamp)
+        return ids, load_documents(changed, what='contexts')
+
+    def iter_complete(self):
+        return iter_complete_docs()
+
+    def read_complete(self, rule_name, ctx_id):
+        return read_complete_doc(rule_name, ctx_id)
+
+    def create(self, ctx):
+        return save_new_ctx(ctx, self.mixed)
+
+    def update(self, ctx):
+        save_ctx(ctx, self.mixed)
+
+    def sync(self, ctxs):
+        sync_contexts(ctx_db_path(), ctxs, get_fname)
+
+    @contextlib.contextmanager
+    def batch(self):
+        yield
+
+    def wait(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def open_store():
+    if config.STORAGE == 'files':
+        store = FileStore()
+    elif config.STORAGE == 'compact':
+        from .compact import CompactStore
+        store = CompactStore()
+    elif config.STORAGE == 'journal':
+        from .journal import JournalStore
+        return JournalStore()
+    else:
+        raise DatabaseError('Unknown storage {}'.format(config.STORAGE))
+    if config.WRITE_BEHIND:
+        from .writer import WriteBehindStore
+        store = WriteBehindStore(store)
+    return store
+
+
+def open_database(owns=None, tag=None):
+    """
+    Database of the configured storage. Checkpoints of the files stores
+    are kept per tag, workers of a server use their partition.
+    """
+    if config.STORAGE == 'sqlite':
+        from .sqlite import SqliteDatabase
+        return SqliteDatabase()
+    checkpoint = None
+    if config.CHECKPOINT_INTERVAL and config.STORAGE in CHECKPOINT_STORAGE:
+        from .checkpoint import checkpoint_path
+        checkpoint = checkpoint_path(tag)
+    return Database(owns=owns, checkpoint=checkpoint)
+
+
+class Database:
+    """
+    Active contexts in memory on top of a store. The owns(rule_name, index)
+    predicate limits them to the partition of a server worker.
+    """
+    # The stats count the contexts of this process only
+    shared = False
+
+    def __init__(self, store=None, owns=None, checkpoint=None):
+        self.store = store if store is not None else open_store()
+        self.active = {}
+        self.changes = 0
+        # Saves of different contexts may come from several threads
+        self.lock = threading.Lock()
+        # Checkpoint file, its contexts not decoded yet by key
+        self.checkpoint = checkpoint
+        self.snapshot = None
+        self.pending = {}
+        if checkpoint:
+            from .checkpoint import read_checkpoint
+            self.snapshot = read_checkpoint(checkpoint)
+        if self.snapshot:
+            ctxs = self._replay(self.snapshot)
+        else:
+            ctxs = self.store.load()
         ctxs = init_contexts(ctxs)
-        self.contexts = ctxs
-        self._set_active()
+        for ctx in ctxs:
+            if owns and not owns(ctx.rule_name, ctx.index):
+                continue
+            if is_active_ctx(ctx):
+                key = ctx_key(ctx)
+                self.pending.pop(key, None)
+                self.active.setdefault(key, ctx)
+
+    def _replay(self, snapshot):
+        """
+        Take the contexts of the checkpoint, return the documents of the
+        active contexts saved after it.
+        """
+        ids, changed = self.store.changed_since(snapshot.stamp)
+        self.pending = dict(item for item in snapshot.contexts.items()
+                            if (item[0][0], item[1][0]) in ids)
+        return changed
 
     def find_by_idx(self, rule_name, index):
-        candidates = self._get_canditates(rule_name, index)
-        return next(iter(candidates), None)
+        key = (rule_name, frozenset(index))
+        ctx = self.active.get(key)
+        if ctx is None and self.pending:
+            with self.lock:
+                ctx = self._restore(key)
+        return ctx
+
+    def _restore(self, key):
+        """Decode the checkpointed context of the key on first use."""
+        ctx = self.active.get(key)
+        entry = self.pending.pop(key, None)
+        if ctx is None and entry is not None:
+            ctx = init_contexts([self.snapshot.read(entry)])[0]
+            self.active[key] = ctx
+        return ctx
 
     def save(self, ctx):
+        with self.lock:
+            ctx = self._save(ctx)
+        # Write-behind saves wait out of the lock to share a commit
+        self.store.wait()
+        return ctx
+
+    def _save(self, ctx):
+        key = ctx_key(ctx)
         is_new = not ctx.id
-        exists = self.find_by_idx(ctx.rule_name, ctx.index)
+        exists = self.active.get(key)
+        if exists is None and self.pending:
+            exists = self._restore(key)
         if is_new and exists:
             raise DatabaseError('The context already exists')
         if not is_new and not exists:
             raise DatabaseError('Untracked context #{}'.format(ctx.id))
         if is_new:
-            ctx = save_new_ctx(ctx)
-            self.contexts.append(ctx)
+            ctx = self.store.create(ctx)
+        else:
+            self.store.update(ctx)
+        if is_active_ctx(ctx):
+            self.active[key] = ctx
         else:
-            save_ctx(ctx)
-        self._set_active()
+            self.active.pop(key, None)
+            metrics.CONTEXTS_COMPLETED.inc()
+        self.changes += 1
         return ctx
 
+    def stats(self):
+        """Count of the active contexts."""
+        return {'active': len(self.active) + len(self.pending)}
+
+    def write_checkpoint(self):
+        from .checkpoint import write_checkpoint
+        return write_checkpoint(self.checkpoint, self)
+
     def rules(self):
         rule_docs = load_rule_docs()
         return init_rules(rule_docs)
 
-    def _set_active(self):
-        self.active = []
-        for ctx in self.contexts:
-            if is_active_ctx(ctx):
-                self.active.append(ctx)
+    def read_complete(self, rule_name, ctx_id):
+        doc = self.store.read_complete(rule_name, ctx_id)
+        return init_contexts([doc])[0] if doc else None
 
-    def _get_canditates(self, rule_name, idx):
-        for ctx in self.active:
-            if rule_name != ctx.rule_name:
-                continue
-            if idx != ctx.index:
-                continue
-            yield ctx
+    def iter_complete(self):
+        for doc in self.store.iter_complete():
+            yield init_contexts([doc])[0]
+
+    def batch(self):
+        """Group the saves of several messages into one flush."""
+        return self.store.batch()
+
+    def flush(self):
+        self.store.flush()
+
+    def close(self):
+        self.store.close()
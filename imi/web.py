@@ -1,28 +1,64 @@
+import json
 import logging
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer
 from bottle import Bottle, request, response
 from pathlib import Path
-from .storage import Database
+from urllib.request import urlopen
+from .storage import open_database
 from .context import ContextAgent, ContextError
-from .config import DATADIR
-from . import handlers
+from .partition import PartitionAgent
+from .reload import RuleReloader
+from .checkpoint import Checkpointer
+from .config import (DATADIR, RULES_RELOAD_INTERVAL, CHECKPOINT_INTERVAL,
+                     HTTP_READ_TIMEOUT)
+from . import handlers, metrics
 
-__all__ = ['init_app']
+__all__ = ['init_app', 'ThreadingWSGIServer']
 
 log = logging.getLogger(__name__)
 
 
 def setup_routing(bottle_app, app):
     bottle_app.route('/invoke', ['POST'], app.invoke)
+    bottle_app.route('/invoke/batch', ['POST'], app.invoke_batch)
+    bottle_app.route('/metrics', ['GET'], app.show_metrics)
+    bottle_app.route('/metrics/local', ['GET'], app.show_local_metrics)
 
 
-def init_app():
+def init_app(partition=None):
     handlers.register()
     bottle_app = Bottle(catchall=False)
-    app = WebApp()
+    app = WebApp(partition)
     setup_routing(bottle_app, app)
+    bottle_app.install(ClosePlugin(app))
     return bottle_app
 
 
+class ClosePlugin:
+    """Closes the WebApp with the Bottle application."""
+    name = 'imi-close'
+    api = 2
+
+    def __init__(self, app):
+        self.app = app
+
+    def apply(self, callback, route):
+        return callback
+
+    def close(self):
+        self.app.close()
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    """
+    WSGIRef server handling every request in its own thread. Closing
+    the server waits for the requests in progress.
+    """
+    daemon_threads = False
+    block_on_close = True
+
+
 def ensuredatadir():
     try:
         Path(DATADIR).mkdir()
@@ -37,18 +73,80 @@ def force_json():
         request.environ['CONTENT_TYPE'] = json_type
 
 
+def parse_batch(text):
+    """Messages of a JSON array or of newline delimited JSON."""
+    try:
+        doc = json.loads(text)
+    except ValueError:
+        return [json.loads(line) for line in text.splitlines()
+                if line.strip()]
+    return doc if isinstance(doc, list) else [doc]
+
+
+def peer_metrics(partition):
+    """Metric snapshots of the other workers, read on their own sockets."""
+    snapshots = []
+    for number, (host, port) in enumerate(partition.addresses):
+        if number == partition.number:
+            continue
+        url = 'http://{}:{}/metrics/local'.format(host, port)
+        try:
+            with urlopen(url, timeout=HTTP_READ_TIMEOUT) as res:
+                snapshots.append(json.loads(res.read().decode('utf-8')))
+        except (OSError, ValueError) as err:
+            log.warning('Cannot read the metrics of worker {}: {}'.format(
+                number, err))
+    return snapshots
+
+
+def close_app(app):
+    for thread in app.threads:
+        thread.stop()
+    log.info('Writing the pending contexts')
+    app.db.flush()
+    app.db.close()
+
+
 class WebApp:
 
-    def __init__(self):
+    def __init__(self, partition=None):
         ensuredatadir()
-        self.db = Database()
-        self.ctx = ContextAgent(self.db.rules(), self.db)
+        self.partition = partition
+        if partition is None:
+            self.db = open_database()
+            self.ctx = ContextAgent(self.db.rules(), self.db)
+        else:
+            tag = '{}-of-{}'.format(partition.number, partition.count)
+            self.db = open_database(partition.owns, tag)
+            self.ctx = PartitionAgent(self.db.rules(), self.db, partition)
+        # The workers add up their gauges, one of them counts a storage
+        # they share
+        if partition is None or partition.number == 0 or not self.db.shared:
+            metrics.CONTEXTS.set_function(self.db.stats)
+        else:
+            metrics.CONTEXTS.set_function(None)
+        self.threads = []
+        if RULES_RELOAD_INTERVAL:
+            self.threads.append(RuleReloader(self.ctx, RULES_RELOAD_INTERVAL))
+        if self.db.checkpoint:
+            self.threads.append(Checkpointer(self.db, CHECKPOINT_INTERVAL))
+        for thread in self.threads:
+            thread.start()
+
+    def close(self):
+        """Stop the background threads, write the saves still queued."""
+        close_app(self)
 
     def invoke(self):
+        with metrics.REQUEST_SECONDS.labels('/invoke').time():
+            return self.invoke_message()
+
+    def invoke_message(self):
         force_json()
         log.info('Received a message')
 
         def handle_error(err):
+            metrics.REQUEST_ERRORS.labels('/invoke').inc()
             response.status = 400
             return {'error': str(err)}
         try:
@@ -58,3 +156,49 @@ class WebApp:
         except ValueError as err:
             res = handle_error(err)
         return res
+
+    def invoke_batch(self):
+        with metrics.REQUEST_SECONDS.labels('/invoke/batch').time():
+            return self.invoke_messages()
+
+    def invoke_messages(self):
+        log.info('Received a batch of messages')
+        errors = metrics.REQUEST_ERRORS.labels('/invoke/batch')
+        try:
+            messages = parse_batch(request.body.read().decode('utf-8'))
+        except ValueError as err:
+            errors.inc()
+            response.status = 400
+            return {'error': str(err)}
+        results = []
+        with self.db.batch():
+            for message in messages:
+                try:
+                    res = self.ctx.apply_message(message)
+                except ContextError as err:
+                    errors.inc()
+                    res = {'error': str(err)}
+                except ValueError as err:
+                    errors.inc()
+                    res = {'error': str(err)}
+                except Exception as err:
+                    # Earlier messages are applied already, the client
+                    # gets a result for every message
+                    log.exception('Failed to apply a message')
+                    errors.inc()
+                    res = {'error': str(err)}
+                results.append(res)
+        response.content_type = 'application/json'
+        return json.dumps(results)
+
+    def show_metrics(self):
+        """Metrics of the server, added up over the workers."""
+        snapshots = ()
+        if self.partition is not None:
+            snapshots = peer_metrics(self.partition)
+        response.content_type = 'text/plain; version=0.0.4'
+        return metrics.render(snapshots)
+
+    def show_local_metrics(self):
+        response.content_type = 'application/json'
+        return json.dumps(metrics.snapshot())
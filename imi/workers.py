@@ -0,0 +1,178 @@
+"""
+Persistent workers for command:// nodes.
+
+A command opts in by being listed in config.COMMAND_WORKERS with its
+pool size. It is started once as `<command> -` with IMI_WORKER=1 in the
+environment and must answer with a {"ready": true} line. Then it gets
+one JSON message per line on stdin and writes one JSON line with the
+result to stdout for each of them. Commands which do not complete the
+handshake are run one-shot per message as before.
+"""
+
+import os
+import json
+import queue
+import logging
+import threading
+import subprocess
+from . import config
+
+__all__ = ['WorkerManager', 'WorkerError']
+
+log = logging.getLogger(__name__)
+
+READY = {'ready': True}
+
+
+class WorkerError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+
+class ProtocolError(WorkerError):
+    pass
+
+
+class Worker:
+
+    def __init__(self, path, start_timeout):
+        self.path = path
+        env = dict(os.environ, IMI_WORKER='1')
+        self.proc = subprocess.Popen([str(path), '-'], env=env,
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE)
+        self.lines = queue.Queue()
+        reader = threading.Thread(target=self._read)
+        reader.daemon = True
+        reader.start()
+        try:
+            ready = json.loads(self._readline(start_timeout).decode('utf-8'))
+        except (WorkerError, ValueError) as err:
+            self.kill()
+            raise ProtocolError('{} is not a worker: {}'.format(path, err))
+        if ready != READY:
+            self.kill()
+            raise ProtocolError('{} is not a worker'.format(path))
+
+    def call(self, data, timeout):
+        try:
+            self.proc.stdin.write(data.rstrip(b'\n') + b'\n')
+            self.proc.stdin.flush()
+        except OSError as err:
+            self.kill()
+            raise WorkerError('{} failed: {}'.format(self.path, err))
+        return self._readline(timeout)
+
+    def alive(self):
+        return self.proc.poll() is None
+
+    def kill(self):
+        if self.alive():
+            self.proc.kill()
+        self.proc.wait()
+        self.proc.stdin.close()
+        self.proc.stdout.close()
+
+    def _read(self):
+        try:
+            for line in self.proc.stdout:
+                self.lines.put(line)
+        except ValueError:
+            pass  # stdout closed by kill()
+        self.lines.put(None)
+
+    def _readline(self, timeout):
+        try:
+            line = self.lines.get(timeout=timeout)
+        except queue.Empty:
+            self.kill()
+            raise WorkerError('{} timed out'.format(self.path))
+        if line is None:
+            self.kill()
+            raise WorkerError('{} exited'.format(self.path))
+        return line
+
+
+class CommandPool:
+
+    def __init__(self, path, size, timeout, start_timeout):
+        self.path = path
+        self.timeout = timeout
+        self.start_timeout = start_timeout
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+
+    def call(self, data):
+        if not self.slots.acquire(timeout=self.timeout):
+            raise WorkerError('{} has no free workers'.format(self.path))
+        try:
+            worker = self._get()
+            out = worker.call(data, self.timeout)
+            self.idle.put(worker)
+            return out
+        finally:
+            self.slots.release()
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().kill()
+            except queue.Empty:
+                break
+
+    def _get(self):
+        while True:
+            try:
+                worker = self.idle.get_nowait()
+            except queue.Empty:
+                return Worker(self.path, self.start_timeout)
+            if worker.alive():
+                return worker
+            log.warning('Restart crashed worker {}'.format(self.path))
+            worker.kill()
+
+
+class WorkerManager:
+
+    def __init__(self, sizes=None, timeout=None, start_timeout=None):
+        if sizes is None:
+            sizes = config.COMMAND_WORKERS
+        self.sizes = sizes
+        self.timeout = timeout or config.COMMAND_TIMEOUT
+        self.start_timeout = start_timeout or config.COMMAND_START_TIMEOUT
+        self.pools = {}
+        self.oneshot = set()
+        self.lock = threading.Lock()
+
+    def call(self, command, path, data):
+        """
+        Pass data to a persistent worker of the command and return its
+        output, or None if the command has to be run one-shot.
+        """
+        if not self.sizes.get(command) or command in self.oneshot:
+            return None
+        try:
+            return self._get_pool(command, path).call(data)
+        except ProtocolError as err:
+            log.warning('{}, fall back to one-shot mode'.format(err))
+            self.oneshot.add(command)
+            return None
+
+    def close(self):
+        with self.lock:
+            for pool in self.pools.values():
+                pool.close()
+            self.pools.clear()
+
+    def _get_pool(self, command, path):
+        with self.lock:
+            pool = self.pools.get(command)
+            if pool is None:
+                size = self.sizes[command]
+                pool = CommandPool(path, size, self.timeout,
+                                   self.start_timeout)
+                self.pools[command] = pool
+        return pool
@@ -0,0 +1,225 @@
+"""
+Write-behind of context saves for the files and compact storage.
+
+WriteBehindStore queues the updates of contexts by id and a writer
+thread writes them in rounds, so several saves of a context between two
+rounds cost a single write. New contexts are still written at once,
+creating the file reserves their id. config.WRITE_BEHIND sets the
+durability of a save:
+
+none     written by the writer every WRITE_BEHIND_INTERVAL seconds,
+         flushing to disk is left to the operating system
+batched  written and synced to disk every WRITE_BEHIND_INTERVAL seconds
+strict   a save returns once written and synced, saves waiting at the
+         same time share a round (group commit). Within Database.batch()
+         the saves of a thread wait once, at the end of the batch.
+
+A context failing to write is retried in the next rounds. The strict
+saves of it keep waiting for the retry: the step is applied in memory
+already, so the save does not fail unless the context is dropped on
+close.
+"""
+
+import logging
+import threading
+import contextlib
+from concurrent.futures import Future
+from . import config
+from .context import clone_nodes
+from .storage import DatabaseError
+
+__all__ = ['WriteBehindStore']
+
+log = logging.getLogger(__name__)
+
+DURABILITY = ('none', 'batched', 'strict')
+
+
+def snapshot(ctx):
+    """The agent goes on changing the nodes, write them as saved."""
+    return ctx._replace(nodes=clone_nodes(ctx.nodes))
+
+
+class WriteBehindStore:
+
+    def __init__(self, store, durability=None, interval=None):
+        if durability is None:
+            durability = config.WRITE_BEHIND
+        if durability not in DURABILITY:
+            raise DatabaseError('Unknown durability {}'.format(durability))
+        if interval is None:
+            interval = config.WRITE_BEHIND_INTERVAL
+        self.store = store
+        self.durability = durability
+        self.interval = interval
+        # Rule name and id of a context to the latest snapshot, whether
+        # it is still to be written and the futures of strict saves
+        # waiting for it, ids are unique per rule only
+        self.queue = {}
+        self.flushes = []
+        self.closed = False
+        self.cond = threading.Condition()
+        # Futures of the strict saves of the thread and its batch depth
+        self.local = threading.local()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def load(self):
+        return self.store.load()
+
+    def changed_since(self, stamp):
+        return self.store.changed_since(stamp)
+
+    def iter_complete(self):
+        self.flush()
+        return self.store.iter_complete()
+
+    def read_complete(self, rule_name, ctx_id):
+        self.flush()
+        return self.store.read_complete(rule_name, ctx_id)
+
+    def create(self, ctx):
+        ctx = self.store.create(ctx)
+        if self.durability != 'none':
+            self._queue(snapshot(ctx), False)  # only to be synced
+        return ctx
+
+    def update(self, ctx):
+        self._queue(snapshot(ctx), True)
+
+    @contextlib.contextmanager
+    def batch(self):
+        self.local.depth = getattr(self.local, 'depth', 0) + 1
+        try:
+            yield
+        finally:
+            self.local.depth -= 1
+            self.wait()
+
+    def wait(self):
+        """
+        Wait until the strict saves of the thread are synced. Database
+        calls it once its lock is released, so saves of other threads
+        join the same round.
+        """
+        if getattr(self.local, 'depth', 0):
+            return
+        futures = getattr(self.local, 'futures', None)
+        self.local.futures = []
+        for future in futures or ():
+            future.result()
+
+    def flush(self):
+        """Wait until the saves queued so far are written."""
+        future = Future()
+        with self.cond:
+            if self.closed:
+                return
+            self.flushes.append(future)
+            self.cond.notify()
+        future.result()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.thread.join()
+        self.store.close()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not (self.queue or self.flushes or self.closed):
+                    self.cond.wait()
+                if self.durability != 'strict' and not self.flushes and \
+                        not self.closed:
+                    # Saves of the interval are written together,
+                    # flushes and close cut the wait short
+                    self.cond.wait(self.interval)
+                batch, self.queue = self.queue, {}
+                flushes, self.flushes = self.flushes, []
+                closed = self.closed
+            failed = self.write(batch)
+            for future in flushes:
+                future.set_result(None)
+            if failed:
+                self.retry(failed)
+            if closed and not batch:
+                return
+
+    def write(self, batch):
+        """
+        Write a round, complete the strict saves of the contexts written.
+        Return the contexts not written with their saves, to be retried.
+        """
+        errors = {}
+        for key, (ctx, write, _) in batch.items():
+            if not write:
+                continue
+            try:
+                self.store.update(ctx)
+            except Exception as err:
+                log.exception('Failed to write context #{}'.format(ctx.id))
+                errors[key] = err
+        synced = [ctx for key, (ctx, _, _) in batch.items()
+                  if key not in errors]
+        if self.durability != 'none' and synced:
+            try:
+                self.store.sync(synced)
+            except Exception as err:
+                log.exception('Failed to sync {} contexts'.format(
+                    len(synced)))
+                errors.update((key, err) for key in batch
+                              if key not in errors)
+        for key, (_, _, futures) in batch.items():
+            if key not in errors:
+                for future in futures:
+                    future.set_result(None)
+        return dict((key, batch[key]) for key in errors)
+
+    def retry(self, failed):
+        """
+        Queue the contexts not written again, unless saved meanwhile, and
+        hold the next round for an interval not to spin on a failing disk.
+        """
+        with self.cond:
+            if self.closed:
+                log.error('Dropped {} contexts not written on close'.format(
+                    len(failed)))
+                for _, _, futures in failed.values():
+                    for future in futures:
+                        future.set_exception(DatabaseError(
+                            'The context was not written before close'))
+                return
+            for key, (ctx, write, futures) in failed.items():
+                queued = self.queue.get(key)
+                if queued:
+                    self.queue[key] = (queued[0], write or queued[1],
+                                       futures + queued[2])
+                else:
+                    self.queue[key] = ctx, write, futures
+            self.cond.wait(self.interval)
+
+    def _queue(self, ctx, write):
+        future = Future() if self.durability == 'strict' else None
+        with self.cond:
+            if self.closed:
+                raise DatabaseError('The storage is closed')
+            idle = not self.queue
+            key = ctx.rule_name, ctx.id
+            queued = self.queue.get(key)
+            futures = []
+            if queued:
+                write = write or queued[1]
+                futures = queued[2]
+            if future:
+                futures.append(future)
+            self.queue[key] = ctx, write, futures
+            if idle or future:
+                self.cond.notify()
+        if future:
+            futures = getattr(self.local, 'futures', None)
+            if futures is None:
+                futures = self.local.futures = []
+            futures.append(future)
@@ -36,6 +36,7 @@ setup(
     install_requires=requirements,
     license="MPL-2.0",
     zip_safe=False,
+    python_requires='>=3.7',
     keywords='imi',
     classifiers=[
         'Development Status :: 1 - Planning',
@@ -43,7 +44,7 @@ setup(
         'Intended Audience :: Healthcare Industry',
         'Intended Audience :: System Administrators',
         'License :: OSI Approved :: Mozilla Public License 2.0 (MPL 2.0)',
-        'Programming Language :: Python :: 3.4',
+        'Programming Language :: Python :: 3.7',
         'Programming Language :: Python :: Implementation :: CPython'
     ],
     entry_points=entrypoints,
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+
+import socket
+import asyncio
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from unittest.mock import Mock, patch
+from urllib.error import HTTPError, URLError
+
+from imi.aio import (AsyncContextAgent, AsyncPoolManager,
+                     invoke_service_async)
+from imi.context import Rule, Node, ContextError, NodeResult, NodeState
+from imi.index import extract as extract_index
+
+__all__ = ['TestAsyncContextAgent', 'TestInvokeServiceAsync']
+
+
+def create_rules():
+    node1 = Node('http://example.com/service1',
+                 NodeState.initial, 0,
+                 NodeResult({'e': 'f'}, None))
+    node2 = Node('http://example.com/service2',
+                 NodeState.initial, 0,
+                 NodeResult({'g': 'h'}, None))
+    rule = Rule('rule1', {'a': 'b'}, ('c',), (node1, node2))
+    return (rule,)
+
+
+class TestAsyncContextAgent(unittest.TestCase):
+
+    def setUp(self):
+        self.database = Mock()
+        self.agent = AsyncContextAgent(create_rules(), self.database)
+        self.addCleanup(self.agent.close)
+        self.contexts = {}
+
+        def find(rule_name, idx):
+            return self.contexts.get(idx)
+
+        def save(ctx):
+            self.contexts[ctx.index] = ctx
+
+        self.database.find_by_idx.side_effect = find
+        self.database.save.side_effect = save
+
+        invoke = patch('imi.aio.invoke_service_async')
+        self.addCleanup(invoke.stop)
+        self.invoke = invoke.start()
+
+        async def echo(url, payload, executor=None, pools=None):
+            await asyncio.sleep(0)
+            return payload
+        self.invoke.side_effect = echo
+
+    def apply(self, *messages):
+        async def apply_all():
+            calls = [self.agent.apply_message(msg) for msg in messages]
+            return await asyncio.gather(*calls)
+        return asyncio.run(apply_all())
+
+    def test_context_init(self):
+        msg = {'a': 'b', 'c': 'd'}
+        self.assertEqual([msg], self.apply(msg))
+        ctx = self.contexts[extract_index(msg, ('c',))]
+        self.assertEqual(NodeState.current, ctx.nodes[0].state)
+        self.assertEqual(1, ctx.nodes[0].calls_count)
+        rule_node = self.agent.rules[0].nodes[0]
+        self.assertEqual(NodeState.initial, rule_node.state)
+
+    def test_context_whole_chain(self):
+        msg = {'a': 'b', 'c': 'd', 'e': 'f', 'g': 'h'}
+        self.apply(msg)
+        ctx = self.contexts[extract_index(msg, ('c',))]
+        for node in ctx.nodes:
+            self.assertEqual(NodeState.passed, node.state)
+            self.assertEqual(msg, node.result.message)
+
+    def test_same_context_serialized(self):
+        msgs = [{'a': 'b', 'c': 'd', 'n': num} for num in range(3)]
+        self.apply(*msgs)
+        self.assertEqual(1, len(self.contexts))
+        self.assertEqual(3, self.database.save.call_count)
+        ctx = self.contexts[extract_index(msgs[0], ('c',))]
+        self.assertEqual(3, ctx.nodes[0].calls_count)
+        self.assertEqual({}, self.agent.locks)
+
+    def test_context_rule_not_found_error(self):
+        with self.assertRaisesRegex(ContextError, 'Cannot find a rule'):
+            self.apply({'a': 'z'})
+
+    def tearDown(self):
+        pass
+
+
+class EchoHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_POST(self):
+        data = self.rfile.read(int(self.headers['Content-Length']))
+        if self.path == '/wait':
+            self.server.barrier.wait()
+        self.send_response(404 if self.path == '/missed' else 200)
+        self.send_header('Content-Type', 'application/json')
+        if self.path == '/chunked':
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for chunk in (data[:1], data[1:]):
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+            self.wfile.write(b'0\r\n\r\n')
+            return
+        if self.path == '/close':
+            self.send_header('Connection', 'close')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class EchoServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+    # Room for the connections of the concurrent calls
+    request_queue_size = 100
+
+
+class TestInvokeServiceAsync(unittest.TestCase):
+
+    def setUp(self):
+        self.server = EchoServer(('127.0.0.1', 0), EchoHandler)
+        self.server.connections = 0
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  args=(0.05,))
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:{}/'.format(self.server.server_port)
+
+    def test_http(self):
+        res = asyncio.run(invoke_service_async(self.url + '?x=1', {'a': 1}))
+        self.assertEqual({'a': 1}, res)
+
+    def call_pooled(self, path, count=2):
+        async def call_all():
+            pools = AsyncPoolManager()
+            try:
+                for num in range(count):
+                    res = await invoke_service_async(
+                        self.url + path, {'a': num}, pools=pools)
+                    self.assertEqual({'a': num}, res)
+            finally:
+                pools.close()
+        asyncio.run(call_all())
+
+    def test_keep_alive(self):
+        self.call_pooled('')
+        self.assertEqual(1, self.server.connections)
+
+    def test_connection_close(self):
+        self.call_pooled('close')
+        self.assertEqual(2, self.server.connections)
+
+    def test_chunked(self):
+        self.call_pooled('chunked')
+        self.assertEqual(1, self.server.connections)
+
+    def test_concurrent(self):
+        # More calls in progress at a time than the node threads
+        count = 80
+        self.server.barrier = threading.Barrier(count, timeout=10)
+
+        async def call_all():
+            pools = AsyncPoolManager(size=4)
+            try:
+                calls = [invoke_service_async(self.url + 'wait', {'a': num},
+                                              pools=pools)
+                         for num in range(count)]
+                return await asyncio.gather(*calls)
+            finally:
+                pools.close()
+        res = asyncio.run(call_all())
+        self.assertEqual([{'a': num} for num in range(count)], res)
+
+    def test_http_error(self):
+        with self.assertRaises(HTTPError) as err:
+            asyncio.run(invoke_service_async(self.url + 'missed', {}))
+        self.assertEqual(404, err.exception.code)
+
+    def test_connection_refused(self):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            url = 'http://127.0.0.1:{}/'.format(sock.getsockname()[1])
+        with self.assertRaises(URLError):
+            asyncio.run(invoke_service_async(url, {}))
+
+    @patch('imi.aio.invoke_service')
+    def test_custom_scheme(self, invoke_service):
+        invoke_service.return_value = {'b': 'c'}
+        res = asyncio.run(invoke_service_async('noop://test', {'a': 'b'}))
+        self.assertEqual({'b': 'c'}, res)
+        invoke_service.assert_called_once_with('noop://test', {'a': 'b'})
+
+    @patch('imi.aio.invoke_service')
+    def test_executor(self, invoke_service):
+        invoke_service.return_value = {'b': 'c'}
+        with ThreadPoolExecutor(1) as executor:
+            res = asyncio.run(invoke_service_async('noop://test', {'a': 1},
+                                                   executor))
+        self.assertEqual({'b': 'c'}, res)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
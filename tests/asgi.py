@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+import json
+import asyncio
+import unittest
+from unittest.mock import patch, Mock
+
+import imi.asgi
+import imi.context
+
+__all__ = ['TestAsgiApp']
+
+
+def call(app, method, path, body=b''):
+    scope = {'type': 'http', 'method': method, 'path': path}
+    chunks = [{'type': 'http.request', 'body': body[:1], 'more_body': True},
+              {'type': 'http.request', 'body': body[1:]}]
+    sent = []
+
+    async def receive():
+        return chunks.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(app(scope, receive, send))
+    return sent[0]['status'], json.loads(sent[1]['body'].decode('utf-8'))
+
+
+class TestAsgiApp(unittest.TestCase):
+
+    def setUp(self):
+        ensuredatadir = patch('imi.asgi.ensuredatadir')
+        ctx = patch('imi.asgi.AsyncContextAgent')
+        db = patch('imi.asgi.open_database')
+        reloader = patch('imi.asgi.RuleReloader')
+        checkpointer = patch('imi.asgi.Checkpointer')
+        for patcher in (ensuredatadir, ctx, db, reloader, checkpointer):
+            self.addCleanup(patcher.stop)
+        self.ensuredatadir = ensuredatadir.start()
+        self.ctx = ctx.start()
+        self.db = db.start()
+        self.reloader = reloader.start()
+        self.checkpointer = checkpointer.start()
+        self.app = imi.asgi.AsgiApp()
+        self.apply_message = Mock()
+
+        async def apply_message(message):
+            return self.apply_message(message)
+        self.app.ctx.apply_message = apply_message
+
+    def test__init__(self):
+        self.ensuredatadir.assert_called_once_with()
+        ctx_args = self.db.return_value.rules.return_value, self.app.db
+        self.ctx.assert_called_once_with(*ctx_args)
+
+    def test_invoke(self):
+        self.apply_message.return_value = {'b': 'c'}
+        status, res = call(self.app, 'POST', '/invoke', b'{"a": "b"}')
+        self.assertEqual(200, status)
+        self.assertEqual({'b': 'c'}, res)
+        self.apply_message.assert_called_once_with({'a': 'b'})
+
+    def test_invoke_context_error(self):
+        err = imi.context.ContextError('test error')
+        self.apply_message.side_effect = err
+        status, res = call(self.app, 'POST', '/invoke', b'{}')
+        self.assertEqual(400, status)
+        self.assertEqual('test error', res['error'])
+
+    def test_invoke_value_error(self):
+        status, res = call(self.app, 'POST', '/invoke', b'not json')
+        self.assertEqual(400, status)
+        self.assertIn('error', res)
+
+    def test_not_found(self):
+        status, _ = call(self.app, 'POST', '/other')
+        self.assertEqual(404, status)
+
+    def test_method_not_allowed(self):
+        status, _ = call(self.app, 'GET', '/invoke')
+        self.assertEqual(405, status)
+
+    def test_metrics(self):
+        self.db.return_value.stats.return_value = {'active': 1}
+        scope = {'type': 'http', 'method': 'GET', 'path': '/metrics'}
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        asyncio.run(self.app(scope, None, send))
+        self.assertEqual(200, sent[0]['status'])
+        self.assertIn(b'imi_contexts{state="active"} 1', sent[1]['body'])
+
+    def test_lifespan(self):
+        messages = [{'type': 'lifespan.startup'},
+                    {'type': 'lifespan.shutdown'}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message['type'])
+
+        asyncio.run(self.app({'type': 'lifespan'}, receive, send))
+        expected = ['lifespan.startup.complete', 'lifespan.shutdown.complete']
+        self.assertEqual(expected, sent)
+        self.app.ctx.close.assert_called_once_with()
+        self.checkpointer.return_value.stop.assert_called_once_with()
+        self.app.db.flush.assert_called_once_with()
+        self.app.db.close.assert_called_once_with()
+
+    def tearDown(self):
+        pass
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -12,7 +12,7 @@ from unittest.mock import patch, call, sentinel, Mock
 from imi.bin import imi
 from imi.config import WEB_HOST, WEB_PORT
 
-__all__ = ['TestMainServer', 'TestMainMessage']
+__all__ = ['TestMainServer', 'TestMainMessage', 'TestMainStorage']
 
 
 class TestMainServer(unittest.TestCase):
@@ -35,11 +35,27 @@ class TestMainServer(unittest.TestCase):
         expected = call(self.pidfile).start().call_list()
         self.assertEqual(expected, self.deamon.mock_calls)
 
+    @patch('imi.bin.imi.signal')
     @patch('imi.bin.imi.run_server')
-    def test_main_start(self, run_server):
+    def test_main_start(self, run_server, signal):
         sys.argv = shlex.split('imi start')
         imi.main()
-        run_server.assert_called_once_with()
+        run_server.assert_called_once_with(1)
+        signal.signal.assert_called_once_with(signal.SIGTERM,
+                                              imi.exit_on_term)
+
+    @patch('imi.bin.imi.signal', Mock())
+    @patch('imi.bin.imi.run_server')
+    def test_main_start_workers(self, run_server):
+        sys.argv = shlex.split('imi start --workers 4')
+        imi.main()
+        run_server.assert_called_once_with(4)
+
+    @patch('imi.prefork.Master')
+    def test_run_server_workers(self, master):
+        imi.run_server(4)
+        master.assert_called_once_with(4)
+        master.return_value.run.assert_called_once_with()
 
     def test_main_stop(self):
         sys.argv = shlex.split('imi stop')
@@ -53,6 +69,12 @@ class TestMainServer(unittest.TestCase):
         expected = call(self.pidfile).restart().call_list()
         self.assertEqual(expected, self.deamon.mock_calls)
 
+    def test_main_restart_workers(self):
+        sys.argv = shlex.split('imi restart --workers 4')
+        imi.main()
+        expected = call(self.pidfile).reload().call_list()
+        self.assertEqual(expected, self.deamon.mock_calls)
+
     @patch('imi.bin.imi.log')
     def test_main_exception(self, log):
         try:
@@ -128,10 +150,79 @@ class TestMainMessage(unittest.TestCase):
         res = imi.invoke({'test': 'message'})
         self.assertEqual({'test': 'result'}, res)
 
+    @patch('imi.ingest.Ingest')
+    def test_main_ingest(self, ingest):
+        args = self.parser.return_value.parse_args.return_value
+        args.command = 'ingest'
+        args.concurrency = 8
+        args.batch_size = 50
+        ingest.return_value.run.return_value = {'messages': 1, 'errors': 0}
+        with patch('sys.stdout', new_callable=io.StringIO):
+            imi.main()
+        ingest.assert_called_once_with(8, 50)
+        ingest.return_value.run.assert_called_once_with(args.message)
+
+    @patch('imi.ingest.Ingest')
+    def test_main_ingest_errors(self, ingest):
+        args = self.parser.return_value.parse_args.return_value
+        args.command = 'ingest'
+        args.concurrency = 1
+        args.batch_size = 1
+        ingest.return_value.run.return_value = {'messages': 2, 'errors': 1}
+        with patch('sys.stdout', new_callable=io.StringIO):
+            with self.assertRaises(SystemExit):
+                imi.main()
+
+    def test_positive_int(self):
+        self.assertEqual(2, imi.positive_int('2'))
+        with self.assertRaises(argparse.ArgumentTypeError):
+            imi.positive_int('0')
+
     def tearDown(self):
         pass
 
 
+class TestMainStorage(unittest.TestCase):
+
+    @patch('imi.bin.imi.logging.basicConfig', Mock())
+    @patch('imi.journal.compact')
+    def test_main_compact(self, compact):
+        compact.return_value = 2
+        sys.argv = shlex.split('imi compact')
+        imi.main()
+        compact.assert_called_once_with()
+
+    @patch('imi.bin.imi.logging.basicConfig', Mock())
+    @patch('imi.sqlite.import_context_files')
+    @patch('imi.sqlite.SqliteDatabase')
+    def test_main_import(self, database, import_files):
+        import_files.return_value = 2
+        sys.argv = shlex.split('imi import')
+        imi.main()
+        import_files.assert_called_once_with(database.return_value)
+        database.return_value.close.assert_called_once_with()
+
+    @patch('imi.bin.imi.logging.basicConfig', Mock())
+    @patch('imi.compact.convert')
+    def test_main_convert(self, convert):
+        convert.return_value = 2
+        sys.argv = shlex.split('imi convert')
+        imi.main()
+        sys.argv = shlex.split('imi convert --to json')
+        imi.main()
+        self.assertEqual([call('compact'), call('json')], convert.mock_calls)
+
+    @patch('imi.bin.imi.logging.basicConfig', Mock())
+    @patch('imi.layout.migrate')
+    def test_main_migrate(self, migrate):
+        migrate.return_value = 2
+        sys.argv = shlex.split('imi migrate')
+        imi.main()
+        sys.argv = shlex.split('imi migrate --layout flat')
+        imi.main()
+        self.assertEqual([call('sharded'), call('flat')], migrate.mock_calls)
+
+
 class TestServerDaemon(unittest.TestCase):
 
     def setUp(self):
@@ -139,9 +230,11 @@ class TestServerDaemon(unittest.TestCase):
 
     @patch('imi.bin.imi.LOGFILE', 'test.log')
     @patch('imi.bin.imi.logging.basicConfig')
+    @patch('imi.bin.imi.signal', Mock())
+    @patch('imi.bin.imi.WSGIRefServer')
     @patch('imi.bin.imi.run_bottle')
     @patch('imi.bin.imi.init_app')
-    def test_run(self, init_app, run_bottle, log_config):
+    def test_run(self, init_app, run_bottle, server, log_config):
         daemon = imi.ServerDaemon('/test/path/test.pid')
         app = init_app.return_value
         daemon.run()
@@ -149,9 +242,34 @@ class TestServerDaemon(unittest.TestCase):
             'filename': 'test.log',
             'level': logging.INFO,
             'format': '%(message)s'}
-        run_bottle.assert_called_once_with(app, host=WEB_HOST, port=WEB_PORT)
+        server.assert_called_once_with(
+            host=WEB_HOST, port=WEB_PORT,
+            server_class=imi.ThreadingWSGIServer)
+        run_bottle.assert_called_once_with(app, server=server.return_value)
         log_config.assert_called_once_with(**log_args)
         self.assertIs(sys.excepthook, imi.handle_exception)
+        server.return_value.srv.server_close.assert_called_once_with()
+        app.close.assert_called_once_with()
+
+    @patch('imi.bin.imi.signal', Mock())
+    @patch('imi.bin.imi.run_bottle')
+    @patch('imi.bin.imi.init_app')
+    def test_run_server_exit(self, init_app, run_bottle):
+        run_bottle.side_effect = SystemExit(0)
+        with self.assertRaises(SystemExit):
+            imi.run_server()
+        init_app.return_value.close.assert_called_once_with()
+
+    @patch('imi.bin.imi.WEB_THREADED', False)
+    @patch('imi.bin.imi.signal', Mock())
+    @patch('imi.bin.imi.WSGIRefServer')
+    @patch('imi.bin.imi.run_bottle')
+    @patch('imi.bin.imi.init_app')
+    def test_run_server_single_thread(self, init_app, run_bottle, server):
+        imi.run_server()
+        server.assert_called_once_with(host=WEB_HOST, port=WEB_PORT)
+        run_bottle.assert_called_once_with(init_app.return_value,
+                                           server=server.return_value)
 
     def tearDown(self):
         pass
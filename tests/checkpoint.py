@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+import os
+import json
+import time
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch, Mock
+
+from imi.context import NodeState
+from imi.storage import Database, FileStore, context_to_dict, get_fname
+from imi.checkpoint import (Checkpointer, read_checkpoint, checkpoint_path,
+                            HEADER)
+from tests.helpers import new_ctx, complete
+
+__all__ = ['TestCheckpoint', 'TestCheckpointer']
+
+RULE = {
+    'name': 'rule1',
+    'nodes': [
+        {'url': 'http://example.com/1', 'exit': {'c': 'd'}},
+        {'url': 'http://example.com/2', 'exit': {'e': 'f'}}
+    ]
+}
+
+
+class TestCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = Path(tmp.name)
+        for patcher in (patch('imi.config.DATADIR', tmp.name),
+                        patch('imi.checkpoint.load_rule_docs',
+                              Mock(return_value=[RULE]))):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.checkpoint = checkpoint_path()
+        self.db = self.open()
+        self.saved = [self.db.save(new_ctx(index)) for index in 'xyz']
+
+    def open(self):
+        return Database(FileStore(), checkpoint=self.checkpoint)
+
+    def age(self):
+        """Date the context files before the checkpoint."""
+        past = time.time() - 100
+        for path in self.path.glob('context/**/*.json'):
+            os.utime(str(path), (past, past))
+
+    def test_restore(self):
+        self.age()
+        self.assertEqual(3, self.db.write_checkpoint())
+        db = self.open()
+        self.assertEqual({}, db.active)
+        self.assertEqual(3, len(db.pending))
+        self.assertEqual({'active': 3}, db.stats())
+        ctx = db.find_by_idx('rule1', {('a', 'y')})
+        self.assertEqual(context_to_dict(self.saved[1]), context_to_dict(ctx))
+        self.assertIs(ctx, db.find_by_idx('rule1', {('a', 'y')}))
+        self.assertEqual(2, len(db.pending))
+        self.assertIsNone(db.find_by_idx('rule1', {('a', 'w')}))
+
+    def test_replay(self):
+        self.age()
+        self.db.write_checkpoint()
+        ctx_x, ctx_y, _ = self.saved
+        ctx_x.nodes[0].state = NodeState.passed
+        ctx_x.nodes[1].state = NodeState.current
+        self.db.save(ctx_x)
+        complete(ctx_y)
+        self.db.save(ctx_y)
+        ctx_w = self.db.save(new_ctx('w'))
+        db = self.open()
+        self.assertEqual(1, len(db.pending))
+        found = db.find_by_idx('rule1', {('a', 'x')})
+        self.assertEqual(context_to_dict(ctx_x), context_to_dict(found))
+        self.assertIsNone(db.find_by_idx('rule1', {('a', 'y')}))
+        self.assertEqual(ctx_w.id, db.find_by_idx('rule1', {('a', 'w')}).id)
+        self.assertIsNotNone(db.find_by_idx('rule1', {('a', 'z')}))
+
+    def test_replay_rule_id(self):
+        self.age()
+        self.db.write_checkpoint()
+        ctx = self.saved[0]
+        complete(ctx)
+        self.db.save(ctx)
+        other = new_ctx('w')._replace(id=ctx.id, rule_name='rule2')
+        path = self.path.joinpath('context', get_fname(other))
+        path.write_text(json.dumps(context_to_dict(other)))
+        db = self.open()
+        self.assertIsNone(db.find_by_idx('rule1', {('a', 'x')}))
+        self.assertIsNotNone(db.find_by_idx('rule2', {('a', 'w')}))
+
+    def test_save_pending(self):
+        self.age()
+        self.db.write_checkpoint()
+        db = self.open()
+        ctx = self.saved[0]
+        complete(ctx)
+        db.save(ctx)
+        self.assertEqual(2, len(db.pending))
+        self.assertEqual({'active': 2}, db.stats())
+
+    def test_rewrite(self):
+        self.age()
+        self.db.write_checkpoint()
+        db = self.open()
+        db.find_by_idx('rule1', {('a', 'x')})
+        self.assertEqual(3, db.write_checkpoint())
+        db = self.open()
+        self.assertEqual(3, len(db.pending))
+        for ctx in self.saved:
+            found = db.find_by_idx(ctx.rule_name, ctx.index)
+            self.assertEqual(context_to_dict(ctx), context_to_dict(found))
+
+    @patch('imi.checkpoint.log', Mock())
+    def test_broken(self):
+        self.checkpoint.write_bytes(b'\0' * HEADER.size)
+        self.assertIsNone(read_checkpoint(self.checkpoint))
+        self.checkpoint.write_bytes(b'')
+        self.assertIsNone(read_checkpoint(self.checkpoint))
+        db = self.open()
+        self.assertEqual(3, len(db.active))
+
+
+class TestCheckpointer(unittest.TestCase):
+
+    def test_write(self):
+        db = Mock(changes=0)
+        checkpointer = Checkpointer(db, 1)
+        self.assertFalse(checkpointer.write())
+        db.changes = 2
+        self.assertTrue(checkpointer.write())
+        db.write_checkpoint.assert_called_once_with()
+        self.assertFalse(checkpointer.write())
+
+    def test_run(self):
+        db = Mock(changes=0)
+        checkpointer = Checkpointer(db, 0.01)
+        checkpointer.start()
+        db.changes = 1
+        time.sleep(0.1)
+        checkpointer.stop()
+        db.write_checkpoint.assert_called_once_with()
+
+
+if __name__ == '__main__':
+    unittest.main()
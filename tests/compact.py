@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+import os
+import json
+import time
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+from imi.context import NodeState
+from imi.storage import DatabaseError, context_to_dict
+from imi.compact import (CompactStore, convert, encode, decode, rule_table,
+                         HEADER, MAGIC, TABLES)
+from tests.helpers import new_ctx, complete
+
+__all__ = ['TestCodec', 'TestCompactStore', 'TestConvert']
+
+RULE = {
+    'name': 'rule1',
+    'nodes': [
+        {'url': 'http://example.com/1', 'exit': {'c': 'd'}},
+        {'url': 'http://example.com/2', 'exit': {'e': 'f'}}
+    ]
+}
+
+
+class TestCodec(unittest.TestCase):
+
+    def setUp(self):
+        self.table = rule_table(RULE)
+        self.tables = dict([self.table])
+
+    def test_roundtrip(self):
+        ctx = new_ctx()
+        doc = decode(encode(ctx, self.table), self.tables)
+        self.assertEqual(context_to_dict(ctx), doc)
+
+    def test_no_table(self):
+        ctx = new_ctx()
+        doc = decode(encode(ctx), {})
+        self.assertEqual(context_to_dict(ctx), doc)
+
+    def test_compact(self):
+        ctx = new_ctx()
+        data = encode(ctx, self.table)
+        self.assertLess(len(data), len(encode(ctx)))
+        self.assertNotIn(b'example.com', data)
+        self.assertLess(len(data), len(json.dumps(context_to_dict(ctx))))
+
+    def test_changed_node(self):
+        ctx = new_ctx(url='http://example.com/other')
+        data = encode(ctx, self.table)
+        self.assertIn(b'example.com/other', data)
+        self.assertEqual(context_to_dict(ctx), decode(data, self.tables))
+
+    def test_unknown_table(self):
+        data = encode(new_ctx(), self.table)
+        with self.assertRaisesRegex(DatabaseError, 'Unknown rule table'):
+            decode(data, {})
+
+    def test_header(self):
+        data = encode(new_ctx(), self.table)
+        self.assertEqual(HEADER.pack(MAGIC, 1), data[:HEADER.size])
+        with self.assertRaisesRegex(DatabaseError, 'version 2'):
+            decode(HEADER.pack(MAGIC, 2) + data[HEADER.size:], self.tables)
+        with self.assertRaisesRegex(DatabaseError, 'Not a compact'):
+            decode(b'{"id": "abc"}', self.tables)
+
+
+class TestCompactStore(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = Path(tmp.name)
+        self.rules = [RULE]
+        load_rule_docs = patch('imi.compact.load_rule_docs')
+        self.addCleanup(load_rule_docs.stop)
+        load_rule_docs.start().side_effect = lambda: self.rules
+        self.store = CompactStore(self.path)
+        self.store.load()
+
+    def reopen(self):
+        store = CompactStore(self.path)
+        return store, store.load()
+
+    def test_create(self):
+        ctx = self.store.create(new_ctx())
+        self.assertRegex(ctx.id, '[a-z0-9]{8}')
+        _, docs = self.reopen()
+        self.assertEqual([context_to_dict(ctx)], docs)
+
+    def test_update(self):
+        ctx = self.store.create(new_ctx())
+        ctx.nodes[0].state = NodeState.passed
+        ctx.nodes[1].state = NodeState.current
+        self.store.update(ctx)
+        _, docs = self.reopen()
+        self.assertEqual([context_to_dict(ctx)], docs)
+
+    def test_complete(self):
+        ctx = self.store.create(new_ctx())
+        complete(ctx)
+        self.store.update(ctx)
+        store, docs = self.reopen()
+        self.assertEqual([], docs)
+        doc = store.read_complete('rule1', ctx.id)
+        self.assertEqual(context_to_dict(ctx), doc)
+        self.assertEqual([doc], list(store.iter_complete()))
+        self.assertIsNone(store.read_complete('rule1', 'zyx'))
+
+    def test_rule_changed(self):
+        ctx = self.store.create(new_ctx())
+        self.rules = [dict(RULE, nodes=RULE['nodes'][:1])]
+        _, docs = self.reopen()
+        self.assertEqual([context_to_dict(ctx)], docs)
+        self.assertTrue(self.path.joinpath(TABLES).exists())
+
+    def test_rule_added(self):
+        self.rules = [RULE, dict(RULE, name='rule2')]
+        ctx = self.store.create(new_ctx()._replace(rule_name='rule2'))
+        self.assertIn('rule2', self.store.rules)
+        _, docs = self.reopen()
+        self.assertEqual([context_to_dict(ctx)], docs)
+
+    def test_rule_missing(self):
+        ctxs = [new_ctx()._replace(rule_name='rule2') for _ in range(3)]
+        with patch.object(self.store, 'refresh_rules',
+                          wraps=self.store.refresh_rules) as refresh:
+            self.store.create(ctxs[0])
+            self.store.create(ctxs[1])
+            self.assertEqual(1, refresh.call_count)
+            self.rules = [RULE, dict(RULE, name='rule2')]
+            with patch('imi.compact.rules_version', return_value=-1):
+                self.store.create(ctxs[2])
+            self.assertEqual(2, refresh.call_count)
+        self.assertIn('rule2', self.store.rules)
+
+    def test_changed_since(self):
+        old = self.store.create(new_ctx('x'))
+        past = time.time() - 100
+        os.utime(str(self.path.joinpath('ctx-rule1-{}.ctx'.format(old.id))),
+                 (past, past))
+        ctx = self.store.create(new_ctx('y'))
+        ids, docs = self.store.changed_since(past + 50)
+        self.assertEqual({(old.rule_name, old.id), (ctx.rule_name, ctx.id)},
+                         ids)
+        self.assertEqual([context_to_dict(ctx)], docs)
+
+    @patch('imi.config.CONTEXT_LAYOUT', 'sharded')
+    def test_sharded(self):
+        ctx = self.store.create(new_ctx('x'))
+        done = self.store.create(new_ctx('y'))
+        complete(done)
+        self.store.update(done)
+        fname = 'ctx-rule1-{}.ctx'.format(ctx.id)
+        self.assertTrue(self.path.joinpath('rule1', ctx.id[:2],
+                                           fname).exists())
+        store, docs = self.reopen()
+        self.assertEqual([context_to_dict(ctx)], docs)
+        self.assertEqual(context_to_dict(done),
+                         store.read_complete('rule1', done.id))
+        self.assertEqual(2, convert('json', self.path))
+        self.assertEqual(2, len(list(self.path.glob('*/*/*/*.json')) +
+                                list(self.path.glob('*/*/*.json'))))
+
+
+class TestConvert(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = Path(tmp.name)
+        self.path.joinpath('complete').mkdir()
+        load_rule_docs = patch('imi.compact.load_rule_docs')
+        self.addCleanup(load_rule_docs.stop)
+        load_rule_docs.start().return_value = [RULE]
+
+    def write_json(self, ctx, directory=''):
+        fname = 'ctx-rule1-{}.json'.format(ctx.id)
+        path = self.path.joinpath(directory, fname)
+        path.write_text(json.dumps(context_to_dict(ctx)))
+
+    def test_convert(self):
+        active = new_ctx('x')._replace(id='abc')
+        done = new_ctx('y')._replace(id='def')
+        complete(done)
+        self.write_json(active)
+        self.write_json(done, 'complete')
+        self.assertEqual(2, convert('compact', self.path))
+        self.assertEqual([], list(self.path.glob('**/*.json')))
+        store = CompactStore(self.path)
+        self.assertEqual([context_to_dict(active)], store.load())
+        self.assertEqual(context_to_dict(done),
+                         store.read_complete('rule1', 'def'))
+        self.assertEqual(2, convert('json', self.path))
+        self.assertEqual([], list(self.path.glob('**/*.ctx')))
+        doc = json.loads(self.path.joinpath('ctx-rule1-abc.json').read_text())
+        self.assertEqual(context_to_dict(active), doc)
+
+    def test_convert_unknown(self):
+        with self.assertRaises(DatabaseError):
+            convert('xml', self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 
 import io
+import time
+import threading
 from copy import deepcopy
 
 import unittest
@@ -9,6 +11,7 @@ from unittest.mock import Mock, patch
 from imi.context import (Context, Rule, Node, ContextError,
                          NodeResult, NodeState, ContextAgent)
 from imi.index import extract as extract_index
+from imi.storage import Database
 
 __all__ = ['TestContextAgent']
 
@@ -68,6 +71,18 @@ class TestContextAgent(unittest.TestCase):
         self.assertEqual(NodeState.initial, rule_node.state)
         self.assertEqual(NodeState.current, current.state)
 
+    def test_context_init_shares_rule_data(self):
+        rule = self.agent.rules[0]
+        ctx = self.agent.init_context(rule, frozenset())
+        for rule_node, node in zip(rule.nodes, ctx.nodes):
+            self.assertIsNot(rule_node, node)
+            self.assertIsNot(rule_node.result, node.result)
+            self.assertIs(rule_node.result.criteria, node.result.criteria)
+        ctx.nodes[0].calls_count += 1
+        ctx.nodes[0].result.message = {'a': 'b'}
+        self.assertEqual(0, rule.nodes[0].calls_count)
+        self.assertIsNone(rule.nodes[0].result.message)
+
     def test_context_next_node(self):
         self.msg['g'] = 'h'
         self.ctx = create_context(self.agent.rules[0], self.msg, 1)
@@ -102,6 +117,58 @@ class TestContextAgent(unittest.TestCase):
             return
         self.fail('ContextError not raised')
 
+    def test_set_rules(self):
+        self.ctx = create_context(self.agent.rules[0], self.msg, 1)
+        rules = create_rules()
+        self.agent.set_rules(rules)
+        self.assertIs(rules[0], self.agent.rules[0])
+        self.msg['g'] = 'h'
+        self.agent.apply_message(self.msg)
+        self.assertEqual(NodeState.current, self.ctx.nodes[2].state)
+
+    def test_node_slots(self):
+        node = self.agent.rules[0].nodes[0]
+        self.assertFalse(hasattr(node, '__dict__'))
+        self.assertFalse(hasattr(node.result, '__dict__'))
+
+    def test_context_lock(self):
+        with self.agent.context_lock('rule1', frozenset()):
+            self.assertEqual(1, len(self.agent.locks))
+        self.assertEqual({}, self.agent.locks)
+
+    def test_same_context_serialized(self):
+        store = Mock()
+        store.load.return_value = []
+        store.create.side_effect = lambda ctx: ctx._replace(id='abc')
+        database = Database(store)
+        agent = ContextAgent(create_rules(), database)
+        barrier = threading.Barrier(2)
+        calls = []
+
+        def slow_response(req):
+            calls.append(req)
+            time.sleep(0.05)
+            return io.BytesIO(req.data)
+        errors = []
+
+        def apply():
+            barrier.wait()
+            try:
+                agent.apply_message(dict(self.msg))
+            except Exception as err:
+                errors.append(err)
+        with patch('imi.context.urlopen', side_effect=slow_response):
+            threads = [threading.Thread(target=apply) for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual([], errors)
+        self.assertEqual(2, len(calls))
+        self.assertEqual(1, len(database.active))
+        ctx = next(iter(database.active.values()))
+        self.assertEqual(2, ctx.nodes[0].calls_count)
+
     def tearDown(self):
         pass
 
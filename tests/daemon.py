@@ -148,6 +148,23 @@ class TestDaemon(unittest.TestCase):
         self.daemon.stop.assert_called_once_with()
         self.daemon.start.assert_called_once_with()
 
+    @patch('imi.daemon.os')
+    def test_reload(self, os):
+        open_pid = self.pathlib.Path.return_value.open
+        read_pid = open_pid.return_value.__enter__.return_value.read
+        read_pid.return_value = '12345'
+        self.daemon.start = Mock()
+        self.daemon.reload()
+        os.kill.assert_called_once_with(12345, signal.SIGHUP)
+        self.assertFalse(self.daemon.start.called)
+
+    def test_reload_not_running(self):
+        open_pid = self.pathlib.Path.return_value.open
+        open_pid.side_effect = [FileNotFoundError]
+        self.daemon.start = Mock()
+        self.daemon.reload()
+        self.daemon.start.assert_called_once_with()
+
     def tearDown(self):
         pass
 
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+import unittest
+
+from imi.context import Rule
+from imi.dispatch import RuleDispatcher
+
+__all__ = ['TestRuleDispatcher']
+
+
+def create_rules():
+    return (
+        Rule('first', {'type': 'a', 'x': {'$exists': True}}, (), ()),
+        Rule('second', {'type': {'$in': ['a', 'b']}}, (), ()),
+        Rule('any', {'y': {'$exists': True}}, (), ()),
+        Rule('third', {'type': 'c'}, (), ()),
+    )
+
+
+class TestRuleDispatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.dispatcher = RuleDispatcher(create_rules())
+
+    def test_key(self):
+        self.assertEqual('type', self.dispatcher.key)
+        self.assertEqual([2], self.dispatcher.wildcard)
+
+    def test_find_first_match(self):
+        rule = self.dispatcher.find({'type': 'a', 'x': 1})
+        self.assertEqual('first', rule.name)
+
+    def test_find_in(self):
+        rule = self.dispatcher.find({'type': 'a'})
+        self.assertEqual('second', rule.name)
+        rule = self.dispatcher.find({'type': 'b'})
+        self.assertEqual('second', rule.name)
+
+    def test_find_keeps_order(self):
+        rule = self.dispatcher.find({'type': 'c', 'y': 1})
+        self.assertEqual('any', rule.name)
+        rule = self.dispatcher.find({'type': 'c'})
+        self.assertEqual('third', rule.name)
+
+    def test_find_list_value(self):
+        rule = self.dispatcher.find({'type': [{'z': 1}, 'c']})
+        self.assertEqual('third', rule.name)
+
+    def test_find_no_field(self):
+        self.assertIsNone(self.dispatcher.find({'x': 1}))
+        self.assertEqual('any', self.dispatcher.find({'y': 1}).name)
+
+    def test_candidates(self):
+        self.assertEqual([0, 1, 2], self.dispatcher.candidates({'type': 'a'}))
+        self.assertEqual([2], self.dispatcher.candidates({'type': 'z'}))
+
+    def test_no_discriminator(self):
+        rules = (Rule('r1', {'a': {'$gt': 1}}, (), ()),
+                 Rule('r2', {}, (), ()))
+        dispatcher = RuleDispatcher(rules)
+        self.assertIsNone(dispatcher.key)
+        self.assertEqual('r1', dispatcher.find({'a': 2}).name)
+        self.assertEqual('r2', dispatcher.find({'a': 0}).name)
+
+    def tearDown(self):
+        pass
+
+
+if __name__ == '__main__':
+    unittest.main()
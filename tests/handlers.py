@@ -2,8 +2,8 @@
 
 import json
 import unittest
-from unittest.mock import patch
-from urllib.request import Request
+from unittest.mock import patch, Mock
+from urllib.request import Request, HTTPHandler
 
 import imi.handlers
 
@@ -29,6 +29,27 @@ class TestCustomHandler(unittest.TestCase):
         res = json.loads(self.handler.command_open(req).read().decode('utf-8'))
         self.assertEqual({'b': 'c'}, res)
 
+    @patch('imi.handlers.subprocess.check_output')
+    def test_command_open_worker(self, check_output):
+        workers = Mock()
+        workers.call.return_value = json.dumps({'b': 'c'}).encode('utf-8')
+        handler = imi.handlers.CustomHandler(workers)
+        data = json.dumps({'a': 'b'}).encode('utf-8')
+        req = Request('command://example', data=data)
+        res = json.loads(handler.command_open(req).read().decode('utf-8'))
+        self.assertEqual({'b': 'c'}, res)
+        self.assertEqual('example', workers.call.call_args[0][0])
+        self.assertFalse(check_output.called)
+
+    @patch('imi.handlers.install_opener')
+    def test_register(self, install_opener):
+        imi.handlers.register()
+        opener = install_opener.call_args[0][0]
+        handlers = [type(handler) for handler in opener.handlers]
+        self.assertIn(imi.handlers.CustomHandler, handlers)
+        self.assertIn(imi.handlers.PooledHTTPHandler, handlers)
+        self.assertNotIn(HTTPHandler, handlers)
+
     def tearDown(self):
         pass
 
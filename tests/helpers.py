@@ -0,0 +1,18 @@
+"""Contexts shared by the storage tests."""
+
+from imi.context import Context, Node, NodeResult, NodeState
+
+__all__ = ['new_ctx', 'complete']
+
+
+def new_ctx(index='z', rule_name='rule1', url='http://example.com/2'):
+    """New context of a rule of two nodes, the first one called once."""
+    node1 = Node('http://example.com/1', NodeState.current, 1,
+                 NodeResult({'c': 'd'}, {'a': index}))
+    node2 = Node(url, NodeState.initial, 0, NodeResult({'e': 'f'}, None))
+    return Context(None, rule_name, frozenset({('a', index)}), [node1, node2])
+
+
+def complete(ctx):
+    for node in ctx.nodes:
+        node.state = NodeState.passed
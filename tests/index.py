@@ -49,7 +49,30 @@ class TestIndex(unittest.TestCase):
     def test_extract_array_sub_path(self):
         idx = ('n.o',)
         res = index.extract(self.document, idx)
-        self.assertTrue(('n.o', None) in res)
+        self.assertTrue(('n.o', 'p') in res)
+
+    def test_extract_array_position(self):
+        idx = ('n.0.o', 'n.1.o', 'n.5.o')
+        res = index.extract(self.document, idx)
+        expected = {('n.0.o', 'p'), ('n.1.o', None), ('n.5.o', None)}
+        self.assertEqual(expected, res)
+
+    def test_extract_array_ambiguous(self):
+        self.document['n'].append({'o': 'x'})
+        with self.assertRaisesRegex(ValueError, 'ambiguous'):
+            index.extract(self.document, ('n.o',))
+        self.document['n'][-1]['o'] = 'p'
+        res = index.extract(self.document, ('n.o',))
+        self.assertEqual({('n.o', 'p')}, res)
+
+    def test_compile(self):
+        extractor = index.compile(['a', 'k.l'])
+        self.assertIsInstance(extractor, index.Extractor)
+        self.assertEqual(('a', 'k.l'), extractor)
+        self.assertIs(extractor, index.compile(extractor))
+        expected = frozenset({('a', 'b'), ('k.l', 'm')})
+        self.assertEqual(expected, extractor(self.document))
+        self.assertEqual(expected, index.extract(self.document, extractor))
 
     def tearDown(self):
         pass
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+import io
+import json
+import threading
+import unittest
+from unittest.mock import Mock, call, patch
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from imi.ingest import Ingest, iter_messages
+
+__all__ = ['TestIterMessages', 'TestIngest']
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        size = int(self.headers['Content-Length'])
+        body = json.loads(self.rfile.read(size).decode('utf-8'))
+        self.server.requests.append((self.path, body))
+        if self.path == '/invoke/batch':
+            result = [{'error': 'bad'} if msg.get('bad') else msg
+                      for msg in body]
+            status = 200
+        else:
+            result = body
+            status = 400 if body.get('bad') else 200
+        data = json.dumps(result).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestIterMessages(unittest.TestCase):
+
+    def test_ndjson(self):
+        stream = io.StringIO('\n{"a": 1}\n\n{"a": 2}\n')
+        self.assertEqual([{'a': 1}, {'a': 2}], list(iter_messages(stream)))
+
+    def test_yaml(self):
+        stream = io.StringIO('a: 1\n---\n---\na: 2\n')
+        self.assertEqual([{'a': 1}, {'a': 2}], list(iter_messages(stream)))
+
+    def test_yaml_streamed(self):
+        stream = io.StringIO('a: 1\n---\na: 2\n')
+        stream.read = Mock(side_effect=stream.read)
+        self.assertEqual([{'a': 1}, {'a': 2}], list(iter_messages(stream)))
+        self.assertNotIn(call(), stream.read.call_args_list)
+
+    def test_empty(self):
+        self.assertEqual([], list(iter_messages(io.StringIO(''))))
+
+
+class TestIngest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.requests = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.port = self.server.server_address[1]
+
+    def stream(self, count, bad=()):
+        lines = [json.dumps({'n': n, 'bad': n in bad}) for n in range(count)]
+        return io.StringIO('\n'.join(lines))
+
+    def test_run(self):
+        ingest = Ingest(3, 1, '127.0.0.1', self.port)
+        res = ingest.run(self.stream(10, bad=[4]))
+        self.assertEqual(10, res['messages'])
+        self.assertEqual(1, res['errors'])
+        paths = set(path for path, _ in self.server.requests)
+        self.assertEqual({'/invoke'}, paths)
+        numbers = sorted(body['n'] for _, body in self.server.requests)
+        self.assertEqual(list(range(10)), numbers)
+
+    def test_run_batch(self):
+        ingest = Ingest(2, 4, '127.0.0.1', self.port)
+        res = ingest.run(self.stream(10, bad=[1, 9]))
+        self.assertEqual(10, res['messages'])
+        self.assertEqual(2, res['errors'])
+        sizes = sorted(len(body) for _, body in self.server.requests)
+        self.assertEqual([2, 4, 4], sizes)
+
+    def test_run_connection_error(self):
+        self.server.shutdown()
+        self.server.server_close()
+        ingest = Ingest(2, 1, '127.0.0.1', self.port)
+        res = ingest.run(self.stream(3))
+        self.assertEqual({'messages': 3, 'errors': 3},
+                         {'messages': res['messages'],
+                          'errors': res['errors']})
+
+    def test_run_not_json(self):
+        stream = io.StringIO('when: 2020-01-01\n---\na: 1\n')
+        ingest = Ingest(1, 1, '127.0.0.1', self.port)
+        res = ingest.run(stream)
+        self.assertEqual(2, res['messages'])
+        self.assertEqual(1, res['errors'])
+
+    @patch('imi.ingest.log', Mock())
+    def test_run_worker_error(self):
+        ingest = Ingest(1, 1, '127.0.0.1', self.port)
+        with patch.object(ingest, 'post', side_effect=RuntimeError):
+            res = ingest.run(self.stream(5))
+        self.assertEqual(5, res['errors'])
+
+    def test_invalid(self):
+        for args in ((0, 1), (1, 0)):
+            with self.assertRaises(ValueError):
+                Ingest(*args)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+from imi.context import NodeState
+from imi.journal import (JournalStore, compact, list_segments,
+                         segment_number, SNAPSHOT, ARCHIVE)
+from tests.helpers import new_ctx, complete
+
+__all__ = ['TestJournalStore', 'TestCompact']
+
+
+def step(ctx):
+    ctx.nodes[0].state = NodeState.passed
+    ctx.nodes[0].calls_count = 1
+    ctx.nodes[0].result.message = {'c': 'd'}
+    ctx.nodes[1].state = NodeState.current
+
+
+class TestJournalStore(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = Path(tmp.name)
+        self.store = JournalStore(self.path, sync_every=0)
+        self.store.load()
+
+    def reopen(self):
+        self.store.close()
+        store = JournalStore(self.path)
+        docs = store.load()
+        self.addCleanup(store.close)
+        return store, docs
+
+    def test_create(self):
+        ctx = self.store.create(new_ctx())
+        self.assertRegex(ctx.id, '[a-z0-9]{8}')
+        _, docs = self.reopen()
+        self.assertEqual(1, len(docs))
+        self.assertEqual(ctx.id, docs[0]['id'])
+        self.assertEqual({'a': 'z'}, docs[0]['index'])
+
+    def test_update(self):
+        ctx = self.store.create(new_ctx())
+        step(ctx)
+        self.store.update(ctx)
+        _, docs = self.reopen()
+        nodes = docs[0]['nodes']
+        self.assertEqual('passed', nodes[0]['state'])
+        self.assertEqual(1, nodes[0]['calls_count'])
+        self.assertEqual({'c': 'd'}, nodes[0]['result']['message'])
+        self.assertEqual('current', nodes[1]['state'])
+        self.assertEqual('http://example.com/2', nodes[1]['url'])
+
+    def test_broken_tail(self):
+        self.store.create(new_ctx())
+        self.store.stream.write('{"op": "upd')
+        segment = self.store.segment
+        store, docs = self.reopen()
+        self.assertEqual(1, len(docs))
+        self.assertEqual([segment + 1], [segment_number(path) for path in
+                                         list_segments(self.path)])
+
+    def test_load_active_only(self):
+        ctx = self.store.create(new_ctx())
+        complete(ctx)
+        self.store.update(ctx)
+        store, docs = self.reopen()
+        self.assertEqual([], docs)
+        docs = list(store.iter_complete())
+        self.assertEqual([ctx.id], [doc['id'] for doc in docs])
+        # Archived on load, not replayed again
+        self.assertTrue(self.path.joinpath(ARCHIVE).exists())
+        self.assertEqual(1, len(list_segments(self.path)))
+
+    def test_segment_rotation(self):
+        self.store.segment_size = 1
+        self.store.create(new_ctx('x'))
+        self.store.create(new_ctx('y'))
+        self.assertEqual(2, len(list_segments(self.path)))
+        _, docs = self.reopen()
+        self.assertEqual(2, len(docs))
+
+    @patch('imi.journal.os.fsync')
+    def test_sync_every(self, fsync):
+        self.store.sync_every = 2
+        self.store.create(new_ctx('x'))
+        self.assertFalse(fsync.called)
+        self.store.create(new_ctx('y'))
+        self.assertEqual(1, fsync.call_count)
+
+    @patch('imi.journal.os.fsync')
+    def test_batch(self, fsync):
+        self.store.sync_every = 1
+        with self.store.batch():
+            with self.store.batch():
+                self.store.create(new_ctx('x'))
+            self.store.create(new_ctx('y'))
+            self.assertFalse(fsync.called)
+        self.assertEqual(1, fsync.call_count)
+
+    @patch('imi.journal.os.fsync')
+    def test_batch_other_thread(self, fsync):
+        self.store.sync_every = 1
+        with self.store.batch():
+            self.store.create(new_ctx('x'))
+            thread = threading.Thread(target=self.store.create,
+                                      args=(new_ctx('y'),))
+            thread.start()
+            thread.join()
+            self.assertEqual(1, fsync.call_count)
+        self.assertEqual(1, fsync.call_count)
+
+    def tearDown(self):
+        self.store.close()
+
+
+class TestCompact(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = Path(tmp.name)
+
+    def test_compact(self):
+        store = JournalStore(self.path, segment_size=1)
+        store.load()
+        ctx = store.create(new_ctx('x'))
+        step(ctx)
+        store.update(ctx)
+        store.create(new_ctx('y'))
+        store.close()
+        self.assertEqual(3, len(list_segments(self.path)))
+        self.assertEqual(2, compact(self.path))
+        self.assertTrue(self.path.joinpath(SNAPSHOT).exists())
+        self.assertEqual(1, len(list_segments(self.path)))
+        store = JournalStore(self.path)
+        docs = dict((doc['id'], doc) for doc in store.load())
+        store.close()
+        self.assertEqual(2, len(docs))
+        self.assertEqual('current', docs[ctx.id]['nodes'][1]['state'])
+
+    def test_compact_archive(self):
+        store = JournalStore(self.path, segment_size=1)
+        store.load()
+        ctx = store.create(new_ctx('x'))
+        complete(ctx)
+        store.update(ctx)
+        store.create(new_ctx('y'))
+        store.close()
+        compact(self.path)
+        self.assertTrue(self.path.joinpath(ARCHIVE).exists())
+        store = JournalStore(self.path)
+        docs = store.load()
+        self.addCleanup(store.close)
+        self.assertEqual(1, len(docs))
+        self.assertEqual(ctx.id, store.read_complete('rule1', ctx.id)['id'])
+        self.assertIsNone(store.read_complete('rule1', 'abc'))
+
+    def test_compact_all(self):
+        store = JournalStore(self.path)
+        store.load()
+        store.create(new_ctx('x'))
+        store.close()
+        self.assertEqual(0, compact(self.path))
+        self.assertEqual(1, compact(self.path, keep_newest=False))
+        self.assertEqual([], list_segments(self.path))
+        store = JournalStore(self.path)
+        self.assertEqual(1, len(store.load()))
+        store.close()
+
+    def test_compact_nothing(self):
+        self.assertEqual(0, compact(self.path))
+
+    def tearDown(self):
+        pass
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+import os
+import time
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+from imi.storage import (Database, DatabaseError, FileStore, context_to_dict,
+                         sync_contexts, get_fname)
+from imi.layout import migrate, parse_fname, context_entries
+from tests.helpers import new_ctx, complete
+
+__all__ = ['TestShardedStore', 'TestMigrate']
+
+
+def sharded(ctx, directory=''):
+    return Path(directory, 'rule1', ctx.id[:2], get_fname(ctx))
+
+
+class LayoutCase(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = Path(tmp.name).joinpath('context')
+        for patcher in (patch('imi.config.DATADIR', tmp.name),
+                        patch('imi.config.CONTEXT_LAYOUT', 'flat')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def files(self):
+        return sorted(str(path.relative_to(self.path))
+                      for path in self.path.glob('**/*.json'))
+
+    def layout(self, layout):
+        patcher = patch('imi.config.CONTEXT_LAYOUT', layout)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class TestShardedStore(LayoutCase):
+
+    def setUp(self):
+        super().setUp()
+        self.layout('sharded')
+        self.db = Database(FileStore())
+
+    def test_save(self):
+        ctx = self.db.save(new_ctx('x'))
+        self.assertEqual([str(sharded(ctx))], self.files())
+        complete(ctx)
+        self.db.save(ctx)
+        self.assertEqual([str(sharded(ctx, 'complete'))], self.files())
+        found = self.db.read_complete('rule1', ctx.id)
+        self.assertEqual(context_to_dict(ctx), context_to_dict(found))
+        self.assertEqual([context_to_dict(ctx)],
+                         [context_to_dict(found)
+                          for found in self.db.iter_complete()])
+
+    def test_load(self):
+        saved = [self.db.save(new_ctx(index)) for index in 'xyz']
+        db = Database(FileStore())
+        self.assertEqual(3, len(db.active))
+        for ctx in saved:
+            found = db.find_by_idx(ctx.rule_name, ctx.index)
+            self.assertEqual(context_to_dict(ctx), context_to_dict(found))
+
+    def test_changed_since(self):
+        old = self.db.save(new_ctx('x'))
+        past = time.time() - 100
+        os.utime(str(self.path.joinpath(sharded(old))), (past, past))
+        ctx = self.db.save(new_ctx('y'))
+        ids, docs = FileStore().changed_since(past + 50)
+        self.assertEqual({(old.rule_name, old.id), (ctx.rule_name, ctx.id)},
+                         ids)
+        self.assertEqual([context_to_dict(ctx)], docs)
+
+    @patch('imi.storage.os.fsync')
+    def test_sync(self, fsync):
+        active = self.db.save(new_ctx('x'))
+        done = self.db.save(new_ctx('y'))
+        complete(done)
+        self.db.save(done)
+        sync_contexts(self.path, [active, done], get_fname)
+        # Files, their shards and rule directories, the shard left
+        # and both base directories
+        self.assertEqual(9 if active.id[:2] != done.id[:2] else 8,
+                         fsync.call_count)
+
+
+class TestMigrate(LayoutCase):
+
+    def setUp(self):
+        super().setUp()
+        self.db = Database(FileStore())
+        self.saved = [self.db.save(new_ctx(index)) for index in 'xyz']
+        complete(self.saved[2])
+        self.db.save(self.saved[2])
+
+    def test_migrate(self):
+        self.assertEqual(3, migrate('sharded', self.path))
+        x, y, z = self.saved
+        expected = [str(sharded(z, 'complete')), str(sharded(x)),
+                    str(sharded(y))]
+        self.assertEqual(sorted(expected), self.files())
+        self.assertEqual(3, migrate('flat', self.path))
+        self.assertEqual(sorted(['complete/' + get_fname(z), get_fname(x),
+                                 get_fname(y)]), self.files())
+        dirs = [path.name for path in self.path.glob('**/') if path.is_dir()]
+        self.assertEqual(['context', 'complete'], dirs)
+
+    def test_unknown(self):
+        with self.assertRaises(DatabaseError):
+            migrate('nested', self.path)
+
+    def test_online(self):
+        """Saves of a sharded server while the files are migrated."""
+        self.layout('sharded')
+        db = Database(FileStore())
+        x, y, _ = self.saved
+        x.nodes[0].calls_count = 5
+        db.save(x)
+        self.assertEqual(2, migrate('sharded', self.path))
+        complete(y)
+        db.save(y)
+        self.assertEqual(0, migrate('sharded', self.path))
+        db = Database(FileStore())
+        self.assertEqual([x.id], [ctx.id for ctx in db.active.values()])
+        self.assertEqual(5, db.active[x.rule_name, x.index].nodes[0]
+                         .calls_count)
+        found = db.read_complete('rule1', y.id)
+        self.assertEqual(context_to_dict(y), context_to_dict(found))
+
+    def test_interrupted(self):
+        """A flat file left next to its sharded copy is not loaded."""
+        x = self.saved[0]
+        target = self.path.joinpath(sharded(x))
+        target.parent.mkdir(parents=True)
+        os.link(str(self.path.joinpath(get_fname(x))), str(target))
+        self.layout('sharded')
+        entries = context_entries(self.path, '.json')
+        self.assertEqual(2, len(entries))
+        self.assertEqual(3, migrate('sharded', self.path))
+        self.assertEqual(2, len(Database(FileStore()).active))
+
+    def test_parse_fname(self):
+        self.assertEqual(('file-rule', 'abc'),
+                         parse_fname('ctx-file-rule-abc.json'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+import json
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+from imi.loader import load_documents, Loader, Progress
+
+__all__ = ['TestLoadDocuments', 'TestProgress']
+
+
+class TestLoadDocuments(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.paths = []
+        for num in range(20):
+            path = Path(tmp.name).joinpath('{}.json'.format(num))
+            path.write_text(json.dumps({'num': num}))
+            self.paths.append(path)
+        self.expected = [{'num': num} for num in range(20)]
+
+    def test_sequential(self):
+        docs = load_documents(self.paths, workers=1, processes=0)
+        self.assertEqual(self.expected, docs)
+
+    def test_threads(self):
+        docs = load_documents(self.paths, workers=4, processes=0)
+        self.assertEqual(self.expected, docs)
+
+    def test_processes(self):
+        docs = load_documents(self.paths, workers=4, processes=2)
+        self.assertEqual(self.expected, docs)
+
+    def test_process_size(self):
+        loader = Loader(processes=1, process_size=11)
+        self.addCleanup(loader.close)
+        with patch.object(loader.decoders, 'submit',
+                          wraps=loader.decoders.submit) as submit:
+            self.assertEqual({'num': 1}, loader.load(self.paths[1]))
+            self.assertFalse(submit.called)
+            self.assertEqual({'num': 10}, loader.load(self.paths[10]))
+            self.assertTrue(submit.called)
+
+    def test_broken(self):
+        self.paths[5].write_text('{"num"')
+        with self.assertRaises(ValueError):
+            load_documents(self.paths, workers=4, processes=0)
+
+    def test_empty(self):
+        self.assertEqual([], load_documents([], workers=4))
+
+
+class TestProgress(unittest.TestCase):
+
+    @patch('imi.loader.log')
+    def test_step(self, log):
+        progress = Progress(3, interval=0)
+        progress.step()
+        self.assertFalse(log.info.called)
+        progress.interval = 1e-9
+        progress.step()
+        log.info.assert_called_once_with('Loaded 2/3 files')
+        progress.finish()
+        self.assertRegex(log.info.call_args[0][0], r'Loaded 2 files in ')
+
+
+if __name__ == '__main__':
+    unittest.main()
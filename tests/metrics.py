@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+import json
+import unittest
+from unittest.mock import patch
+
+from imi.metrics import (Metric, Counter, Gauge, Histogram, render, snapshot,
+                         node_metrics, NODE_SECONDS)
+
+__all__ = ['TestMetrics']
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        metrics = patch('imi.metrics.METRICS', [])
+        self.addCleanup(metrics.stop)
+        metrics.start()
+
+    def test_counter(self):
+        counter = Counter('test_total', 'Test counter', ['path'])
+        counter.labels('/a').inc()
+        counter.labels('/a').inc(2)
+        counter.labels('/b"').inc()
+        expected = ('# HELP test_total Test counter\n'
+                    '# TYPE test_total counter\n'
+                    'test_total{path="/a"} 3\n'
+                    'test_total{path="/b\\""} 1\n')
+        self.assertEqual(expected, render())
+
+    def test_histogram(self):
+        histogram = Histogram('test_seconds', 'Test', buckets=(0.1, 1))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        lines = render().splitlines()
+        self.assertIn('test_seconds_bucket{le="0.1"} 1', lines)
+        self.assertIn('test_seconds_bucket{le="1"} 2', lines)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 3', lines)
+        self.assertIn('test_seconds_sum 5.55', lines)
+        self.assertIn('test_seconds_count 3', lines)
+
+    def test_histogram_time(self):
+        histogram = Histogram('test_seconds', 'Test', ['op'])
+        with histogram.labels('a').time():
+            pass
+        self.assertIn('test_seconds_count{op="a"} 1', render())
+
+    def test_gauge(self):
+        gauge = Gauge('test_items', 'Test', ['state'])
+        self.assertNotIn('test_items{', render())
+        gauge.set_function(lambda: {'active': 2, 'completed': 1})
+        lines = render().splitlines()
+        self.assertIn('test_items{state="active"} 2', lines)
+        self.assertIn('test_items{state="completed"} 1', lines)
+
+    def test_abstract(self):
+        with self.assertRaises(TypeError):
+            Metric('test', 'Test')
+
+    def test_merge(self):
+        counter = Counter('test_total', 'Test counter', ['path'])
+        histogram = Histogram('test_seconds', 'Test', buckets=(0.1, 1))
+        gauge = Gauge('test_items', 'Test')
+        gauge.set_function(lambda: 2)
+        counter.labels('/a').inc()
+        histogram.observe(0.5)
+        other = json.loads(json.dumps(snapshot()))
+        counter.labels('/b').inc()
+        lines = render([other, other]).splitlines()
+        self.assertIn('test_total{path="/a"} 3', lines)
+        self.assertIn('test_total{path="/b"} 1', lines)
+        self.assertIn('test_seconds_bucket{le="0.1"} 0', lines)
+        self.assertIn('test_seconds_bucket{le="1"} 3', lines)
+        self.assertIn('test_seconds_sum 1.5', lines)
+        self.assertIn('test_items 6', lines)
+
+    def test_node_metrics(self):
+        url = 'http://Example.com:8080/a'
+        seconds, errors = node_metrics('rule1', url)
+        self.assertIs(seconds, node_metrics('rule1', url)[0])
+        labels = NODE_SECONDS.children
+        self.assertIs(seconds, labels[('rule1', 'http', 'example.com')])
+        seconds, _ = node_metrics('rule1', 'command://notify')
+        self.assertIs(seconds, labels[('rule1', 'command', 'notify')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+import io
+import unittest
+from unittest.mock import patch, Mock, sentinel
+from urllib.error import HTTPError
+
+from imi.context import Rule, ContextError
+from imi.partition import Partition, PartitionAgent, partition_of
+
+__all__ = ['TestPartition', 'TestPartitionAgent']
+
+ADDRESSES = [('127.0.0.1', 8001), ('127.0.0.1', 8002), ('127.0.0.1', 8003)]
+
+
+class TestPartition(unittest.TestCase):
+
+    def test_partition_of(self):
+        index = frozenset({('a', 'b'), ('c', None)})
+        number = partition_of('rule1', index, 3)
+        self.assertIn(number, range(3))
+        same = frozenset({('c', None), ('a', 'b')})
+        self.assertEqual(number, partition_of('rule1', same, 3))
+
+    def test_spread(self):
+        numbers = set(partition_of('rule1', {('a', n)}, 3) for n in range(30))
+        self.assertEqual({0, 1, 2}, numbers)
+
+    def test_owns(self):
+        index = frozenset({('a', 'b')})
+        owner = partition_of('rule1', index, 3)
+        self.assertTrue(Partition(owner, ADDRESSES).owns('rule1', index))
+        other = (owner + 1) % 3
+        self.assertFalse(Partition(other, ADDRESSES).owns('rule1', index))
+        self.assertEqual('http://127.0.0.1:8002/invoke',
+                         Partition(0, ADDRESSES).url(1))
+
+
+class TestPartitionAgent(unittest.TestCase):
+
+    def setUp(self):
+        self.rule = Rule('rule1', {}, ['a'], [])
+        self.owner = partition_of('rule1', {('a', 'b')}, 3)
+
+    def agent(self, number):
+        partition = Partition(number, ADDRESSES)
+        agent = PartitionAgent([self.rule], Mock(), partition)
+        agent.apply_step = Mock(return_value=(False, sentinel.result))
+        return agent
+
+    def test_apply_local(self):
+        agent = self.agent(self.owner)
+        res = agent.apply_message({'a': 'b'})
+        self.assertIs(sentinel.result, res)
+
+    @patch('imi.partition.invoke_service')
+    def test_apply_forward(self, invoke_service):
+        other = (self.owner + 1) % 3
+        agent = self.agent(other)
+        invoke_service.return_value = sentinel.forwarded
+        res = agent.apply_message({'a': 'b'})
+        self.assertIs(sentinel.forwarded, res)
+        url = 'http://127.0.0.1:{}/invoke'.format(8001 + self.owner)
+        invoke_service.assert_called_once_with(url, {'a': 'b'})
+        self.assertFalse(agent.apply_step.called)
+
+    @patch('imi.partition.invoke_service')
+    def test_forward_context_error(self, invoke_service):
+        body = io.BytesIO(b'{"error": "Cannot find a rule"}')
+        err = HTTPError('url', 400, 'Bad Request', {}, body)
+        invoke_service.side_effect = err
+        agent = self.agent((self.owner + 1) % 3)
+        with self.assertRaisesRegex(ContextError, 'Cannot find a rule'):
+            agent.apply_message({'a': 'b'})
+
+    @patch('imi.partition.invoke_service')
+    def test_forward_server_error(self, invoke_service):
+        err = HTTPError('url', 500, 'Error', {}, io.BytesIO(b''))
+        invoke_service.side_effect = err
+        agent = self.agent((self.owner + 1) % 3)
+        with self.assertRaises(HTTPError):
+            agent.apply_message({'a': 'b'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+import json
+import socket
+import threading
+import unittest
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from unittest.mock import patch
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, build_opener
+
+from imi.pool import (PoolManager, PooledHTTPHandler, PooledHTTPSHandler,
+                      split_host)
+
+__all__ = ['TestPoolManager']
+
+
+class EchoHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.server.ports.add(self.client_address[1])
+        self.server.requests += 1
+        length = int(self.headers['Content-Length'])
+        data = self.rfile.read(length)
+        if self.path == '/drop':
+            self.close_connection = True
+            return  # called, but no response
+        code = 500 if self.path == '/error' else 200
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestPoolManager(unittest.TestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), EchoHandler)
+        self.server.daemon_threads = True
+        self.server.ports = set()
+        self.server.requests = 0
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  args=(0.05,))
+        thread.daemon = True
+        thread.start()
+        self.pools = PoolManager(size=2, retries=1)
+        self.opener = build_opener(PooledHTTPHandler(self.pools),
+                                   PooledHTTPSHandler(self.pools))
+        self.url = 'http://127.0.0.1:{}/'.format(self.server.server_port)
+
+    def post(self, url, doc):
+        data = json.dumps(doc).encode('utf-8')
+        headers = {'Content-Type': 'application/json'}
+        req = Request(url, data=data, method='POST', headers=headers)
+        response = self.opener.open(req)
+        return json.loads(response.read().decode('utf-8'))
+
+    def test_keep_alive(self):
+        for num in range(3):
+            self.assertEqual({'num': num}, self.post(self.url, {'num': num}))
+        self.assertEqual(1, len(self.server.ports))
+        self.assertEqual(1, len(self.pools.pools))
+
+    def test_http_error(self):
+        with self.assertRaises(HTTPError) as err:
+            self.post(self.url + 'error', {})
+        self.assertEqual(500, err.exception.code)
+        self.assertEqual({'num': 1}, self.post(self.url, {'num': 1}))
+
+    def test_retry_stale_connection(self):
+        self.post(self.url, {})
+        pool = next(iter(self.pools.pools.values()))
+        conn = pool.idle.get_nowait()
+        conn.sock.close()
+        conn.sock, peer = socket.socketpair()
+        peer.close()
+        pool.idle.put_nowait(conn)
+        self.assertEqual({'a': 'b'}, self.post(self.url, {'a': 'b'}))
+        self.assertEqual(2, len(self.server.ports))
+
+    def test_no_retry_after_sent(self):
+        self.post(self.url, {})
+        with self.assertRaises(URLError):
+            self.post(self.url + 'drop', {})
+        self.assertEqual(2, self.server.requests)
+
+    def test_connection_refused(self):
+        url = self.url
+        self.server.shutdown()
+        self.server.server_close()
+        with patch('imi.pool.log'):
+            with self.assertRaises(URLError):
+                self.post(url, {})
+
+    def test_split_host(self):
+        self.assertEqual(('example.com', 80),
+                         split_host('example.com', 'http'))
+        self.assertEqual(('example.com', 443),
+                         split_host('example.com', 'https'))
+        self.assertEqual(('::1', 8080), split_host('[::1]:8080', 'http'))
+
+    def tearDown(self):
+        self.pools.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
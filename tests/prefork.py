@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+import os
+import signal
+import threading
+import unittest
+from http.client import HTTPConnection
+from unittest.mock import patch
+from wsgiref.simple_server import WSGIRequestHandler
+
+from imi.prefork import (Master, PreboundServer, ThreadingPreboundServer,
+                         bind_socket)
+from imi.storage import DatabaseError
+
+__all__ = ['TestPreboundServer', 'TestMaster']
+
+
+def hello(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [b'hello']
+
+
+def wait_signal(number, sock, private):
+    signal.pause()
+
+
+class QuietHandler(WSGIRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+
+class TestPreboundServer(unittest.TestCase):
+
+    def test_serve(self):
+        sock = bind_socket('127.0.0.1', 0)
+        server = PreboundServer(sock, QuietHandler)
+        server.set_app(hello)
+        thread = threading.Thread(target=server.serve_forever,
+                                  kwargs={'poll_interval': 0.05})
+        thread.start()
+        try:
+            conn = HTTPConnection(*sock.getsockname())
+            conn.request('GET', '/')
+            self.assertEqual(b'hello', conn.getresponse().read())
+            conn.close()
+        finally:
+            server.shutdown()
+            thread.join()
+            sock.close()
+
+    def test_close_waits(self):
+        """Closing the server waits for the requests in progress."""
+        sock = bind_socket('127.0.0.1', 0)
+        server = ThreadingPreboundServer(sock, QuietHandler)
+        started = threading.Event()
+        done = []
+
+        def slow(environ, start_response):
+            started.set()
+            threading.Event().wait(0.3)
+            done.append(True)
+            return hello(environ, start_response)
+        server.set_app(slow)
+        thread = threading.Thread(target=server.serve_forever,
+                                  kwargs={'poll_interval': 0.05})
+        thread.start()
+        conn = HTTPConnection(*sock.getsockname())
+        conn.request('GET', '/')
+        started.wait(1)
+        server.shutdown()
+        thread.join()
+        server.server_close()
+        self.assertEqual([True], done)
+        self.assertEqual(b'hello', conn.getresponse().read())
+        conn.close()
+
+
+class TestMaster(unittest.TestCase):
+
+    @patch('imi.prefork.serve_worker', wait_signal)
+    def test_run_stop(self):
+        master = Master(2, '127.0.0.1', 0)
+        pids = []
+
+        def stop():
+            pids.extend(master.children)
+            master.stop()
+        timer = threading.Timer(0.5, stop)
+        timer.start()
+        self.addCleanup(signal.signal, signal.SIGINT,
+                        signal.default_int_handler)
+        self.addCleanup(signal.signal, signal.SIGTERM, signal.SIG_DFL)
+        master.run()
+        timer.join()
+        self.assertEqual(2, len(pids))
+        self.assertEqual({}, master.children)
+        for pid in pids:
+            with self.assertRaises(ProcessLookupError):
+                os.kill(pid, 0)
+
+    @patch('imi.prefork.config.WEB_RESPAWN_DELAY', 10)
+    @patch('imi.prefork.serve_worker', wait_signal)
+    def test_restart(self):
+        master = Master(2, '127.0.0.1', 0)
+        pids = []
+
+        def restart():
+            pids.append(set(master.children))
+            master.restart()
+            for _ in range(100):
+                if not pids[0] & set(master.children) and \
+                        len(master.children) == 2:
+                    break
+                threading.Event().wait(0.05)
+            pids.append(set(master.children))
+            master.stop()
+        timer = threading.Timer(0.5, restart)
+        timer.start()
+        self.addCleanup(signal.signal, signal.SIGINT,
+                        signal.default_int_handler)
+        self.addCleanup(signal.signal, signal.SIGTERM, signal.SIG_DFL)
+        self.addCleanup(signal.signal, signal.SIGHUP, signal.SIG_DFL)
+        master.run()
+        timer.join()
+        old, new = pids
+        self.assertEqual(2, len(new))
+        self.assertFalse(old & new)
+
+    @patch('imi.prefork.config.STORAGE', 'journal')
+    def test_journal(self):
+        with self.assertRaisesRegex(DatabaseError, 'single worker'):
+            Master(2, '127.0.0.1', 0).run()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,10 +2,11 @@
 
 import re
 import unittest
+from unittest.mock import patch, Mock
 
-from imi.query import match
+from imi.query import match, compile, Matcher
 
-__all__ = ['TestQuery']
+__all__ = ['TestQuery', 'TestCompile']
 
 
 class TestQuery(unittest.TestCase):
@@ -210,5 +211,48 @@ class TestQuery(unittest.TestCase):
     def tearDown(self):
         pass
 
+
+class TestCompile(unittest.TestCase):
+
+    def setUp(self):
+        self.document = {'a': 'b', 'n': [{'o': 'p'}, {'q': 'r'}]}
+
+    def test_compile_keeps_query(self):
+        query = {'a': 'b', 'n.o': {'$in': ['p']}}
+        matcher = compile(query)
+        self.assertIsInstance(matcher, Matcher)
+        self.assertEqual(query, matcher)
+        self.assertTrue(matcher(self.document))
+
+    def test_compile_matcher(self):
+        matcher = compile({'a': 'b'})
+        self.assertIs(matcher, compile(matcher))
+        self.assertTrue(match(self.document, matcher))
+
+    def test_compile_empty(self):
+        self.assertEqual({}, compile(None))
+        self.assertTrue(compile(None)(self.document))
+
+    def test_compile_regex_once(self):
+        re_compile = Mock(wraps=re.compile)
+        with patch.dict('imi.query.OPERATOR_ARGS', {'$regex': re_compile}):
+            matcher = compile({'a': {'$regex': '^b$'}})
+            self.assertTrue(matcher(self.document))
+            self.assertFalse(matcher({'a': 'c'}))
+        re_compile.assert_called_once_with('^b$')
+
+    def test_compile_unknown_operator(self):
+        matcher = compile({'a': {'$exists': True, '$unknown': 1}})
+        self.assertFalse(matcher(self.document))
+
+    def test_compile_nested(self):
+        matcher = compile({'$or': [{'a': 'z'},
+                                   {'n': {'$elemMatch': {'q': 'r'}}}]})
+        self.assertTrue(matcher(self.document))
+        self.assertFalse(matcher({'a': 'b'}))
+
+    def tearDown(self):
+        pass
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+import os
+import json
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch, Mock
+
+import imi.storage
+from imi.reload import RuleReloader
+
+__all__ = ['TestRuleReloader']
+
+
+def rule_doc(name, type_):
+    return {'name': name, 'criteria': {'type': type_}, 'index': ['a'],
+            'nodes': [{'url': 'noop://', 'exit': {}}]}
+
+
+class TestRuleReloader(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = Path(tmp.name)
+        # Rule files hold the type of their only rule
+        parse = patch('imi.storage.parse_rule_file',
+                      wraps=imi.storage.parse_rule_file)
+        list_rule_files = patch('imi.reload.list_rule_files')
+        self.addCleanup(parse.stop)
+        self.addCleanup(list_rule_files.stop)
+        self.parse = parse.start()
+        list_rule_files.start().side_effect = \
+            lambda: sorted(self.path.glob('*.yaml'))
+        self.agent = Mock()
+        self.reloader = RuleReloader(self.agent, interval=0.01)
+
+    def write(self, name, type_, mtime=None):
+        path = self.path.joinpath(name + '.yaml')
+        if type_ == 'broken':
+            path.write_text('broken')
+        else:
+            path.write_text(json.dumps(rule_doc('rule', type_)))
+        if mtime is not None:
+            os.utime(str(path), ns=(mtime, mtime))
+
+    def rules(self):
+        return self.agent.set_rules.call_args[0][0]
+
+    def test_scan(self):
+        self.write('r1', 't1')
+        self.write('r2', 't2')
+        self.assertTrue(self.reloader.scan())
+        self.assertEqual(['r1-rule', 'r2-rule'],
+                         [rule.name for rule in self.rules()])
+        self.assertFalse(self.reloader.scan())
+        self.assertEqual(1, self.agent.set_rules.call_count)
+        self.assertEqual(2, self.parse.call_count)
+
+    def test_scan_changed_only(self):
+        self.write('r1', 't1', 1)
+        self.write('r2', 't2', 1)
+        self.reloader.scan()
+        unchanged = self.rules()[1]
+        self.write('r1', 'tx', 2)
+        self.assertTrue(self.reloader.scan())
+        self.assertEqual(3, self.parse.call_count)
+        rules = self.rules()
+        self.assertEqual({'type': 'tx'}, rules[0].criteria)
+        self.assertIs(unchanged, rules[1])
+
+    def test_scan_removed(self):
+        self.write('r1', 't1')
+        self.write('r2', 't2')
+        self.reloader.scan()
+        self.path.joinpath('r2.yaml').unlink()
+        self.assertTrue(self.reloader.scan())
+        self.assertEqual(['r1-rule'], [rule.name for rule in self.rules()])
+        self.assertNotIn(self.path.joinpath('r2.yaml'),
+                         imi.storage.RULE_FILES)
+
+    def test_scan_broken(self):
+        self.write('r1', 't1', 1)
+        self.reloader.scan()
+        self.write('r1', 'broken', 2)
+        with patch('imi.reload.log'):
+            self.reloader.scan()
+        self.assertEqual({'type': 't1'}, self.rules()[0].criteria)
+        self.assertFalse(self.reloader.scan())
+        self.assertEqual(2, self.parse.call_count)
+
+    def test_scan_touched(self):
+        self.write('r1', 't1', 1)
+        self.reloader.scan()
+        os.utime(str(self.path.joinpath('r1.yaml')), ns=(2, 2))
+        self.assertFalse(self.reloader.scan())
+        self.assertEqual(1, self.parse.call_count)
+
+    def test_start_stop(self):
+        self.write('r1', 't1', 1)
+        self.reloader.start()
+        self.addCleanup(self.reloader.stop)
+        self.assertEqual(1, self.agent.set_rules.call_count)
+        self.write('r1', 't2', 2)
+        for _ in range(100):
+            if self.agent.set_rules.call_count > 1:
+                break
+            self.reloader.stopped.wait(0.01)
+        self.reloader.stop()
+        self.assertEqual({'type': 't2'}, self.rules()[0].criteria)
+
+    def tearDown(self):
+        pass
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+
+import sqlite3
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+from imi.context import NodeState
+from imi.sqlite import (SqliteDatabase, import_context_files, index_key,
+                        primary_key, dumps)
+from imi.storage import DatabaseError
+from tests.helpers import new_ctx
+
+__all__ = ['TestSqliteDatabase']
+
+
+def ctx_doc(ctxid, state, rule_name='rule1'):
+    return {
+        'id': ctxid,
+        'rule_name': rule_name,
+        'index': {'a': 'z'},
+        'nodes': [{
+            'url': 'http://example.com/1',
+            'state': state,
+            'calls_count': 1,
+            'result': {'criteria': {'c': 'd'}}
+        }]
+    }
+
+
+class TestSqliteDatabase(unittest.TestCase):
+
+    def setUp(self):
+        self.db = SqliteDatabase(':memory:')
+
+    def count(self, active):
+        query = 'SELECT count(*) FROM contexts WHERE active = ?'
+        return self.db.conn.execute(query, (active,)).fetchone()[0]
+
+    def test_index_key(self):
+        key1 = index_key(frozenset({('a', 'b'), ('c', 'd')}))
+        key2 = index_key({('c', 'd'), ('a', 'b')})
+        self.assertEqual(key1, key2)
+
+    def test_save_new(self):
+        ctx = self.db.save(new_ctx())
+        self.assertRegex(ctx.id, '[a-z0-9]{8}')
+        found = self.db.find_by_idx('rule1', {('a', 'z')})
+        self.assertEqual(ctx.id, found.id)
+        self.assertEqual(NodeState.current, found.nodes[0].state)
+        self.assertEqual({'c': 'd'}, found.nodes[0].result.criteria)
+
+    def test_find_by_idx_not_found(self):
+        self.db.save(new_ctx())
+        self.assertIsNone(self.db.find_by_idx('rule1', {('a', 'b')}))
+        self.assertIsNone(self.db.find_by_idx('rule2', {('a', 'z')}))
+
+    def test_save_new_if_index_exists(self):
+        self.db.save(new_ctx())
+        with self.assertRaisesRegex(DatabaseError, 'already exists'):
+            self.db.save(new_ctx())
+
+    def test_save_complete(self):
+        ctx = self.db.save(new_ctx())
+        ctx.nodes[0].state = NodeState.passed
+        self.db.save(ctx)
+        self.assertIsNone(self.db.find_by_idx('rule1', {('a', 'z')}))
+        self.assertEqual(0, self.count(1))
+        self.assertEqual(1, self.count(0))
+        self.db.save(new_ctx())
+        self.assertEqual(1, self.count(1))
+
+    def test_save_update_missed(self):
+        ctx = new_ctx()._replace(id='abc')
+        with self.assertRaisesRegex(DatabaseError, 'Untracked context #abc'):
+            self.db.save(ctx)
+
+    def test_batch(self):
+        with self.db.batch():
+            x = self.db.save(new_ctx('x'))
+            with self.db.batch():
+                self.db.save(new_ctx('y'))
+            self.assertEqual(0, self.count(1))
+            self.assertEqual(x.id, self.db.find_by_idx(
+                'rule1', {('a', 'x')}).id)
+            self.assertEqual(2, self.db.stats()['active'])
+            x.nodes[0].state = NodeState.passed
+            self.db.save(x)
+            self.assertIsNone(self.db.find_by_idx('rule1', {('a', 'x')}))
+        self.assertFalse(self.db.conn.in_transaction)
+        self.assertEqual(1, self.count(1))
+        self.assertEqual(1, self.count(0))
+        self.assertEqual({}, self.db.pending)
+
+    def test_batch_update(self):
+        ctx = self.db.save(new_ctx())
+        with self.db.batch():
+            ctx.nodes[0].state = NodeState.passed
+            self.db.save(ctx)
+            self.assertEqual(1, self.count(1))
+            self.assertIsNone(self.db.find_by_idx('rule1', {('a', 'z')}))
+            self.assertEqual(0, self.db.stats()['active'])
+        self.assertEqual(1, self.count(0))
+
+    def test_batch_rollback(self):
+        with self.assertRaises(ValueError):
+            with self.db.batch():
+                self.db.save(new_ctx('x'))
+                raise ValueError('node failed')
+        self.assertFalse(self.db.conn.in_transaction)
+        self.assertEqual(0, self.count(1))
+        self.assertIsNone(self.db.find_by_idx('rule1', {('a', 'x')}))
+
+    def test_batch_other_thread(self):
+        """Other threads neither wait for the batch nor join it."""
+        done = []
+
+        def step():
+            ctx = self.db.find_by_idx('rule1', {('a', 'x')})
+            ctx.nodes[0].calls_count = 5
+            done.append(self.db.save(ctx))
+            done.append(self.db.save(new_ctx('y')))
+        with self.assertRaises(ValueError):
+            with self.db.batch():
+                self.db.save(new_ctx('x'))
+                thread = threading.Thread(target=step)
+                thread.start()
+                thread.join(1)
+                self.assertEqual(2, len(done))
+                self.assertEqual(2, self.count(1))
+                raise ValueError('node failed')
+        found = self.db.find_by_idx('rule1', {('a', 'x')})
+        self.assertEqual(5, found.nodes[0].calls_count)
+
+    def test_read_complete(self):
+        ctx = self.db.save(new_ctx())
+        self.assertIsNone(self.db.read_complete('rule1', ctx.id))
+        ctx.nodes[0].state = NodeState.passed
+        self.db.save(ctx)
+        self.assertEqual(ctx.id, self.db.read_complete('rule1', ctx.id).id)
+        self.assertEqual([ctx.id], [c.id for c in self.db.iter_complete()])
+
+    @patch('imi.sqlite.iter_complete_docs')
+    @patch('imi.sqlite.load_context_docs')
+    def test_import(self, load_context_docs, iter_complete_docs):
+        load_context_docs.return_value = [ctx_doc('abc', 'current')]
+        complete = ctx_doc('def', 'passed')
+        iter_complete_docs.side_effect = lambda: iter([complete])
+        self.assertEqual(2, import_context_files(self.db))
+        self.assertEqual(0, import_context_files(self.db))
+        found = self.db.find_by_idx('rule1', {('a', 'z')})
+        self.assertEqual('abc', found.id)
+
+    @patch('imi.sqlite.iter_complete_docs')
+    @patch('imi.sqlite.load_context_docs')
+    def test_import_same_id(self, load_context_docs, iter_complete_docs):
+        load_context_docs.return_value = [
+            ctx_doc('abc', 'current'), ctx_doc('abc', 'current', 'rule-2')]
+        iter_complete_docs.side_effect = lambda: iter([])
+        self.assertEqual(2, import_context_files(self.db))
+        found = self.db.find_by_idx('rule-2', {('a', 'z')})
+        self.assertEqual(('rule-2', 'abc'), (found.rule_name, found.id))
+
+    def test_upgrade(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = Path(tmp.name).joinpath('context.db')
+        conn = sqlite3.connect(str(path))
+        conn.execute('CREATE TABLE contexts (id TEXT PRIMARY KEY,'
+                     ' rule_name TEXT NOT NULL, idx TEXT NOT NULL,'
+                     ' active INTEGER NOT NULL, doc TEXT NOT NULL)')
+        ctx = new_ctx()._replace(id='abc')
+        conn.execute('INSERT INTO contexts VALUES (?, ?, ?, 1, ?)',
+                     ('abc', ctx.rule_name, index_key(ctx.index),
+                      dumps(ctx)))
+        conn.commit()
+        conn.close()
+        db = SqliteDatabase(path)
+        self.addCleanup(db.close)
+        self.assertEqual(['rule_name', 'id'], primary_key(db.conn))
+        self.assertEqual('abc', db.find_by_idx(ctx.rule_name, ctx.index).id)
+        with self.assertRaises(DatabaseError):
+            db.save(new_ctx())
+        SqliteDatabase(path).close()
+
+    def tearDown(self):
+        self.db.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,19 @@
 #!/usr/bin/env python
 
 import io
+import os
+import yaml
+import tempfile
+from pathlib import Path
 
 import unittest
 from unittest.mock import patch, Mock, call
 
 import imi.storage
+import imi.metrics
 from imi.context import Context, Node, NodeResult, NodeState
+from imi.query import Matcher
+from imi.index import Extractor
 
 
 class TestDBFiles(unittest.TestCase):
@@ -20,14 +27,70 @@ class TestDBFiles(unittest.TestCase):
         file2 = Mock()
         file1.stem = 'file1'
         file2.stem = 'file2'
-        file1.open.return_value = io.StringIO('name: 1')
-        file2.open.return_value = io.StringIO('name: 2')
+        file1.read_bytes.return_value = b'name: 1'
+        file2.read_bytes.return_value = b'name: 2'
         globs = path.return_value.joinpath.return_value.glob
         globs.return_value = [file1, file2]
         results = imi.storage.load_rule_docs()
         expected = [{'name': 'file1-1'}, {'name': 'file2-2'}]
         self.assertEqual(expected, results)
 
+    def test_load_rule_file_cache(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = Path(tmp.name).joinpath('r.yaml')
+        path.write_text('name: a\n---\nname: b\n')
+        parse = Mock(wraps=imi.storage.parse_rule_file)
+        with patch('imi.storage.parse_rule_file', parse):
+            docs = imi.storage.load_rule_file(path)
+            self.assertEqual([{'name': 'r-a'}, {'name': 'r-b'}], docs)
+            self.assertIs(docs, imi.storage.load_rule_file(path))
+            os.utime(str(path), ns=(2, 2))  # touched only
+            self.assertIs(docs, imi.storage.load_rule_file(path))
+            self.assertEqual(1, parse.call_count)
+            version = imi.storage.rules_version()
+            path.write_text('name: c\n')
+            os.utime(str(path), ns=(1, 1))
+            docs = imi.storage.load_rule_file(path)
+            self.assertEqual([{'name': 'r-c'}], docs)
+            self.assertEqual(2, parse.call_count)
+            self.assertEqual(version + 1, imi.storage.rules_version())
+
+    @patch('imi.storage.rules_path')
+    def test_load_rule_file_evict(self, rules_path):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        rules_path.return_value = Path(tmp.name)
+        paths = [Path(tmp.name).joinpath(name) for name in ('a.yaml',
+                                                            'b.yaml')]
+        for path in paths:
+            path.write_text('name: x\n')
+        self.assertEqual(2, len(imi.storage.load_rule_docs()))
+        paths[1].unlink()
+        self.assertEqual([{'name': 'a-x'}], imi.storage.load_rule_docs())
+        self.assertIn(paths[0], imi.storage.RULE_FILES)
+        self.assertNotIn(paths[1], imi.storage.RULE_FILES)
+
+    def test_load_rule_file_error(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = Path(tmp.name).joinpath('r.yaml')
+        path.write_text('broken')
+        parse = Mock(wraps=imi.storage.parse_rule_file)
+        with patch('imi.storage.parse_rule_file', parse):
+            for _ in range(2):
+                with self.assertRaises(TypeError):
+                    imi.storage.load_rule_file(path)
+        self.assertEqual(1, parse.call_count)
+
+    def test_load_rule_file_safe(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = Path(tmp.name).joinpath('r.yaml')
+        path.write_text('name: !!python/object/apply:os.getcwd []\n')
+        with self.assertRaises(yaml.YAMLError):
+            imi.storage.load_rule_file(path)
+
     @patch('imi.storage.Path')
     def test_load_context_docs(self, path):
 
@@ -45,9 +108,27 @@ class TestDBFiles(unittest.TestCase):
         compglob = ctxpath.joinpath.return_value.glob
         compglob.return_value = [file1, file2]
         results = imi.storage.load_context_docs()
-        expected = [{'name': 1}, {'name': 2}, {'name': 1}, {'name': 2}]
+        expected = [{'name': 1}, {'name': 2}]
+        self.assertEqual(expected, results)
+        self.assertFalse(compglob.called)
+        results = list(imi.storage.iter_complete_docs())
         self.assertEqual(expected, results)
 
+    @patch('imi.storage.ctx_db_path')
+    def test_read_complete_doc(self, ctx_db_path):
+        path = ctx_db_path.return_value.joinpath.return_value
+        path.open.return_value = io.StringIO('{"id": "abc"}')
+        result = imi.storage.read_complete_doc('rule1', 'abc')
+        self.assertEqual({'id': 'abc'}, result)
+        args = ('complete', 'ctx-rule1-abc.json')
+        ctx_db_path.return_value.joinpath.assert_called_once_with(*args)
+
+    @patch('imi.storage.ctx_db_path')
+    def test_read_complete_doc_missed(self, ctx_db_path):
+        path = ctx_db_path.return_value.joinpath.return_value
+        path.open.side_effect = FileNotFoundError
+        self.assertIsNone(imi.storage.read_complete_doc('rule1', 'abc'))
+
     @patch('imi.storage.Path')
     @patch('imi.storage.config.DATADIR', 'test')
     def test_ctx_db_path(self, path):
@@ -81,6 +162,46 @@ def new_ctx():
     return Context(None, 'rule-new', {('a', 'z')}, [node])
 
 
+class TestOpenStore(unittest.TestCase):
+
+    @patch('imi.storage.ensure_ctx_dir')
+    @patch('imi.storage.config.STORAGE', 'files')
+    def test_files(self, ensure_ctx_dir):
+        store = imi.storage.open_store()
+        self.assertIsInstance(store, imi.storage.FileStore)
+        ensure_ctx_dir.assert_called_once_with()
+
+    @patch('imi.journal.JournalStore')
+    @patch('imi.storage.config.STORAGE', 'journal')
+    def test_journal(self, store):
+        self.assertEqual(store.return_value, imi.storage.open_store())
+
+    @patch('imi.compact.CompactStore')
+    @patch('imi.storage.config.STORAGE', 'compact')
+    def test_compact(self, store):
+        self.assertEqual(store.return_value, imi.storage.open_store())
+
+    @patch('imi.storage.config.STORAGE', 'unknown')
+    def test_unknown(self):
+        with self.assertRaises(imi.storage.DatabaseError):
+            imi.storage.open_store()
+
+
+class TestOpenDatabase(unittest.TestCase):
+
+    @patch('imi.storage.Database')
+    @patch('imi.storage.config.STORAGE', 'files')
+    def test_files(self, database):
+        db = imi.storage.open_database()
+        self.assertEqual(database.return_value, db)
+
+    @patch('imi.sqlite.SqliteDatabase')
+    @patch('imi.storage.config.STORAGE', 'sqlite')
+    def test_sqlite(self, database):
+        db = imi.storage.open_database()
+        self.assertEqual(database.return_value, db)
+
+
 class TestDatabase(unittest.TestCase):
 
     def setUp(self):
@@ -209,6 +330,20 @@ class TestDatabase(unittest.TestCase):
         self.assertEqual(3, len(rules[0].nodes))
         self.assertEqual('http://example.com/3', rules[0].nodes[2].url)
 
+    def test_rules_compiled(self):
+        rules = self.db.rules()
+        self.assertIsInstance(rules[0].criteria, Matcher)
+        self.assertIsInstance(rules[0].nodes[0].result.criteria, Matcher)
+        self.assertIsInstance(rules[0].index, Extractor)
+        self.assertEqual({'c': 'd'}, rules[0].nodes[0].result.criteria)
+
+    def test_shared_node_data(self):
+        rules = self.db.rules()
+        ctx = self.db.find_by_idx('rule1', {('a', 'b')})
+        rule_node = rules[0].nodes[0]
+        self.assertIs(rule_node.result.criteria, ctx.nodes[0].result.criteria)
+        self.assertIs(rule_node.url, ctx.nodes[0].url)
+
     def test_find_by_idx_found(self):
         idx = {('a', 'b')}
         ctx = self.db.find_by_idx('rule1', idx)
@@ -230,7 +365,7 @@ class TestDatabase(unittest.TestCase):
         ctx = self.contexts[-1]
         self.assertRegex(ctx['id'], '[a-z0-9]{8}')
         self.assertEqual('rule-new', ctx['rule_name'])
-        self.assertEqual(3, len(self.db.contexts))
+        self.assertEqual(2, len(self.db.active))
 
     def test_save_new_completed(self):
         ctx = new_ctx()
@@ -245,7 +380,6 @@ class TestDatabase(unittest.TestCase):
         ctx = self.contexts[-1]
         self.assertRegex(ctx['id'], '[a-z0-9]{8}')
         self.assertEqual('rule-new', ctx['rule_name'])
-        self.assertEqual(3, len(self.db.contexts))
         self.assertEqual(2, len(self.db.active))
 
     def test_save_new_tries_exceeded(self):
@@ -259,13 +393,59 @@ class TestDatabase(unittest.TestCase):
         self.fail('DatabaseError not raised')
 
     def test_save_update(self):
-        ctx = self.db.contexts[0]
+        completed = imi.metrics.CONTEXTS_COMPLETED.labels()
+        before = completed.value
+        ctx = self.db.find_by_idx('rule1', {('a', 'b')})
         nodes = ctx.nodes
         nodes[1].state = NodeState.passed
         nodes[2].state = NodeState.passed
         self.db.save(ctx)
+        self.assertEqual(before + 1, completed.value)
         self.assertEqual(0, len(self.db.active))
         self.save_complete.assert_called_once_with('w')
+        self.assertEqual({'active': 0}, self.db.stats())
+
+    def test_save_new_active(self):
+        ctx = self.db.save(new_ctx())
+        self.assertIs(ctx, self.db.find_by_idx('rule-new', {('a', 'z')}))
+        self.assertEqual(2, len(self.db.active))
+
+    def test_save_update_active(self):
+        ctx = self.db.find_by_idx('rule1', {('a', 'b')})
+        self.db.save(ctx)
+        self.assertIs(ctx, self.db.find_by_idx('rule1', {('a', 'b')}))
+        self.assertEqual(1, len(self.db.active))
+
+    def test_loads_active_only(self):
+        self.assertEqual(1, len(self.db.active))
+        self.assertIsNone(self.db.find_by_idx('rule1', {('a', 'z')}))
+
+    def test_owns(self):
+        store = Mock()
+        store.load.return_value = self.contexts
+        db = imi.storage.Database(store, owns=lambda name, idx: False)
+        self.assertEqual({}, db.active)
+
+    def test_read_complete(self):
+        store = Mock()
+        store.load.return_value = []
+        store.read_complete.return_value = self.contexts[1]
+        store.iter_complete.return_value = iter(self.contexts[1:])
+        db = imi.storage.Database(store)
+        ctx = db.read_complete('rule1', 'zyx')
+        store.read_complete.assert_called_once_with('rule1', 'zyx')
+        self.assertEqual('zyx', ctx.id)
+        self.assertEqual(['zyx'], [ctx.id for ctx in db.iter_complete()])
+
+    def test_save_store(self):
+        store = Mock()
+        store.load.return_value = []
+        store.create.side_effect = lambda ctx: ctx._replace(id='new')
+        db = imi.storage.Database(store)
+        ctx = db.save(new_ctx())
+        store.create.assert_called_once_with(ctx._replace(id=None))
+        db.save(ctx)
+        store.update.assert_called_once_with(ctx)
 
     def test_save_new_if_index_exists(self):
         ctx = new_ctx()
@@ -279,7 +459,7 @@ class TestDatabase(unittest.TestCase):
         self.fail('DatabaseError not raised')
 
     def test_save_update_missed(self):
-        ctx = self.db.contexts[0]
+        ctx = self.db.find_by_idx('rule1', {('a', 'b')})
         ctx = ctx._replace(index={('a', 'z')})
         try:
             self.db.save(ctx)
@@ -1,10 +1,14 @@
 #!/usr/bin/env python
 
+import json
 import unittest
-from unittest.mock import patch, sentinel, MagicMock
+from urllib.error import URLError
+from unittest.mock import patch, sentinel, MagicMock, Mock, call, ANY
 
 import imi.web
 import imi.context
+import imi.metrics
+from imi.partition import Partition
 
 __all__ = ['TestWebApp']
 
@@ -14,13 +18,19 @@ class TestWebApp(unittest.TestCase):
     def setUp(self):
         ensuredatadir = patch('imi.web.ensuredatadir')
         ctx = patch('imi.web.ContextAgent')
-        db = patch('imi.web.Database')
+        db = patch('imi.web.open_database')
+        reloader = patch('imi.web.RuleReloader')
+        checkpointer = patch('imi.web.Checkpointer')
         self.addCleanup(ensuredatadir.stop)
         self.addCleanup(ctx.stop)
         self.addCleanup(db.stop)
+        self.addCleanup(reloader.stop)
+        self.addCleanup(checkpointer.stop)
         self.ensuredatadir = ensuredatadir.start()
         self.ctx = ctx.start()
         self.db = db.start()
+        self.reloader = reloader.start()
+        self.checkpointer = checkpointer.start()
         self.app = imi.web.WebApp()
 
     def test__init__(self):
@@ -29,6 +39,45 @@ class TestWebApp(unittest.TestCase):
         self.assertEqual(self.app.ctx, self.ctx.return_value)
         ctx_args = self.db.return_value.rules.return_value, self.app.db
         self.ctx.assert_called_once_with(*ctx_args)
+        self.reloader.assert_called_once_with(self.app.ctx, 2)
+        self.reloader.return_value.start.assert_called_once_with()
+        self.checkpointer.assert_called_once_with(self.app.db, 60)
+        self.checkpointer.return_value.start.assert_called_once_with()
+
+    @patch('imi.web.RULES_RELOAD_INTERVAL', 0)
+    def test__init__no_reload(self):
+        self.reloader.reset_mock()
+        imi.web.WebApp()
+        self.assertFalse(self.reloader.called)
+
+    def test__init__no_checkpoint(self):
+        self.checkpointer.reset_mock()
+        self.db.return_value.checkpoint = None
+        imi.web.WebApp()
+        self.assertFalse(self.checkpointer.called)
+
+    def test_close(self):
+        self.app.close()
+        self.reloader.return_value.stop.assert_called_once_with()
+        self.checkpointer.return_value.stop.assert_called_once_with()
+        self.app.db.flush.assert_called_once_with()
+        self.app.db.close.assert_called_once_with()
+
+    @patch('imi.web.PartitionAgent')
+    def test__init__partition(self, agent):
+        partition = Partition(1, [('::1', 1), ('::1', 2)])
+        imi.web.WebApp(partition)
+        self.db.assert_called_with(partition.owns, '1-of-2')
+
+    @patch('imi.web.PartitionAgent', Mock())
+    @patch('imi.web.metrics.CONTEXTS')
+    def test__init__shared_storage(self, gauge):
+        self.db.return_value.shared = True
+        imi.web.WebApp(Partition(1, [('::1', 1), ('::1', 2)]))
+        gauge.set_function.assert_called_once_with(None)
+        gauge.reset_mock()
+        imi.web.WebApp(Partition(0, [('::1', 1), ('::1', 2)]))
+        gauge.set_function.assert_called_once_with(self.db.return_value.stats)
 
     @patch('imi.web.request')
     def test_invoke(self, request):
@@ -50,6 +99,78 @@ class TestWebApp(unittest.TestCase):
         response = self.app.invoke()
         self.assertEqual('test error', response['error'])
 
+    @patch('imi.web.response', MagicMock())
+    @patch('imi.web.request')
+    def test_invoke_batch(self, request):
+        body = b'[{"a": 1}, {"a": 2}, {"a": 3}]'
+        request.body.read.return_value = body
+        err = imi.context.ContextError('test error')
+        self.app.ctx.apply_message.side_effect = [{'b': 1}, err, {'b': 3}]
+        res = json.loads(self.app.invoke_batch())
+        self.assertEqual([{'b': 1}, {'error': 'test error'}, {'b': 3}], res)
+        self.assertEqual(3, self.app.ctx.apply_message.call_count)
+        self.app.db.batch.assert_called_once_with()
+
+    @patch('imi.web.log', MagicMock())
+    @patch('imi.web.response', MagicMock())
+    @patch('imi.web.request')
+    def test_invoke_batch_failure(self, request):
+        request.body.read.return_value = b'{"a": 1}\n{"a": 2}'
+        err = URLError('connection refused')
+        self.app.ctx.apply_message.side_effect = [err, {'b': 2}]
+        res = json.loads(self.app.invoke_batch())
+        expected = [{'error': '<urlopen error connection refused>'},
+                    {'b': 2}]
+        self.assertEqual(expected, res)
+
+    @patch('imi.web.response', MagicMock())
+    @patch('imi.web.request')
+    def test_invoke_batch_bad_body(self, request):
+        request.body.read.return_value = b'{"a": 1}\nnot json'
+        res = self.app.invoke_batch()
+        self.assertIn('error', res)
+        self.assertFalse(self.app.ctx.apply_message.called)
+
+    @patch('imi.web.response', MagicMock())
+    @patch('imi.web.request', MagicMock())
+    def test_invoke_metrics(self):
+        err = imi.context.ContextError('test error')
+        self.app.ctx.apply_message.side_effect = err
+        errors = imi.metrics.REQUEST_ERRORS.labels('/invoke')
+        before = errors.value
+        self.app.invoke()
+        self.assertEqual(before + 1, errors.value)
+
+    @patch('imi.web.response')
+    def test_show_metrics(self, response):
+        self.app.db.stats.return_value = {'active': 2}
+        text = self.app.show_metrics()
+        self.assertIn('imi_contexts{state="active"} 2\n', text)
+        self.assertIn('imi_request_seconds', text)
+        self.assertTrue(response.content_type.startswith('text/plain'))
+
+    @patch('imi.web.log', Mock())
+    @patch('imi.web.urlopen')
+    @patch('imi.web.response', MagicMock())
+    def test_show_metrics_workers(self, urlopen):
+        self.app.partition = Partition(0, [('127.0.0.1', port)
+                                           for port in (1, 2, 3)])
+        self.app.db.stats.return_value = {'active': 2}
+        peer = {'imi_contexts': [[['active'], 3]]}
+        res = urlopen.return_value.__enter__.return_value
+        res.read.return_value = json.dumps(peer).encode('utf-8')
+        urlopen.side_effect = [urlopen.return_value, URLError('down')]
+        text = self.app.show_metrics()
+        self.assertIn('imi_contexts{state="active"} 5\n', text)
+        urlopen.assert_any_call('http://127.0.0.1:2/metrics/local',
+                                timeout=ANY)
+
+    @patch('imi.web.response', MagicMock())
+    def test_show_local_metrics(self):
+        self.app.db.stats.return_value = {'active': 2}
+        doc = json.loads(self.app.show_local_metrics())
+        self.assertEqual([[['active'], 2]], doc['imi_contexts'])
+
     def tearDown(self):
         pass
 
@@ -71,8 +192,22 @@ class TestHelpers(unittest.TestCase):
     @patch('imi.web.WebApp')
     def test_init_app(self, app, bott):
         imi.web.init_app()
-        args = ('/invoke', ['POST'], app.return_value.invoke)
-        bott.return_value.route.assert_called_once_with(*args)
+        routes = [call('/invoke', ['POST'], app.return_value.invoke),
+                  call('/invoke/batch', ['POST'],
+                       app.return_value.invoke_batch),
+                  call('/metrics', ['GET'], app.return_value.show_metrics),
+                  call('/metrics/local', ['GET'],
+                       app.return_value.show_local_metrics)]
+        self.assertEqual(routes, bott.return_value.route.call_args_list)
+        plugin = bott.return_value.install.call_args[0][0]
+        plugin.close()
+        app.return_value.close.assert_called_once_with()
+
+    def test_parse_batch(self):
+        expected = [{'a': 1}, {'a': 2}]
+        self.assertEqual(expected, imi.web.parse_batch('[{"a":1},{"a":2}]'))
+        self.assertEqual(expected, imi.web.parse_batch('{"a":1}\n{"a":2}\n'))
+        self.assertEqual([{'a': 1}], imi.web.parse_batch('{"a": 1}'))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+from imi.workers import WorkerManager, WorkerError
+
+__all__ = ['TestWorkerManager']
+
+WORKER = '''#!{}
+import os, sys, json
+print(json.dumps({{'ready': True}}), flush=True)
+for line in sys.stdin:
+    doc = json.loads(line)
+    if doc.get('crash'):
+        sys.exit(1)
+    if doc.get('hang'):
+        sys.stdin.readline()
+    doc['pid'] = os.getpid()
+    print(json.dumps(doc), flush=True)
+'''
+
+ONESHOT = '''#!{}
+import sys
+sys.stdout.write(sys.stdin.read())
+'''
+
+
+class TestWorkerManager(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.bindir = Path(tmp.name)
+        self.worker = self.script('worker', WORKER)
+        self.oneshot = self.script('oneshot', ONESHOT)
+        sizes = {'worker': 1, 'oneshot': 1}
+        self.manager = WorkerManager(sizes, timeout=2, start_timeout=0.5)
+        self.addCleanup(self.manager.close)
+        log = patch('imi.workers.log')
+        self.addCleanup(log.stop)
+        log.start()
+
+    def script(self, name, template):
+        path = self.bindir.joinpath(name)
+        with path.open('w') as stream:
+            stream.write(template.format(sys.executable))
+        os.chmod(str(path), 0o755)
+        return path
+
+    def call(self, command, path, doc):
+        out = self.manager.call(command, path, json.dumps(doc).encode())
+        return json.loads(out.decode('utf-8')) if out else out
+
+    def test_persistent(self):
+        res1 = self.call('worker', self.worker, {'a': 1})
+        res2 = self.call('worker', self.worker, {'a': 2})
+        self.assertEqual(2, res2['a'])
+        self.assertEqual(res1['pid'], res2['pid'])
+
+    def test_not_configured(self):
+        self.assertIsNone(self.call('other', self.worker, {}))
+
+    def test_fall_back(self):
+        self.assertIsNone(self.call('oneshot', self.oneshot, {}))
+        self.assertIn('oneshot', self.manager.oneshot)
+
+    def test_restart_on_crash(self):
+        res1 = self.call('worker', self.worker, {})
+        with self.assertRaisesRegex(WorkerError, 'exited'):
+            self.call('worker', self.worker, {'crash': True})
+        res2 = self.call('worker', self.worker, {})
+        self.assertNotEqual(res1['pid'], res2['pid'])
+
+    def test_timeout(self):
+        self.manager.timeout = 0.2
+        with self.assertRaisesRegex(WorkerError, 'timed out'):
+            self.call('worker', self.worker, {'hang': True})
+        self.assertIn('a', self.call('worker', self.worker, {'a': 1}))
+
+    def tearDown(self):
+        pass
+
+
+if __name__ == '__main__':
+    unittest.main()
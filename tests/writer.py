@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+from unittest.mock import patch, Mock, ANY
+
+import imi.storage
+from imi.context import Context, Node, NodeResult, NodeState
+from imi.storage import (DatabaseError, sync_contexts, get_fname,
+                         context_to_dict)
+from imi.writer import WriteBehindStore
+
+__all__ = ['TestWriteBehindStore', 'TestSync']
+
+
+def new_ctx(ctxid='abc'):
+    node = Node('http://example.com/1', NodeState.current, 0,
+                NodeResult({'c': 'd'}, None))
+    return Context(ctxid, 'rule1', frozenset({('a', 'z')}), [node])
+
+
+class TestWriteBehindStore(unittest.TestCase):
+
+    def open(self, durability, interval=0.01):
+        self.store = Mock()
+        self.store.create.side_effect = lambda ctx: ctx._replace(id='new')
+        self.written = []
+        self.store.update.side_effect = lambda ctx: self.written.append(
+            (ctx.id, ctx.nodes[0].calls_count))
+        writer = WriteBehindStore(self.store, durability, interval)
+        self.addCleanup(writer.close)
+        return writer
+
+    def test_coalesce(self):
+        writer = self.open('none', 10)
+        ctx = new_ctx()
+        for _ in range(3):
+            ctx.nodes[0].calls_count += 1
+            writer.update(ctx)
+        writer.update(new_ctx('def'))
+        ctx.nodes[0].calls_count += 1  # not saved
+        writer.flush()
+        self.assertEqual([('abc', 3), ('def', 0)], self.written)
+        self.assertFalse(self.store.sync.called)
+
+    def test_create(self):
+        writer = self.open('none')
+        self.assertEqual('new', writer.create(new_ctx(None)).id)
+        writer.flush()
+        self.assertEqual([], self.written)
+
+    def test_batched(self):
+        writer = self.open('batched')
+        writer.create(new_ctx(None))
+        writer.update(new_ctx())
+        writer.flush()
+        self.assertEqual([('abc', 0)], self.written)
+        synced = self.store.sync.call_args[0][0]
+        self.assertEqual(['new', 'abc'], [ctx.id for ctx in synced])
+
+    def test_strict(self):
+        writer = self.open('strict', 10)
+        writer.update(new_ctx())
+        writer.wait()
+        self.assertEqual([('abc', 0)], self.written)
+        self.store.sync.assert_called_once_with([ANY])
+
+    def test_strict_batch(self):
+        writer = self.open('strict')
+        release = threading.Event()
+        released = []
+        self.store.sync.side_effect = lambda ctxs: released.append(
+            release.wait(1))
+        with writer.batch():
+            with writer.batch():
+                writer.update(new_ctx())
+            writer.update(new_ctx('def'))
+            release.set()
+        self.assertEqual(['abc', 'def'], sorted(ctxid for ctxid, _ in
+                                                self.written))
+        self.assertTrue(all(released))
+
+    @patch('imi.writer.log', Mock())
+    def test_strict_error(self):
+        writer = self.open('strict')
+        self.recovered = False
+
+        def update(ctx):
+            self.fail_bad(ctx)
+            self.recovered = True
+        self.store.update.side_effect = update
+        writer.update(new_ctx('bad'))
+        writer.update(new_ctx())
+        writer.wait()
+        self.assertEqual([('abc', 0), ('bad', 0)], self.written)
+
+    @patch('imi.writer.log', Mock())
+    def test_strict_error_close(self):
+        writer = self.open('strict')
+        self.recovered = False
+        self.store.update.side_effect = lambda ctx: self.fail_bad(ctx)
+        writer.update(new_ctx('bad'))
+        threading.Timer(0.05, writer.close).start()
+        with self.assertRaisesRegex(DatabaseError, 'before close'):
+            writer.wait()
+
+    def fail_bad(self, ctx):
+        if ctx.id == 'bad' and not self.recovered:
+            raise OSError('disk full')
+        self.written.append((ctx.id, ctx.nodes[0].calls_count))
+
+    @patch('imi.writer.log', Mock())
+    def test_retry(self):
+        writer = self.open('batched')
+        self.recovered = False
+        self.store.update.side_effect = lambda ctx: self.fail_bad(ctx)
+        for ctxid in ('bad', 'abc', 'def'):
+            writer.update(new_ctx(ctxid))
+        writer.flush()
+        self.assertEqual(['abc', 'def'], [ctxid for ctxid, _ in
+                                          self.written])
+        self.recovered = True
+        writer.flush()
+        writer.flush()
+        self.assertEqual(['abc', 'def', 'bad'], [ctxid for ctxid, _ in
+                                                 self.written])
+
+    def test_rule_key(self):
+        writer = self.open('none', 10)
+        writer.update(new_ctx('x'))
+        writer.update(new_ctx('x')._replace(rule_name='rule2'))
+        writer.flush()
+        self.assertEqual([('x', 0), ('x', 0)], self.written)
+
+    def test_strict_group(self):
+        writer = self.open('strict')
+        ctxs = [new_ctx('abc'), new_ctx('def')._replace(index=frozenset())]
+        self.store.load.return_value = [context_to_dict(ctx) for ctx in ctxs]
+        db = imi.storage.Database(writer)
+        release = threading.Event()
+        self.store.sync.side_effect = lambda ctxs: release.wait(1)
+        saves = [threading.Thread(target=db.save, args=(ctx,))
+                 for ctx in ctxs]
+        for thread in saves:
+            thread.start()
+        # A save waiting for the sync does not hold up the other one
+        for _ in range(100):
+            if len(self.written) + len(writer.queue) == 2:
+                break
+            threading.Event().wait(0.01)
+        self.assertEqual(2, len(self.written) + len(writer.queue))
+        release.set()
+        for thread in saves:
+            thread.join()
+
+    def test_close(self):
+        writer = self.open('none', 10)
+        writer.update(new_ctx())
+        writer.close()
+        self.assertEqual([('abc', 0)], self.written)
+        self.store.close.assert_called_once_with()
+        with self.assertRaises(DatabaseError):
+            writer.update(new_ctx())
+
+    def test_read_complete(self):
+        writer = self.open('none', 10)
+        writer.update(new_ctx())
+        writer.read_complete('rule1', 'abc')
+        self.assertEqual([('abc', 0)], self.written)
+
+    def test_unknown(self):
+        with self.assertRaises(DatabaseError):
+            WriteBehindStore(Mock(), 'sometimes')
+
+    @patch('imi.writer.WriteBehindStore')
+    @patch('imi.storage.ensure_ctx_dir', Mock())
+    @patch('imi.storage.config.WRITE_BEHIND', 'batched')
+    def test_open_store(self, writer):
+        self.assertEqual(writer.return_value, imi.storage.open_store())
+
+
+class TestSync(unittest.TestCase):
+
+    @patch('imi.storage.os.fsync')
+    def test_sync_contexts(self, fsync):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = Path(tmp.name)
+        path.joinpath('complete').mkdir()
+        active = new_ctx()
+        done = new_ctx('def')
+        done.nodes[0].state = NodeState.passed
+        path.joinpath(get_fname(active)).touch()
+        path.joinpath('complete', get_fname(done)).touch()
+        sync_contexts(path, [active, done], get_fname)
+        self.assertEqual(4, fsync.call_count)
+
+
+if __name__ == '__main__':
+    unittest.main()